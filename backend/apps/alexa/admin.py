@@ -1,3 +1,11 @@
 from django.contrib import admin
+from .models import AlexaEvent
 
-# Register your models here.
+@admin.register(AlexaEvent)
+class AlexaEventAdmin(admin.ModelAdmin):
+    list_display = ('namespace', 'name', 'created_at', 'sent_at', 'attempts')
+    list_filter = ('namespace', 'name')
+    # The scope token is a user credential: never shown
+    exclude = ('access_token',)
+    readonly_fields = ('namespace', 'name', 'correlation_token', 'payload', 'created_at', 'sent_at',
+                       'attempts', 'last_error')
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class AlexaConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.alexa'
+
+    def ready(self):
+        import apps.alexa.signals  # noqa
@@ -3,6 +3,8 @@ from rest_framework import exceptions
 from oauth2_provider.models import AccessToken
 from django.utils import timezone
 
+from apps.users.authentication import token_cache
+
 class AlexaManualAuthentication(authentication.BaseAuthentication):
     def authenticate(self, request):
         auth_header = request.META.get('HTTP_AUTHORIZATION', '')
@@ -10,13 +12,19 @@ class AlexaManualAuthentication(authentication.BaseAuthentication):
             return None
 
         token_str = auth_header.split(' ')[1]
+
+        # Tokens seen before (by Alexa or the DRF stack) need no query
+        cached = token_cache.get('oauth2', token_str)
+        if cached is not None:
+            return cached
         
         try:
-            token = AccessToken.objects.get(token=token_str)
+            token = AccessToken.objects.select_related('user').get(token=token_str)
             
             if token.expires < timezone.now():
                 raise exceptions.AuthenticationFailed('Token expired')
-                
+
+            token_cache.put('oauth2', token_str, token.user, token, token.scope, token.expires)
             return (token.user, token)
             
         except AccessToken.DoesNotExist:
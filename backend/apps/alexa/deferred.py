@@ -0,0 +1,185 @@
+"""
+Routine activations that may outlast Alexa's response deadline.
+
+A routine whose compiled plan is estimated to fit ALEXA_RESPONSE_BUDGET is
+awaited and answered directly (so failures are reported). Longer ones are
+answered with a DeferredResponse; when the run finishes, its final event
+(ActivationStarted / Response, or an ErrorResponse) is written to the
+AlexaEvent outbox, from which AlexaEventOutbox.drain() hands it to the
+event gateway.
+"""
+import copy
+import datetime
+import logging
+import math
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+from oauth2_provider.models import get_access_token_model
+
+from .models import AlexaEvent
+
+logger = logging.getLogger(__name__)
+
+
+def response_budget() -> float:
+    return getattr(settings, 'ALEXA_RESPONSE_BUDGET', 3)
+
+
+def estimated_duration(plan) -> float:
+    from apps.routines.runtime import routine_runtime
+    return plan.estimated_duration(getattr(settings, 'ALEXA_STAGE_LATENCY_ESTIMATE', 0.5),
+                                   routine_runtime.max_fanout)
+
+
+def deferred_response(header: Dict[str, Any], seconds: float) -> Dict[str, Any]:
+    return {
+        "event": {
+            "header": {
+                "namespace": "Alexa",
+                "name": "DeferredResponse",
+                "payloadVersion": "3",
+                "messageId": str(uuid.uuid4()),
+                "correlationToken": header.get('correlationToken')
+            },
+            "payload": {
+                "estimatedDeferralInSeconds": max(1, math.ceil(seconds))
+            }
+        }
+    }
+
+
+def run_routine(routine_id, header: Dict[str, Any], build_response: Callable[[], Dict[str, Any]],
+                build_error: Callable[[str], Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Start a routine for a directive and return what Alexa gets now: the
+    directive's response, an error, or a DeferredResponse whose final event
+    goes to the outbox. Raises NezuRoutine.DoesNotExist for unknown ids.
+    """
+    from apps.routines.runtime import routine_runtime
+    execution = routine_runtime.submit(routine_id)
+    estimate = estimated_duration(execution.plan)
+    budget = response_budget()
+
+    def final_event(finished):
+        return build_error(finished.error) if finished.error else build_response()
+
+    # Registering fails only if the run is already over: then answer directly
+    if estimate > budget and execution.add_done_callback(lambda finished: outbox.put(final_event(finished))):
+        logger.info(f"Routine {routine_id}: ~{estimate:.1f}s is over the {budget}s budget, deferring")
+        return deferred_response(header, estimate)
+
+    if execution.wait(budget):
+        return final_event(execution)
+    # Still finishing its last calls: it has started either way
+    return build_response()
+
+
+def scope_of(event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    return event.get('event', {}).get('endpoint', {}).get('scope')
+
+
+class AlexaEventOutbox:
+    """
+    Pending Alexa events, stored until the gateway accepts them. Events sent
+    (or still pending) after `retention_hours` are deleted by the drain, at
+    most every `prune_interval` seconds.
+    """
+
+    def __init__(self, retention_hours: int = None, prune_interval: float = 3600):
+        self.retention_hours = (retention_hours if retention_hours is not None
+                                else getattr(settings, 'ALEXA_EVENT_RETENTION_HOURS', 24))
+        self.prune_interval = prune_interval
+        self._lock = threading.Lock()
+        self._pruned_at = None
+
+    def put(self, event: Dict[str, Any]):
+        """Store an event, minus its scope token; called from the routine worker threads"""
+        header = event['event']['header']
+        close_old_connections()
+        try:
+            payload = copy.deepcopy(event)
+            scope = scope_of(payload)
+            token = scope.pop('token', None) if scope else None
+            access_token = get_access_token_model().objects.filter(token=token).first() if token else None
+            AlexaEvent.objects.create(namespace=header['namespace'], name=header['name'],
+                                      correlation_token=header.get('correlationToken') or '', payload=payload,
+                                      access_token=access_token,
+                                      user_id=access_token.user_id if access_token else None,
+                                      application_id=access_token.application_id if access_token else None)
+        except Exception as e:
+            logger.error(f"Could not store Alexa event {header['namespace']}.{header['name']}: {e}")
+        finally:
+            close_old_connections()
+
+    def drain(self, send: Callable[[Dict[str, Any]], Any], limit: int = 100) -> int:
+        """
+        Hand up to `limit` pending events, oldest first, to `send` (e.g. a
+        POST to the Alexa event gateway). Events whose send raises stay
+        pending for the next drain. Returns the number sent.
+        """
+        sent = []
+        for event in AlexaEvent.objects.filter(sent_at__isnull=True).select_related('access_token')[:limit]:
+            try:
+                send(self._with_token(event))
+            except Exception as e:
+                logger.error(f"Alexa event {event.id} not sent: {e}")
+                AlexaEvent.objects.filter(id=event.id).update(attempts=event.attempts + 1, last_error=str(e))
+                continue
+            sent.append(event.id)
+        if sent:
+            AlexaEvent.objects.filter(id__in=sent).update(sent_at=timezone.now())
+        self._maybe_prune()
+        return len(sent)
+
+    @staticmethod
+    def _with_token(event: AlexaEvent) -> Dict[str, Any]:
+        """
+        The stored payload with its scope token put back. A token refresh
+        deletes the access token the event was stored with, so events that
+        outlive it are sent with the user's newest live token for the same
+        application.
+        """
+        payload = copy.deepcopy(event.payload)
+        scope = scope_of(payload)
+        if scope is not None:
+            access_token = event.access_token
+            if access_token is None or access_token.is_expired():
+                access_token = get_access_token_model().objects.filter(
+                    user_id=event.user_id, application_id=event.application_id,
+                    expires__gt=timezone.now()).order_by('-expires').first() if event.user_id else None
+            if access_token is None:
+                raise ValueError("the user has no live access token for this event")
+            scope['token'] = access_token.token
+        return payload
+
+    def _maybe_prune(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._pruned_at is not None and now - self._pruned_at < self.prune_interval:
+                return
+            self._pruned_at = now
+        self.prune()
+
+    def prune(self, before: datetime.datetime = None) -> int:
+        """
+        Delete events sent before `before` (default: the retention window)
+        and pending events created before it, which Alexa would no longer
+        accept. Returns the number of events deleted.
+        """
+        before = before or timezone.now() - datetime.timedelta(hours=self.retention_hours)
+        deleted, _ = AlexaEvent.objects.filter(
+            Q(sent_at__lt=before) | Q(sent_at__isnull=True, created_at__lt=before)).delete()
+        if deleted:
+            logger.info(f"Pruned {deleted} Alexa events older than {before:%Y-%m-%d %H:%M}")
+        return deleted
+
+
+# Singleton instance
+outbox = AlexaEventOutbox()
@@ -0,0 +1,149 @@
+"""
+Alexa discovery payload: every device, routine and room as an endpoint.
+
+The endpoint list is built with one query per entity type (rooms come with
+their device count annotated) and kept in the Django cache until a Device,
+Room or NezuRoutine change drops it (see signals.py), so re-discovery is a
+cache hit.
+"""
+import logging
+from typing import Any, Dict, List
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Count
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY = 'alexa_discovery:endpoints'
+MANUFACTURER = "Nezu HomePilot"
+ALEXA_INTERFACE = {
+    "type": "AlexaInterface",
+    "interface": "Alexa",
+    "version": "3"
+}
+ENDPOINT_HEALTH = {
+    "type": "AlexaInterface",
+    "interface": "Alexa.EndpointHealth",
+    "version": "3",
+    "properties": {
+        "supported": [{"name": "connectivity"}],
+        "proactivelyReported": False,
+        "retrievable": True
+    }
+}
+# Map Nezu device types to Alexa display categories (SWITCH otherwise)
+DISPLAY_CATEGORIES = {
+    'light': 'LIGHT',
+    'lock': 'SMARTLOCK',
+}
+# Device fields that show up in discovery: saves touching only other fields
+# (state updates) keep the cached payload
+DEVICE_FIELDS = {'name', 'type', 'room', 'room_obj', 'room_obj_id', 'entity_id'}
+
+
+def power_controller(proactively_reported: bool) -> Dict[str, Any]:
+    return {
+        "type": "AlexaInterface",
+        "interface": "Alexa.PowerController",
+        "version": "3",
+        "properties": {
+            "supported": [{"name": "powerState"}],
+            "proactivelyReported": proactively_reported,
+            "retrievable": True
+        }
+    }
+
+
+def build_endpoints() -> List[Dict[str, Any]]:
+    """Discovery endpoints for devices, routines and rooms: three queries"""
+    from apps.devices.models import Device
+    from apps.rooms.models import Room
+    from apps.routines.models import NezuRoutine
+
+    endpoints = []
+    devices = Device.objects.only('id', 'name', 'type', 'room', 'entity_id')
+    for device in devices:
+        endpoints.append({
+            "endpointId": str(device.id),
+            "manufacturerName": MANUFACTURER,
+            "friendlyName": device.name,
+            "description": f"{device.type} in {device.room}",
+            "displayCategories": [DISPLAY_CATEGORIES.get(device.type, 'SWITCH')],
+            "cookie": {
+                "entity_id": device.entity_id
+            },
+            "capabilities": [ALEXA_INTERFACE, power_controller(True), ENDPOINT_HEALTH]
+        })
+
+    # Routines as scenes
+    for routine_id, name in NezuRoutine.objects.values_list('id', 'name'):
+        endpoints.append({
+            "endpointId": f"routine_{routine_id}",
+            "manufacturerName": MANUFACTURER,
+            "friendlyName": name,
+            "description": "Nezu Routine",
+            "displayCategories": ["SCENE_TRIGGER"],
+            "cookie": {
+                "routine_id": str(routine_id)
+            },
+            "capabilities": [
+                ALEXA_INTERFACE,
+                {
+                    "type": "AlexaInterface",
+                    "interface": "Alexa.SceneController",
+                    "version": "3",
+                    "supportsDeactivation": False
+                }
+            ]
+        })
+
+    # Rooms that have devices, as controllable groups
+    rooms = Room.objects.annotate(num_devices=Count('devices')).filter(num_devices__gt=0)
+    for room_id, name, num_devices in rooms.values_list('id', 'name', 'num_devices'):
+        endpoints.append({
+            "endpointId": f"room_{room_id}",
+            "manufacturerName": MANUFACTURER,
+            "friendlyName": name,
+            "description": f"Room with {num_devices} devices",
+            "displayCategories": ["SWITCH"],  # Using SWITCH for room groups
+            "cookie": {
+                "room_id": str(room_id),
+                "type": "room"
+            },
+            "capabilities": [ALEXA_INTERFACE, power_controller(False), ENDPOINT_HEALTH]
+        })
+    return endpoints
+
+
+class DiscoveryCache:
+    """
+    The assembled endpoint list in the Django cache. With a shared cache
+    backend an invalidation reaches every worker; `ttl` bounds how stale a
+    per-process cache can get after edits made by another process.
+    """
+
+    def __init__(self, cache_alias: str = None, ttl: float = None):
+        self.cache_alias = cache_alias or getattr(settings, 'ALEXA_DISCOVERY_CACHE_ALIAS', 'default')
+        self.ttl = ttl if ttl is not None else getattr(settings, 'ALEXA_DISCOVERY_TTL', 3600)
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def get(self) -> List[Dict[str, Any]]:
+        endpoints = self.cache.get(CACHE_KEY)
+        if endpoints is None:
+            endpoints = build_endpoints()
+            self.cache.set(CACHE_KEY, endpoints, timeout=self.ttl)
+            logger.info(f"Alexa Discovery: built {len(endpoints)} endpoints")
+        return endpoints
+
+    def invalidate(self):
+        """Drop the payload once the current transaction commits"""
+        transaction.on_commit(lambda: self.cache.delete(CACHE_KEY))
+
+
+# Singleton instance
+discovery_cache = DiscoveryCache()
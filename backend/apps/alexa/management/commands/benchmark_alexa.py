@@ -0,0 +1,92 @@
+import statistics
+import time
+from concurrent import futures
+from unittest import mock
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from apps.alexa.services import handle_directive
+from apps.devices.models import Device
+from apps.rooms.models import Room
+from apps.users.models import User
+
+BENCH_PREFIX = 'light.nezu_alexa_bench_'
+
+
+def directive(namespace, name, endpoint_id, cookie):
+    return {'directive': {
+        'header': {'namespace': namespace, 'name': name, 'messageId': 'bench', 'correlationToken': 'bench'},
+        'endpoint': {'endpointId': endpoint_id, 'cookie': cookie, 'scope': {'type': 'BearerToken', 'token': 'bench'}},
+        'payload': {},
+    }}
+
+
+def percentiles(durations):
+    durations_ms = sorted(duration * 1000 for duration in durations)
+    return (f'p50 {statistics.median(durations_ms):.1f}ms, '
+            f'p99 {durations_ms[int(len(durations_ms) * 0.99) - 1]:.1f}ms, max {durations_ms[-1]:.1f}ms')
+
+
+class Command(BaseCommand):
+    help = 'Benchmark Alexa ReportState and room TurnOn (against a simulated slow HA)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=300)
+        parser.add_argument('--room-size', type=int, default=40)
+        parser.add_argument('--ha-latency', type=float, default=5.0, help='Seconds HA takes to answer a service call')
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(is_superuser=True).first() or User.objects.first()
+        if user is None:
+            self.stderr.write('Create a user first')
+            return
+
+        Device.objects.filter(entity_id__startswith=BENCH_PREFIX).delete()
+        room = Room.objects.create(name='Alexa bench', user=user)
+        Device.objects.bulk_create([
+            Device(name=f'Alexa bench {i}', type='light', entity_id=f'{BENCH_PREFIX}{i}', ha_domain='light',
+                   room_obj=room)
+            for i in range(options['room_size'])
+        ])
+        device = Device.objects.filter(entity_id__startswith=BENCH_PREFIX).first()
+        endpoints = [
+            (str(device.id), {'entity_id': device.entity_id}),
+            (f'room_{room.id}', {'room_id': str(room.id), 'type': 'room'}),
+        ]
+
+        try:
+            durations, queries = [], 0
+            for i in range(options['requests']):
+                endpoint_id, cookie = endpoints[i % 2]
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    handle_directive(directive('Alexa', 'ReportState', endpoint_id, cookie))
+                    durations.append(time.perf_counter() - started)
+                queries += len(captured)
+            self.stdout.write(f'ReportState: {len(durations)} requests, {percentiles(durations)}, '
+                              f'{queries / len(durations):.1f} queries/request')
+
+            # HA that answers after --ha-latency seconds; the dispatcher's
+            # timeout (the Alexa budget) still applies
+            executor = futures.ThreadPoolExecutor(max_workers=4)
+
+            def slow_ha(calls, limit=None, timeout=None):
+                executor.submit(time.sleep, options['ha_latency']).result(timeout)
+                return [[]] * len(calls)
+
+            durations = []
+            with mock.patch('apps.core.services.ha_dispatcher.call_services_concurrently', slow_ha):
+                for name in ('TurnOn', 'TurnOff') * 3:
+                    started = time.perf_counter()
+                    handle_directive(directive('Alexa.PowerController', name, *endpoints[1]))
+                    durations.append(time.perf_counter() - started)
+            executor.shutdown(wait=False)
+            self.stdout.write(f'Room power ({options["room_size"]} devices, HA answering in {options["ha_latency"]}s, '
+                              f'budget {settings.ALEXA_ROOM_POWER_BUDGET}s): '
+                              f'{len(durations)} requests, {percentiles(durations)}')
+        finally:
+            Device.objects.filter(entity_id__startswith=BENCH_PREFIX).delete()
+            room.delete()
@@ -0,0 +1,19 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.alexa.deferred import AlexaEventOutbox
+
+
+class Command(BaseCommand):
+    help = 'Delete Alexa outbox events older than the retention window (ALEXA_EVENT_RETENTION_HOURS)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=None, help='Keep this many hours instead')
+
+    def handle(self, *args, **options):
+        outbox = AlexaEventOutbox(retention_hours=options['hours'])
+        before = timezone.now() - datetime.timedelta(hours=outbox.retention_hours)
+        deleted = outbox.prune(before)
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} events older than {before:%Y-%m-%d %H:%M}'))
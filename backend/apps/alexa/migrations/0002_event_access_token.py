@@ -0,0 +1,34 @@
+# Generated by Django 3.2.25 on 2026-10-17 19:58
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def move_tokens_out_of_payloads(apps, schema_editor):
+    AlexaEvent = apps.get_model('alexa', 'AlexaEvent')
+    AccessToken = apps.get_model(*settings.OAUTH2_PROVIDER_ACCESS_TOKEN_MODEL.split('.'))
+    for event in AlexaEvent.objects.all():
+        scope = event.payload.get('event', {}).get('endpoint', {}).get('scope')
+        if not scope or 'token' not in scope:
+            continue
+        token = scope.pop('token')
+        event.access_token = AccessToken.objects.filter(token=token).first() if token else None
+        event.save(update_fields=['payload', 'access_token'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.OAUTH2_PROVIDER_ACCESS_TOKEN_MODEL),
+        ('alexa', '0001_alexa_event_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alexaevent',
+            name='access_token',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.OAUTH2_PROVIDER_ACCESS_TOKEN_MODEL),
+        ),
+        migrations.RunPython(move_tokens_out_of_payloads, migrations.RunPython.noop),
+    ]
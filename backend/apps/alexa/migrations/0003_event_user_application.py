@@ -0,0 +1,36 @@
+# Generated by Django 3.2.25 on 2026-10-17 20:13
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_token_owners(apps, schema_editor):
+    AlexaEvent = apps.get_model('alexa', 'AlexaEvent')
+    for event in AlexaEvent.objects.filter(access_token__isnull=False).select_related('access_token'):
+        event.user_id = event.access_token.user_id
+        event.application_id = event.access_token.application_id
+        event.save(update_fields=['user', 'application'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.OAUTH2_PROVIDER_APPLICATION_MODEL),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('alexa', '0002_event_access_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alexaevent',
+            name='application',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.OAUTH2_PROVIDER_APPLICATION_MODEL),
+        ),
+        migrations.AddField(
+            model_name='alexaevent',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(copy_token_owners, migrations.RunPython.noop),
+    ]
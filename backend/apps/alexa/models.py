@@ -1,3 +1,35 @@
+from django.conf import settings
 from django.db import models
+from oauth2_provider.settings import oauth2_settings
 
-# Create your models here.
+
+class AlexaEvent(models.Model):
+    """
+    Outbox of asynchronous events for the Alexa event gateway, e.g. the
+    final Response of a directive answered with a DeferredResponse.
+    Rows are written when the event happens and sent by a drain (see
+    deferred.AlexaEventOutbox), so no event is lost if sending fails.
+    The payload is stored without its scope token: the drain adds it back
+    from `access_token` when sending, or from the user's current token for
+    the same application once that one is refreshed or expires.
+    """
+    namespace = models.CharField(max_length=100)
+    name = models.CharField(max_length=100)
+    correlation_token = models.TextField(blank=True, default='')
+    payload = models.JSONField()
+    access_token = models.ForeignKey(oauth2_settings.ACCESS_TOKEN_MODEL, null=True, blank=True,
+                                     on_delete=models.SET_NULL, related_name='+')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.CASCADE,
+                             related_name='+')
+    application = models.ForeignKey(oauth2_settings.APPLICATION_MODEL, null=True, blank=True,
+                                    on_delete=models.CASCADE, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return f"{self.namespace}.{self.name} ({'sent' if self.sent_at else 'pending'})"
@@ -1,5 +1,7 @@
 import logging
 import uuid
+
+from .state import alexa_timestamp
 # from apps.devices.models import Device # Moved to individual functions to avoid circular/shadowing issues
 
 logger = logging.getLogger(__name__)
@@ -18,6 +20,9 @@ def handle_directive(request_payload):
     if namespace == 'Alexa.Discovery' and name == 'Discover':
         return handle_discovery()
     
+    if namespace == 'Alexa' and name == 'ReportState':
+        return handle_report_state(directive)
+
     if namespace == 'Alexa.PowerController':
         return handle_power_control(directive)
 
@@ -46,11 +51,7 @@ def handle_scene_control(directive):
     if name != 'Activate':
          return create_error_response(header, 'INVALID_DIRECTIVE', 'Only Activate is supported for scenes')
 
-    try:
-        from apps.routines.services import RoutineService
-        RoutineService.execute_routine(routine_id)
-        
-        # Response
+    def activation_started():
         return {
             "context": {},
             "event": {
@@ -72,128 +73,25 @@ def handle_scene_control(directive):
                     "cause": {
                         "type": "VOICE_INTERACTION"
                     },
-                    "timestamp": "2017-02-03T16:20:50.52Z" # TODO: Real timestamp
+                    "timestamp": alexa_timestamp()
                 }
             }
         }
 
+    try:
+        # Long routines get a DeferredResponse; ActivationStarted follows via the outbox
+        from .deferred import run_routine
+        return run_routine(routine_id, header, activation_started,
+                           lambda error: create_error_response(header, 'ENDPOINT_UNREACHABLE', error, endpoint))
+
     except Exception as e:
         logger.error(f"Error executing scene: {e}")
         return create_error_response(header, 'INTERNAL_ERROR', str(e))
 
 def handle_discovery():
-    from apps.devices.models import Device
-    devices = Device.objects.all()
-    endpoints = []
-
-    for device in devices:
-        # Map Nezu device types to Alexa display categories
-        display_categories = ['SWITCH']
-        if device.type == 'light':
-            display_categories = ['LIGHT']
-        elif device.type == 'lock':
-            display_categories = ['SMARTLOCK']
-        
-        # Capabilities
-        capabilities = [
-            {
-                "type": "AlexaInterface",
-                "interface": "Alexa",
-                "version": "3"
-            },
-            {
-                "type": "AlexaInterface",
-                "interface": "Alexa.PowerController",
-                "version": "3",
-                "properties": {
-                    "supported": [{"name": "powerState"}],
-                    "proactivelyReported": True,
-                    "retrievable": True
-                }
-            }
-        ]
-
-        endpoints.append({
-            "endpointId": str(device.id),
-            "manufacturerName": "Nezu HomePilot",
-            "friendlyName": device.name,
-            "description": f"{device.type} in {device.room}",
-            "displayCategories": display_categories,
-            "cookie": {
-                "entity_id": device.entity_id
-            },
-            "capabilities": capabilities
-        })
-        logger.info(f"Alexa Discovery: Mapping device '{device.name}' (ID: {device.id})")
-
-    logger.info("Starting Alexa Discovery...")
-    
-    # Add Routines as Scenes
-    from apps.routines.models import NezuRoutine
-    routines = NezuRoutine.objects.all()
-    logger.info(f"Found {routines.count()} routines to discover.")
-    
-    for routine in routines:
-        endpoints.append({
-            "endpointId": f"routine_{routine.id}",
-            "manufacturerName": "Nezu HomePilot",
-            "friendlyName": routine.name,
-            "description": "Nezu Routine",
-            "displayCategories": ["SCENE_TRIGGER"],
-            "cookie": {
-                "routine_id": str(routine.id)
-            },
-            "capabilities": [
-                {
-                    "type": "AlexaInterface",
-                    "interface": "Alexa",
-                    "version": "3"
-                },
-                {
-                    "type": "AlexaInterface",
-                    "interface": "Alexa.SceneController",
-                    "version": "3",
-                    "supportsDeactivation": False
-                }
-            ]
-        })
-
-    # Add Rooms as controllable groups
-    from apps.rooms.models import Room
-    rooms = Room.objects.all()
-    logger.info(f"Found {rooms.count()} rooms to discover.")
-    
-    for room in rooms:
-        # Only expose rooms that have devices
-        if room.device_count > 0:
-            endpoints.append({
-                "endpointId": f"room_{room.id}",
-                "manufacturerName": "Nezu HomePilot",
-                "friendlyName": room.name,
-                "description": f"Room with {room.device_count} devices",
-                "displayCategories": ["SWITCH"],  # Using SWITCH for room groups
-                "cookie": {
-                    "room_id": str(room.id),
-                    "type": "room"
-                },
-                "capabilities": [
-                    {
-                        "type": "AlexaInterface",
-                        "interface": "Alexa",
-                        "version": "3"
-                    },
-                    {
-                        "type": "AlexaInterface",
-                        "interface": "Alexa.PowerController",
-                        "version": "3",
-                        "properties": {
-                            "supported": [{"name": "powerState"}],
-                            "proactivelyReported": False,
-                            "retrievable": True
-                        }
-                    }
-                ]
-            })
+    # Cached between discoveries, dropped by Device/Room/NezuRoutine changes
+    from .discovery import discovery_cache
+    endpoints = discovery_cache.get()
 
     logger.info(f"Discovery complete. Returning {len(endpoints)} endpoints.")
     for ep in endpoints:
@@ -214,6 +112,59 @@ def handle_discovery():
     }
 
 
+def handle_report_state(directive):
+    """
+    Current power state and connectivity of a device or room endpoint, from
+    the local state view (no Home Assistant round-trip)
+    """
+    header = directive.get('header', {})
+    endpoint = directive.get('endpoint', {})
+    endpoint_id = str(endpoint.get('endpointId', ''))
+    cookie = endpoint.get('cookie', {})
+
+    from .state import state_properties, state_view
+    if endpoint_id.startswith('routine_'):
+        # Scenes have no state of their own, only reachability
+        properties = [{
+            "namespace": "Alexa.EndpointHealth",
+            "name": "connectivity",
+            "value": {"value": "OK"},
+            "timeOfSample": alexa_timestamp(),
+            "uncertaintyInMilliseconds": 0
+        }]
+    else:
+        if cookie.get('type') == 'room' or endpoint_id.startswith('room_'):
+            state = state_view.room(cookie.get('room_id') or endpoint_id.replace('room_', ''))
+        else:
+            state = state_view.device(endpoint_id)
+        if state is None:
+            return create_error_response(header, 'NO_SUCH_ENDPOINT', f'Endpoint not found: {endpoint_id}')
+        properties = state_properties(state)
+
+    return {
+        "context": {
+            "properties": properties
+        },
+        "event": {
+            "header": {
+                "namespace": "Alexa",
+                "name": "StateReport",
+                "payloadVersion": "3",
+                "messageId": str(uuid.uuid4()),
+                "correlationToken": header.get('correlationToken')
+            },
+            "endpoint": {
+                "scope": {
+                    "type": "BearerToken",
+                    "token": endpoint.get('scope', {}).get('token')
+                },
+                "endpointId": endpoint_id
+            },
+            "payload": {}
+        }
+    }
+
+
 def handle_power_control(directive):
     header = directive.get('header', {})
     endpoint = directive.get('endpoint', {})
@@ -233,22 +184,17 @@ def handle_power_control(directive):
     # Handle room control
     if room_id and endpoint_type == 'room':
         try:
+            from django.conf import settings
             from apps.rooms.models import Room
-            from apps.devices.models import Device
-            room = Room.objects.get(id=room_id)
-            
-            logger.info(f"Controlling room '{room.name}' via Alexa: {name}")
+            from apps.devices.services import DeviceService
             
             target_state = True if name == 'TurnOn' else False
             
-            devices_in_room = Device.objects.filter(room_obj=room)
-            
-            for device in devices_in_room:
-                try:
-                    from apps.devices.services import DeviceService
-                    DeviceService.toggle_device(device.id, target_state)
-                except Exception as e:
-                    logger.error(f"Error toggling device {device.name}: {e}")
+            # One UPDATE, then grouped HA commands; Alexa is answered once the
+            # budget is spent even if HA has not replied yet
+            count = DeviceService.set_room_power(room_id, target_state,
+                                                 timeout=getattr(settings, 'ALEXA_ROOM_POWER_BUDGET', 2))
+            logger.info(f"Controlling room {room_id} ({count} devices) via Alexa: {name}")
             
             return {
                 "context": {
@@ -256,7 +202,7 @@ def handle_power_control(directive):
                         "namespace": "Alexa.PowerController",
                         "name": "powerState",
                         "value": "ON" if target_state else "OFF",
-                        "timeOfSample": "2017-02-03T16:20:50.52Z",
+                        "timeOfSample": alexa_timestamp(),
                         "uncertaintyInMilliseconds": 500
                     }]
                 },
@@ -294,12 +240,7 @@ def handle_power_control(directive):
         routine_id = device_id.replace('routine_', '')
 
     if routine_id:
-        try:
-            logger.info(f"Executing routine {routine_id} via PowerController")
-            if name == 'TurnOn':
-                from apps.routines.services import RoutineService
-                RoutineService.execute_routine(routine_id)
-            
+        def power_response():
             return {
                 "context": {
                     "properties": [
@@ -307,14 +248,14 @@ def handle_power_control(directive):
                             "namespace": "Alexa.PowerController",
                             "name": "powerState",
                             "value": "ON" if name == 'TurnOn' else "OFF",
-                            "timeOfSample": "2017-02-03T16:20:50.52Z",
+                            "timeOfSample": alexa_timestamp(),
                             "uncertaintyInMilliseconds": 500
                         },
                         {
                             "namespace": "Alexa.EndpointHealth",
                             "name": "connectivity",
                             "value": {"value": "OK"},
-                            "timeOfSample": "2017-02-03T16:20:50.52Z",
+                            "timeOfSample": alexa_timestamp(),
                             "uncertaintyInMilliseconds": 500
                         }
                     ]
@@ -337,6 +278,14 @@ def handle_power_control(directive):
                     "payload": {}
                 }
             }
+
+        try:
+            logger.info(f"Executing routine {routine_id} via PowerController")
+            if name != 'TurnOn':
+                return power_response()
+            from .deferred import run_routine
+            return run_routine(routine_id, header, power_response,
+                               lambda error: create_error_response(header, 'ENDPOINT_UNREACHABLE', error, endpoint))
         except Exception as e:
             logger.error(f"Error executing routine: {e}")
             return create_error_response(header, 'INTERNAL_ERROR', str(e))
@@ -357,7 +306,7 @@ def handle_power_control(directive):
                     "namespace": "Alexa.PowerController",
                     "name": "powerState",
                     "value": "ON" if target_state else "OFF",
-                    "timeOfSample": "2017-02-03T16:20:50.52Z",
+                    "timeOfSample": alexa_timestamp(),
                     "uncertaintyInMilliseconds": 500
                 }]
             },
@@ -389,8 +338,8 @@ def handle_power_control(directive):
         traceback.print_exc()
         return create_error_response(header, 'INTERNAL_ERROR', str(e))
 
-def create_error_response(header, type, message):
-    return {
+def create_error_response(header, type, message, endpoint=None):
+    response = {
         "event": {
             "header": {
                 "namespace": "Alexa",
@@ -405,3 +354,13 @@ def create_error_response(header, type, message):
             }
         }
     }
+    if endpoint is not None:
+        # Asynchronous (outbox) errors must name the endpoint and its scope
+        response["event"]["endpoint"] = {
+            "scope": {
+                "type": "BearerToken",
+                "token": endpoint.get('scope', {}).get('token')
+            },
+            "endpointId": endpoint.get('endpointId')
+        }
+    return response
@@ -0,0 +1,26 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.devices.models import Device
+from apps.devices.signals import devices_changed
+from apps.rooms.models import Room
+from apps.routines.models import NezuRoutine
+from .discovery import DEVICE_FIELDS, discovery_cache
+
+
+@receiver(post_save, sender=Device)
+def drop_discovery_for_device(sender, instance, created, update_fields=None, **kwargs):
+    # State updates name their fields and don't change what Alexa discovers
+    if created or update_fields is None or DEVICE_FIELDS.intersection(update_fields):
+        discovery_cache.invalidate()
+
+
+@receiver(post_save, sender=Room)
+@receiver(post_save, sender=NezuRoutine)
+@receiver(post_delete, sender=Room)
+@receiver(post_delete, sender=NezuRoutine)
+@receiver(devices_changed)
+def drop_discovery(sender, **kwargs):
+    # Device deletes arrive as devices_changed: a Device post_delete receiver
+    # would stop the sync engine's bulk delete from being a single DELETE
+    discovery_cache.invalidate()
@@ -0,0 +1,105 @@
+"""
+State of Alexa endpoints for ReportState, without asking Home Assistant.
+
+Power and connectivity come from the Device rows, which the reconciler keeps
+in step with HA and user commands update optimistically. The time of each
+sample is the entity's `last_updated` in the in-memory state mirror, or the
+user command if that is newer, so a ReportState costs one indexed query.
+"""
+import datetime
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from apps.core.services.ha_state_mirror import state_mirror
+
+
+def alexa_timestamp(when: datetime.datetime = None) -> str:
+    """ISO 8601 in UTC with millisecond precision, as Alexa expects"""
+    when = (when or timezone.now()).astimezone(datetime.timezone.utc)
+    return when.strftime('%Y-%m-%dT%H:%M:%S.') + f'{when.microsecond // 1000:03d}Z'
+
+
+class EndpointState(NamedTuple):
+    is_on: bool
+    is_online: bool
+    sampled_at: datetime.datetime
+
+
+class StateView:
+    """Current state of device and room endpoints"""
+
+    def __init__(self, mirror=None):
+        self.mirror = mirror or state_mirror
+
+    def _sampled_at(self, entity_id: Optional[str], last_user_command, updated_at) -> datetime.datetime:
+        sampled_at = None
+        state = self.mirror.get_state(entity_id) if entity_id else None
+        if state:
+            sampled_at = parse_datetime(state.get('last_updated') or state.get('last_changed') or '')
+        if last_user_command and (sampled_at is None or last_user_command > sampled_at):
+            sampled_at = last_user_command
+        return sampled_at or updated_at
+
+    def _states(self, devices) -> List[EndpointState]:
+        rows = devices.values_list('entity_id', 'is_on', 'is_online', 'last_user_command', 'updated_at')
+        return [
+            EndpointState(is_on, is_online, self._sampled_at(entity_id, last_user_command, updated_at))
+            for entity_id, is_on, is_online, last_user_command, updated_at in rows
+        ]
+
+    def device(self, device_id) -> Optional[EndpointState]:
+        """State of one device, or None if there is no such device"""
+        from apps.devices.models import Device
+        try:
+            device_id = int(device_id)
+        except (TypeError, ValueError):
+            return None
+        states = self._states(Device.objects.filter(id=device_id))
+        return states[0] if states else None
+
+    def room(self, room_id) -> Optional[EndpointState]:
+        """
+        Aggregated state of a room: on if any device is on, reachable if any
+        device is, sampled at its most recent device sample. None if the room
+        has no devices (rooms without devices are not discovered).
+        """
+        from apps.devices.models import Device
+        try:
+            room_id = int(room_id)
+        except (TypeError, ValueError):
+            return None
+        states = self._states(Device.objects.filter(room_obj_id=room_id))
+        if not states:
+            return None
+        return EndpointState(
+            any(state.is_on for state in states),
+            any(state.is_online for state in states),
+            max(state.sampled_at for state in states),
+        )
+
+
+def state_properties(state: EndpointState) -> List[Dict[str, Any]]:
+    """PowerController and EndpointHealth context properties for a state"""
+    time_of_sample = alexa_timestamp(state.sampled_at)
+    return [
+        {
+            "namespace": "Alexa.PowerController",
+            "name": "powerState",
+            "value": "ON" if state.is_on else "OFF",
+            "timeOfSample": time_of_sample,
+            "uncertaintyInMilliseconds": 0
+        },
+        {
+            "namespace": "Alexa.EndpointHealth",
+            "name": "connectivity",
+            "value": {"value": "OK" if state.is_online else "UNREACHABLE"},
+            "timeOfSample": time_of_sample,
+            "uncertaintyInMilliseconds": 0
+        }
+    ]
+
+
+# Singleton instance
+state_view = StateView()
@@ -1,3 +1,478 @@
-from django.test import TestCase
+import datetime
+import threading
+import time
+from concurrent import futures
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import caches
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from oauth2_provider.models import AccessToken, Application, RefreshToken
+
+from apps.core.services.ha_client import ha_client
+from apps.core.services.ha_state_mirror import HAStateMirror
+from apps.devices.models import Device, DeviceTombstone
+from apps.devices.services import DeviceSyncEngine
+from apps.rooms.models import Room
+from apps.routines.models import NezuRoutine, RoutineAction
+from apps.routines.plans import routine_plans
+from apps.users.authentication import token_cache
+from apps.users.models import User
+from .deferred import AlexaEventOutbox, outbox
+from .models import AlexaEvent
+from .services import handle_directive
+from .state import alexa_timestamp, state_view
+
+DISCOVER = {'directive': {'header': {'namespace': 'Alexa.Discovery', 'name': 'Discover', 'messageId': '1'}}}
+
+
+class DiscoveryTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        user = User.objects.create_user(username='owner', password='x')
+        self.rooms = [Room.objects.create(name=f'Cuarto {i}', user=user) for i in range(10)]
+        Room.objects.create(name='Vacio', user=user)
+        for i in range(30):
+            Device.objects.create(name=f'Luz {i}', type='light' if i % 2 else 'lock', entity_id=f'light.luz_{i}',
+                                  room_obj=self.rooms[i % len(self.rooms)])
+        NezuRoutine.objects.create(name='Buenas noches')
+
+    def discover(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return {endpoint['endpointId']: endpoint
+                    for endpoint in handle_directive(DISCOVER)['event']['payload']['endpoints']}
+
+    def test_discovery_is_one_query_per_entity_type(self):
+        with CaptureQueriesContext(connection) as queries:
+            endpoints = self.discover()
+
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(len(endpoints), 30 + 1 + 10)
+        room = endpoints[f'room_{self.rooms[0].id}']
+        self.assertEqual(room['description'], 'Room with 3 devices')
+        self.assertEqual(room['cookie'], {'room_id': str(self.rooms[0].id), 'type': 'room'})
+        device = Device.objects.get(entity_id='light.luz_1')
+        self.assertEqual(endpoints[str(device.id)]['displayCategories'], ['LIGHT'])
+        self.assertEqual(endpoints[str(device.id)]['description'], 'light in Cuarto 1')
+
+    def test_rediscovery_is_a_cache_hit(self):
+        self.discover()
+        with CaptureQueriesContext(connection) as queries:
+            endpoints = self.discover()
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(len(endpoints), 41)
+
+    def test_state_updates_keep_the_payload(self):
+        self.discover()
+        device = Device.objects.get(entity_id='light.luz_1')
+        with self.captureOnCommitCallbacks(execute=True):
+            device.is_on = True
+            device.save(update_fields=['is_on'])
+        with CaptureQueriesContext(connection) as queries:
+            self.discover()
+        self.assertEqual(len(queries), 0)
+
+    def test_edits_drop_the_payload(self):
+        self.discover()
+        device = Device.objects.get(entity_id='light.luz_1')
+        with self.captureOnCommitCallbacks(execute=True):
+            device.name = 'Lampara'
+            device.save(update_fields=['name'])
+        self.assertEqual(self.discover()[str(device.id)]['friendlyName'], 'Lampara')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            routine = NezuRoutine.objects.create(name='Cine')
+        self.assertIn(f'routine_{routine.id}', self.discover())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.rooms[0].delete()
+        endpoints = self.discover()
+        self.assertNotIn(f'room_{self.rooms[0].id}', endpoints)
+        self.assertEqual(len(endpoints), 30 + 2 + 9)
+
+        # Deleted through the API (announced by devices_changed)
+        device = Device.objects.get(entity_id='light.luz_3')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.delete(f'/api/devices/{device.id}/').status_code, 204)
+        self.assertNotIn(str(device.id), self.discover())
+
+        # Devices gone from HA: removed by the sync engine's bulk delete
+        with self.captureOnCommitCallbacks(execute=True):
+            DeviceSyncEngine().sync({})
+        self.assertEqual(len(self.discover()), 2)
+
+    def test_cascade_and_admin_deletes_drop_the_payload(self):
+        from django.contrib.admin.sites import site
+        guest = User.objects.create_user(username='guest', password='x')
+        Device.objects.filter(entity_id__in=['light.luz_1', 'light.luz_2']).update(user=guest)
+        self.assertEqual(len(self.discover()), 41)
+
+        # The user's devices are deleted with them
+        with self.captureOnCommitCallbacks(execute=True):
+            guest.delete()
+        self.assertEqual(len(self.discover()), 39)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            site._registry[Device].delete_queryset(None, Device.objects.filter(entity_id='light.luz_3'))
+        self.assertEqual(len(self.discover()), 38)
+        self.assertTrue(DeviceTombstone.objects.filter(entity_id='light.luz_3').exists())
+
+
+class ReportStateTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='owner', password='x')
+        self.room = Room.objects.create(name='Sala', user=user)
+        self.lamp = Device.objects.create(name='Lampara', type='light', entity_id='light.lampara',
+                                          room_obj=self.room, is_on=True)
+        self.tv = Device.objects.create(name='Tele', type='switch', entity_id='switch.tele',
+                                        room_obj=self.room, is_online=False)
+        self.mirror = HAStateMirror()
+        self.mirror.apply_snapshot([
+            {'entity_id': 'light.lampara', 'state': 'on', 'last_updated': '2026-03-01T20:15:30.123456+00:00'},
+            {'entity_id': 'switch.tele', 'state': 'unavailable', 'last_updated': '2026-03-01T18:00:00+00:00'},
+        ])
+        patcher = mock.patch.object(state_view, 'mirror', self.mirror)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # The hot path never talks to HA
+        self.ha_calls = []
+        for method in ('get_states', 'get_state', 'call_service'):
+            patcher = mock.patch.object(ha_client, method, side_effect=AssertionError('HA call'))
+            self.ha_calls.append(patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def report_state(self, endpoint_id, cookie=None):
+        response = handle_directive({'directive': {
+            'header': {'namespace': 'Alexa', 'name': 'ReportState', 'messageId': '1', 'correlationToken': 'c'},
+            'endpoint': {'endpointId': endpoint_id, 'cookie': cookie or {}, 'scope': {'token': 't'}},
+            'payload': {},
+        }})
+        properties = {prop['namespace']: prop for prop in response.get('context', {}).get('properties', [])}
+        return response, properties
+
+    def test_device_state_comes_from_the_local_view(self):
+        with self.assertNumQueries(1):
+            response, properties = self.report_state(str(self.lamp.id), {'entity_id': 'light.lampara'})
+
+        self.assertEqual(response['event']['header']['name'], 'StateReport')
+        self.assertEqual(response['event']['header']['correlationToken'], 'c')
+        self.assertEqual(properties['Alexa.PowerController']['value'], 'ON')
+        self.assertEqual(properties['Alexa.PowerController']['timeOfSample'], '2026-03-01T20:15:30.123Z')
+        self.assertEqual(properties['Alexa.EndpointHealth']['value'], {'value': 'OK'})
+
+        _, properties = self.report_state(str(self.tv.id))
+        self.assertEqual(properties['Alexa.PowerController']['value'], 'OFF')
+        self.assertEqual(properties['Alexa.EndpointHealth']['value'], {'value': 'UNREACHABLE'})
+
+    def test_user_commands_newer_than_ha_set_the_sample_time(self):
+        commanded_at = timezone.now()
+        Device.objects.filter(id=self.tv.id).update(is_on=True, last_user_command=commanded_at)
+        _, properties = self.report_state(str(self.tv.id))
+        self.assertEqual(properties['Alexa.PowerController']['value'], 'ON')
+        self.assertEqual(properties['Alexa.PowerController']['timeOfSample'],
+                         alexa_timestamp(commanded_at))
+
+    def test_room_state_is_aggregated(self):
+        with self.assertNumQueries(1):
+            _, properties = self.report_state(f'room_{self.room.id}', {'room_id': str(self.room.id), 'type': 'room'})
+        self.assertEqual(properties['Alexa.PowerController']['value'], 'ON')
+        self.assertEqual(properties['Alexa.PowerController']['timeOfSample'], '2026-03-01T20:15:30.123Z')
+        self.assertEqual(properties['Alexa.EndpointHealth']['value'], {'value': 'OK'})
+
+        Device.objects.filter(room_obj=self.room).update(is_on=False, is_online=False)
+        _, properties = self.report_state(f'room_{self.room.id}')
+        self.assertEqual(properties['Alexa.PowerController']['value'], 'OFF')
+        self.assertEqual(properties['Alexa.EndpointHealth']['value'], {'value': 'UNREACHABLE'})
+
+    def test_unknown_endpoints(self):
+        for endpoint_id in ('999', 'room_999', 'nonsense'):
+            response, _ = self.report_state(endpoint_id)
+            self.assertEqual(response['event']['payload']['type'], 'NO_SUCH_ENDPOINT')
+
+    def test_answers_in_one_query_without_ha(self):
+        # Latency is measured by `manage.py benchmark_alexa`
+        for endpoint_id in (str(self.lamp.id), f'room_{self.room.id}', str(self.tv.id)):
+            with self.assertNumQueries(1):
+                response, _ = self.report_state(endpoint_id)
+            self.assertEqual(response['event']['header']['name'], 'StateReport')
+        for method in self.ha_calls:
+            method.assert_not_called()
+
+
+def ha_ok(calls, **kwargs):
+    return [([], 0.01)] * len(calls)
+
+
+def ha_down(calls, **kwargs):
+    return [(ConnectionError('HA down'), 0.01)] * len(calls)
+
+
+class FakeEventGateway:
+    """Stands in for the Alexa event gateway: keeps what it is sent"""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.events = []
+
+    def __call__(self, event):
+        if self.fail:
+            raise ConnectionError('gateway down')
+        self.events.append(event)
+
+
+# Deferred runs write the outbox from the runtime's worker threads, so the
+# test transaction can't be used; the main thread keeps off the database
+# while a worker writes (SQLite's shared cache locks per table)
+@override_settings(ALEXA_RESPONSE_BUDGET=0.2, ALEXA_STAGE_LATENCY_ESTIMATE=0.01, ROUTINE_RUN_HISTORY=False)
+class DeferredRoutineTests(TransactionTestCase):
+    def setUp(self):
+        caches['default'].clear()
+        routine_plans.clear()
+        self.stored = threading.Event()
+        put = outbox.put
+
+        def put_and_signal(event):
+            put(event)
+            self.stored.set()
+        patcher = mock.patch.object(outbox, 'put', side_effect=put_and_signal)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        user = User.objects.create_user(username='owner', password='x')
+        app = Application.objects.create(name='Alexa', client_id='alexa', user=user,
+                                         client_type=Application.CLIENT_CONFIDENTIAL,
+                                         authorization_grant_type=Application.GRANT_AUTHORIZATION_CODE)
+        Application.objects.filter(pk=app.pk).update(client_secret='secret')
+        self.token = AccessToken.objects.create(user=user, application=app, token='t', scope='read',
+                                                expires=timezone.now() + datetime.timedelta(hours=1))
+        RefreshToken.objects.create(user=user, application=app, token='refresh', access_token=self.token)
+
+        self.short = NezuRoutine.objects.create(name='Luces')
+        RoutineAction.objects.create(routine=self.short, device_id='light.sala', action_type='turn_on', order=0)
+        RoutineAction.objects.create(routine=self.short, device_id='light.cocina', action_type='turn_on', order=0)
+        self.long = NezuRoutine.objects.create(name='Despertar')
+        RoutineAction.objects.create(routine=self.long, device_id='light.sala', action_type='turn_on', order=0)
+        RoutineAction.objects.create(routine=self.long, action_type='delay', value=1, order=1)
+        RoutineAction.objects.create(routine=self.long, device_id='switch.cafetera', action_type='turn_on', order=2)
+
+    def directive(self, namespace, name, routine):
+        return handle_directive({'directive': {
+            'header': {'namespace': namespace, 'name': name, 'messageId': 'm', 'correlationToken': 'c'},
+            'endpoint': {'endpointId': f'routine_{routine.id}', 'cookie': {'routine_id': str(routine.id)},
+                         'scope': {'type': 'BearerToken', 'token': 't'}},
+            'payload': {},
+        }})
+
+    def activate(self, routine):
+        return self.directive('Alexa.SceneController', 'Activate', routine)
+
+    def wait_for_event(self):
+        self.assertTrue(self.stored.wait(5), 'no event reached the outbox')
+
+    @mock.patch('apps.routines.runtime.dispatch_service_calls_timed', side_effect=ha_ok)
+    def test_routines_within_the_budget_are_answered_directly(self, dispatch):
+        response = self.activate(self.short)
+        self.assertEqual(response['event']['header']['name'], 'ActivationStarted')
+        self.assertEqual(dispatch.call_count, 1)
+        self.assertEqual(AlexaEvent.objects.count(), 0)
+
+    @mock.patch('apps.routines.runtime.dispatch_service_calls_timed', side_effect=ha_down)
+    def test_failures_within_the_budget_are_reported(self, dispatch):
+        response = self.activate(self.short)
+        self.assertEqual(response['event']['header']['name'], 'ErrorResponse')
+        self.assertEqual(response['event']['payload']['type'], 'ENDPOINT_UNREACHABLE')
+
+    @mock.patch('apps.routines.runtime.dispatch_service_calls_timed', side_effect=ha_ok)
+    def test_long_routines_are_deferred_to_the_outbox(self, dispatch):
+        started = time.monotonic()
+        response = self.activate(self.long)
+        self.assertLess(time.monotonic() - started, 0.2)
+
+        self.assertEqual(response['event']['header']['name'], 'DeferredResponse')
+        self.assertEqual(response['event']['header']['correlationToken'], 'c')
+        self.assertEqual(response['event']['payload'], {'estimatedDeferralInSeconds': 2})
+
+        self.wait_for_event()
+        # The user's token is not stored with the event, only a reference to it
+        stored = AlexaEvent.objects.get()
+        self.assertEqual(stored.payload['event']['endpoint']['scope'], {'type': 'BearerToken'})
+        self.assertEqual(stored.access_token_id, self.token.id)
+
+        gateway = FakeEventGateway()
+        self.assertEqual(outbox.drain(gateway), 1)
+        self.assertEqual(dispatch.call_count, 2)
+        event = gateway.events[0]['event']
+        self.assertEqual(event['header']['name'], 'ActivationStarted')
+        self.assertEqual(event['header']['correlationToken'], 'c')
+        self.assertEqual(event['endpoint']['scope']['token'], 't')
+        # Sent events are not sent again
+        self.assertEqual(outbox.drain(gateway), 0)
+
+    @mock.patch('apps.routines.runtime.dispatch_service_calls_timed', side_effect=ha_ok)
+    def test_events_of_deleted_tokens_are_not_sent(self, dispatch):
+        self.activate(self.long)
+        self.wait_for_event()
+        self.token.delete()
+        gateway = FakeEventGateway()
+        self.assertEqual(outbox.drain(gateway), 0)
+        self.assertEqual(gateway.events, [])
+        self.assertEqual(AlexaEvent.objects.get().attempts, 1)
+
+    @mock.patch('apps.routines.runtime.dispatch_service_calls_timed', side_effect=ha_ok)
+    def test_events_outlive_a_token_refresh(self, dispatch):
+        self.activate(self.long)
+        self.wait_for_event()
+        response = self.client.post('/o/token/', {'grant_type': 'refresh_token', 'refresh_token': 'refresh',
+                                                  'client_id': 'alexa', 'client_secret': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(AccessToken.objects.filter(token='t').exists())
+
+        gateway = FakeEventGateway()
+        self.assertEqual(outbox.drain(gateway), 1)
+        self.assertEqual(gateway.events[0]['event']['endpoint']['scope']['token'], response.json()['access_token'])
+
+    def test_old_events_are_pruned(self):
+        now = timezone.now()
+        old = now - datetime.timedelta(hours=25)
+        for sent_at in (None, now, old):
+            event = AlexaEvent.objects.create(namespace='Alexa', name='Response', payload={}, sent_at=sent_at)
+            AlexaEvent.objects.filter(id=event.id).update(created_at=old)
+        recent = AlexaEvent.objects.create(namespace='Alexa', name='Response', payload={})
+
+        self.assertEqual(AlexaEventOutbox(retention_hours=24).prune(), 2)
+        self.assertEqual(AlexaEvent.objects.filter(sent_at=now).count(), 1)
+        self.assertTrue(AlexaEvent.objects.filter(id=recent.id).exists())
+
+    @mock.patch('apps.routines.runtime.dispatch_service_calls_timed', side_effect=ha_ok)
+    def test_power_controller_routines_are_deferred_too(self, dispatch):
+        response = self.directive('Alexa.PowerController', 'TurnOn', self.long)
+        self.assertEqual(response['event']['header']['name'], 'DeferredResponse')
+        self.wait_for_event()
+        self.assertEqual(AlexaEvent.objects.get().name, 'Response')
+
+    @mock.patch('apps.routines.runtime.dispatch_service_calls_timed')
+    def test_failed_deferred_runs_send_an_error_event(self, dispatch):
+        # The stage after the delay fails
+        dispatch.side_effect = [ha_ok([None]), ha_down([None])]
+        self.assertEqual(self.activate(self.long)['event']['header']['name'], 'DeferredResponse')
+        self.wait_for_event()
+        gateway = FakeEventGateway(fail=True)
+        self.assertEqual(outbox.drain(gateway), 0)
+        event = AlexaEvent.objects.get()
+        self.assertEqual((event.name, event.attempts, event.sent_at), ('ErrorResponse', 1, None))
+        self.assertEqual(event.payload['event']['endpoint']['endpointId'], f'routine_{self.long.id}')
+
+        gateway.fail = False
+        self.assertEqual(outbox.drain(gateway), 1)
+        self.assertEqual(gateway.events[0]['event']['payload']['type'], 'ENDPOINT_UNREACHABLE')
+
+
+class RoomPowerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', password='x')
+
+    def create_room(self, name, size):
+        room = Room.objects.create(name=name, user=self.user)
+        Device.objects.bulk_create([
+            Device(name=f'{name} {i}', type='light', entity_id=f'light.{name}_{i}', ha_domain='light', room_obj=room)
+            for i in range(size)
+        ])
+        return room
+
+    def turn_on(self, room_id):
+        return handle_directive({'directive': {
+            'header': {'namespace': 'Alexa.PowerController', 'name': 'TurnOn', 'messageId': 'm', 'correlationToken': 'c'},
+            'endpoint': {'endpointId': f'room_{room_id}', 'cookie': {'room_id': str(room_id), 'type': 'room'}},
+            'payload': {},
+        }})
+
+    def test_query_count_does_not_grow_with_room_size(self):
+        small, large = self.create_room('small', 3), self.create_room('large', 60)
+        queries = {}
+        ha_ok_calls = lambda calls, **kwargs: [[]] * len(calls)  # noqa: E731
+        with mock.patch('apps.devices.services.dispatch_service_calls', side_effect=ha_ok_calls) as dispatch:
+            for room in (small, large):
+                with CaptureQueriesContext(connection) as captured:
+                    response = self.turn_on(room.id)
+                self.assertEqual(response['context']['properties'][0]['value'], 'ON')
+                queries[room.name] = len(captured)
+
+        self.assertEqual(queries['small'], queries['large'])
+        # One dispatch per room, carrying every device
+        self.assertEqual([len(call.args[0]) for call in dispatch.call_args_list], [3, 60])
+        self.assertFalse(Device.objects.filter(is_on=False).exists())
+
+    def test_answers_within_the_budget_when_ha_is_slow(self):
+        # Timings against a slow HA are measured by `manage.py benchmark_alexa`
+        room = self.create_room('sala', 40)
+        with override_settings(ALEXA_ROOM_POWER_BUDGET=0.2), \
+                mock.patch('apps.core.services.ha_dispatcher.call_services_concurrently',
+                           side_effect=futures.TimeoutError) as call_services:
+            response = self.turn_on(room.id)
+        self.assertEqual(response['event']['header']['name'], 'Response')
+        self.assertEqual(Device.objects.filter(room_obj=room, is_on=True).count(), 40)
+        # Grouped: one light.turn_on request for the whole room, waited on for the budget only
+        (calls, limit, timeout), _ = call_services.call_args
+        self.assertEqual(call_services.call_count, 1)
+        self.assertEqual([(domain, service) for domain, service, _ in calls], [('light', 'turn_on')])
+        self.assertEqual(len(calls[0][2]['entity_id']), 40)
+        self.assertEqual(timeout, 0.2)
+
+    def test_unknown_room(self):
+        response = self.turn_on(999)
+        self.assertEqual(response['event']['payload']['type'], 'NO_SUCH_ENDPOINT')
+
+
+class AlexaAuthenticationTests(TestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.user = User.objects.create_user(username='owner', password='x')
+        self.app = Application.objects.create(
+            name='Alexa', client_id='alexa', user=self.user, client_type=Application.CLIENT_CONFIDENTIAL,
+            authorization_grant_type=Application.GRANT_AUTHORIZATION_CODE)
+        # The token view compares the secret as stored in plain text
+        Application.objects.filter(pk=self.app.pk).update(client_secret='secret')
+        self.token = AccessToken.objects.create(user=self.user, application=self.app, token='access-1', scope='read',
+                                                expires=timezone.now() + datetime.timedelta(hours=1))
+        RefreshToken.objects.create(user=self.user, application=self.app, token='refresh-1', access_token=self.token)
+
+    def report_state(self, token):
+        directive = {'directive': {
+            'header': {'namespace': 'Alexa', 'name': 'ReportState', 'messageId': 'm', 'correlationToken': 'c'},
+            'endpoint': {'endpointId': '999', 'scope': {'type': 'BearerToken', 'token': token}},
+            'payload': {},
+        }}
+        return self.client.post('/api/alexa/endpoint/', directive, content_type='application/json',
+                                HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def test_known_tokens_authenticate_without_a_query(self):
+        with CaptureQueriesContext(connection) as first:
+            self.assertEqual(self.report_state('access-1').status_code, 200)
+        with CaptureQueriesContext(connection) as cached:
+            self.assertEqual(self.report_state('access-1').status_code, 200)
+        self.assertEqual(len(cached), len(first) - 1)
+        self.assertFalse(any('oauth2_provider_accesstoken' in query['sql'] for query in cached))
+
+    def test_expiry_is_respected_exactly(self):
+        self.assertEqual(self.report_state('access-1').status_code, 200)
+        with mock.patch('django.utils.timezone.now', return_value=self.token.expires + datetime.timedelta(microseconds=1)):
+            self.assertEqual(self.report_state('access-1').status_code, 403)
+        self.assertEqual(len(token_cache), 0)
+
+    def test_deleted_tokens_stop_authenticating(self):
+        self.assertEqual(self.report_state('access-1').status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.token.delete()
+        self.assertEqual(self.report_state('access-1').status_code, 403)
+
+    def test_refresh_rotation_revokes_the_cached_access_token(self):
+        self.assertEqual(self.report_state('access-1').status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/o/token/', {'grant_type': 'refresh_token', 'refresh_token': 'refresh-1',
+                                                      'client_id': 'alexa', 'client_secret': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.report_state('access-1').status_code, 403)
+        self.assertEqual(self.report_state(response.json()['access_token']).status_code, 200)
+        self.assertIsNotNone(RefreshToken.objects.get(token='refresh-1').revoked)
@@ -131,9 +131,9 @@ class AlexaTokenView(View):
                     scope=scope
                 )
                 
-                # Rotate Refresh Token
-                rt.revoked = timezone.now()
-                rt.save()
+                # Rotate Refresh Token, revoking the access token it came with
+                # (which also drops it from the authentication cache)
+                rt.revoke()
                 
                 new_refresh_token = secrets.token_urlsafe(30)
                 RefreshToken.objects.create(
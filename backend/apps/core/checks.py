@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.checks import Warning, register
+
+# Backends that keep their data inside one process
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register(deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """
+    HA state snapshots, routine run progress, the Alexa discovery payload and
+    the device reconciler's lease are shared between workers through the
+    cache; a process-local backend only works with a single worker.
+    """
+    aliases = {
+        getattr(settings, 'HOMEASSISTANT_STATE_CACHE_ALIAS', 'default'),
+        getattr(settings, 'ROUTINE_RUN_CACHE_ALIAS', 'default'),
+        getattr(settings, 'ALEXA_DISCOVERY_CACHE_ALIAS', 'default'),
+    }
+    errors = []
+    for alias in sorted(aliases):
+        backend = f'{type(caches[alias]).__module__}.{type(caches[alias]).__name__}'
+        if backend in PROCESS_LOCAL_CACHES:
+            errors.append(Warning(
+                f"CACHES['{alias}'] ({backend}) is not shared between processes",
+                hint="Run a single worker, or set CACHE_URL to a shared cache (e.g. dbcache://nezu_cache "
+                     "after `manage.py createcachetable`).",
+                id='core.W001',
+            ))
+    return errors
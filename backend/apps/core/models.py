@@ -0,0 +1,74 @@
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+
+
+class ChangeCounter(models.Model):
+    """
+    Named, monotonically increasing counters (one row per table or feed).
+
+    Writers bump a counter in the same transaction as the rows they change;
+    the UPDATE locks the counter row until commit, so versions become visible
+    in order and a reader that takes the current value first never misses a
+    row committed later with a lower version. Counters that only feed ETags
+    are bumped after commit instead (next_on_commit), once per transaction.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+    @classmethod
+    def next(cls, name, count=1):
+        """
+        Reserve `count` versions and return the highest one.
+        Call inside the transaction that writes the versioned rows.
+        """
+        with transaction.atomic(savepoint=False):
+            if not cls.objects.filter(name=name).update(value=F('value') + count):
+                cls.objects.get_or_create(name=name)
+                cls.objects.filter(name=name).update(value=F('value') + count)
+            return cls.objects.values_list('value', flat=True).get(name=name)
+
+    @classmethod
+    def next_on_commit(cls, name):
+        """
+        Bump counter `name` once the current transaction commits (right away
+        outside one). Several bumps in one transaction cost one UPDATE: only
+        the last callback queued for the name runs it, and the counter row is
+        not locked for the rest of the transaction.
+        """
+        connection = transaction.get_connection()
+
+        def bump():
+            pending = connection.run_on_commit
+            # Run hooks are popped before they're called; captured ones (tests) stay listed
+            mine = next((i for i, entry in enumerate(pending) if entry[1] is bump), -1)
+            if any(getattr(entry[1], 'change_counter', None) == name for entry in pending[mine + 1:]):
+                return
+            if not cls.objects.filter(name=name).update(value=F('value') + 1):
+                cls.next(name)
+
+        bump.change_counter = name
+        transaction.on_commit(bump)
+
+    @classmethod
+    def current(cls, name):
+        return cls.objects.filter(name=name).values_list('value', flat=True).first() or 0
+
+    @classmethod
+    def values(cls, names):
+        """Current value of several counters in one query ({name: value}, 0 if never bumped)"""
+        found = dict(cls.objects.filter(name__in=names).values_list('name', 'value'))
+        return {name: found.get(name, 0) for name in names}
+
+    @classmethod
+    def track(cls, model, name):
+        """Bump counter `name` after commit whenever a `model` row is saved or deleted"""
+        def bump(sender, **kwargs):
+            cls.next_on_commit(name)
+
+        dispatch_uid = f'change_counter_{name}_{model._meta.label_lower}'
+        post_save.connect(bump, sender=model, weak=False, dispatch_uid=dispatch_uid)
+        post_delete.connect(bump, sender=model, weak=False, dispatch_uid=dispatch_uid)
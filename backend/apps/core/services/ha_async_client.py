@@ -0,0 +1,162 @@
+import asyncio
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import httpx
+from django.conf import settings
+
+# (domain, service, service_data)
+ServiceCall = Tuple[str, str, Optional[Dict[str, Any]]]
+
+
+class AsyncHomeAssistantClient:
+    """
+    asyncio counterpart of HomeAssistantClient for fan-out work.
+
+    Exposes the same surface (get_states, call_service, render_template) plus
+    call_services_concurrently, which overlaps many service calls so N
+    commands cost roughly one round-trip instead of N. The underlying
+    httpx.AsyncClient is bound to the event loop it was created on.
+    """
+
+    def __init__(self, base_url: str = None, token: str = None, concurrency: int = None, timeout: float = None):
+        self.base_url = (base_url or getattr(settings, 'HOMEASSISTANT_URL', 'http://homeassistant.local:8123')).rstrip('/')
+        self.token = token if token is not None else getattr(settings, 'HOMEASSISTANT_TOKEN', '')
+        self.headers = {
+            "Authorization": f"Bearer {self.token}",
+            "Content-Type": "application/json",
+        }
+        self.concurrency = concurrency or getattr(settings, 'HOMEASSISTANT_MAX_CONCURRENCY', 10)
+        self.timeout = timeout or 5
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            self._client = httpx.AsyncClient(
+                base_url=f"{self.base_url}/api/",
+                headers=self.headers,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+            )
+            self._client_loop = loop
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _get(self, endpoint: str) -> httpx.Response:
+        try:
+            response = await self.client.get(endpoint)
+            response.raise_for_status()
+            return response
+        except httpx.HTTPError as e:
+            print(f"Error connecting to HA: {e}")
+            raise
+
+    async def _post(self, endpoint: str, data: Dict[str, Any] = None) -> httpx.Response:
+        try:
+            response = await self.client.post(endpoint, json=data or {})
+            response.raise_for_status()
+            return response
+        except httpx.HTTPError as e:
+            print(f"Error posting to HA: {e}")
+            raise
+
+    async def get_states(self) -> List[Dict[str, Any]]:
+        """Get all states from HA"""
+        response = await self._get("states")
+        return response.json()
+
+    async def get_state(self, entity_id: str) -> Dict[str, Any]:
+        """Get state of a specific entity"""
+        response = await self._get(f"states/{entity_id}")
+        return response.json()
+
+    async def call_service(self, domain: str, service: str, service_data: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        """Call a service in HA (e.g. turn_on light)"""
+        response = await self._post(f"services/{domain}/{service}", service_data)
+        return response.json()
+
+    async def render_template(self, template: str) -> str:
+        """Render a Jinja2 template in HA"""
+        response = await self._post("template", {"template": template})
+        return response.text
+
+    async def call_services_concurrently(self, calls: Iterable[ServiceCall], limit: int = None,
+                                         call_timeout: float = None) -> List[Any]:
+        """
+        Run many service calls with at most `limit` in flight.
+        Returns one entry per call, in order: the HA response or the
+        exception raised by that call (one failure does not cancel the rest).
+        """
+        return [result for result, _ in await self.call_services_timed(calls, limit, call_timeout)]
+
+    async def call_services_timed(self, calls: Iterable[ServiceCall], limit: int = None,
+                                  call_timeout: float = None) -> List[Tuple[Any, float]]:
+        """
+        call_services_concurrently, with each call's elapsed seconds:
+        [(response or exception, seconds)]. A call running longer than
+        `call_timeout` seconds is abandoned with a TimeoutError.
+        """
+        semaphore = asyncio.Semaphore(limit or self.concurrency)
+        loop = asyncio.get_running_loop()
+
+        async def run(domain, service, service_data):
+            async with semaphore:
+                started = loop.time()
+                try:
+                    result = await asyncio.wait_for(self.call_service(domain, service, service_data), call_timeout)
+                except asyncio.TimeoutError:
+                    result = TimeoutError(f"{domain}.{service} timed out after {call_timeout}s")
+                except Exception as e:
+                    result = e
+                return result, loop.time() - started
+
+        return await asyncio.gather(*(run(domain, service, service_data) for domain, service, service_data in calls))
+
+
+class EventLoopThread:
+    """
+    A background event loop that sync code (Django views) can submit
+    coroutines to. Keeping one loop per process lets the async client reuse
+    its connections across requests.
+    """
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name='ha-async-loop', daemon=True).start()
+                    self._loop = loop
+        return self._loop
+
+    def run(self, coro, timeout: float = None):
+        """Run a coroutine on the background loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop()).result(timeout)
+
+
+# Singleton instances
+async_ha_client = AsyncHomeAssistantClient()
+event_loop_thread = EventLoopThread()
+
+
+def call_services_concurrently(calls: Iterable[ServiceCall], limit: int = None, timeout: float = None) -> List[Any]:
+    """Sync bridge to AsyncHomeAssistantClient.call_services_concurrently for Django views"""
+    return event_loop_thread.run(async_ha_client.call_services_concurrently(list(calls), limit), timeout)
+
+
+def call_services_timed(calls: Iterable[ServiceCall], limit: int = None, timeout: float = None,
+                        call_timeout: float = None) -> List[Tuple[Any, float]]:
+    """Sync bridge to AsyncHomeAssistantClient.call_services_timed"""
+    return event_loop_thread.run(async_ha_client.call_services_timed(list(calls), limit, call_timeout), timeout)
@@ -1,32 +1,113 @@
+import random
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from django.conf import settings
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple, Union
+
+Timeout = Union[float, Tuple[float, float]]
+
+# (connect, read) timeouts by endpoint prefix; the longest matching prefix wins.
+# Full state and registry downloads can be large on busy installations.
+DEFAULT_TIMEOUTS = {
+    '': (3.05, 5),
+    'states': (3.05, 15),
+    'config/entity_registry/list': (3.05, 15),
+    'template': (3.05, 10),
+}
+
+# Status codes worth retrying for idempotent requests
+RETRY_STATUSES = {502, 503, 504}
+
 
 class HomeAssistantClient:
-    def __init__(self):
-        self.base_url = getattr(settings, 'HOMEASSISTANT_URL', 'http://homeassistant.local:8123').rstrip('/')
-        self.token = getattr(settings, 'HOMEASSISTANT_TOKEN', '')
+    """
+    HTTP client for the Home Assistant REST API.
+
+    Requests go through one shared, pooled requests.Session so connections to
+    HA are kept alive and reused. The session is only configured once and
+    carries no per-request state, so it is safe to share between gunicorn
+    threads. GETs are retried with jittered exponential backoff; POSTs are
+    never retried because service calls are not idempotent.
+    """
+
+    def __init__(self, base_url: str = None, token: str = None, pool_size: int = None,
+                 retries: int = None, backoff: float = None, timeouts: Dict[str, Timeout] = None):
+        self.base_url = (base_url or getattr(settings, 'HOMEASSISTANT_URL', 'http://homeassistant.local:8123')).rstrip('/')
+        self.token = token if token is not None else getattr(settings, 'HOMEASSISTANT_TOKEN', '')
         self.headers = {
             "Authorization": f"Bearer {self.token}",
             "Content-Type": "application/json",
         }
+        self.pool_size = pool_size or getattr(settings, 'HOMEASSISTANT_POOL_SIZE', 10)
+        self.retries = retries if retries is not None else getattr(settings, 'HOMEASSISTANT_GET_RETRIES', 2)
+        self.backoff = backoff if backoff is not None else getattr(settings, 'HOMEASSISTANT_RETRY_BACKOFF', 0.2)
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        self.timeouts.update(timeouts or getattr(settings, 'HOMEASSISTANT_TIMEOUTS', {}))
+
+        self._session: Optional[requests.Session] = None
+        self._session_lock = threading.Lock()
+        self._registry = None
+
+    @property
+    def session(self) -> requests.Session:
+        """Lazily create the pooled session (once per process)"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    # pool_block: threads wait for a free connection instead of
+                    # opening throwaway ones, so HA never sees more than pool_size
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True, max_retries=0)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    session.headers.update(self.headers)
+                    self._session = session
+        return self._session
+
+    def close(self):
+        """Close pooled connections (a new session is created on next use)"""
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def _timeout_for(self, endpoint: str) -> Timeout:
+        prefix = max((key for key in self.timeouts if endpoint.startswith(key)), key=len)
+        return self.timeouts[prefix]
+
+    def _backoff_delay(self, attempt: int) -> float:
+        # Full jitter: spread retries from concurrent workers apart
+        return random.uniform(0, self.backoff * (2 ** attempt))
 
     def _get(self, endpoint: str) -> requests.Response:
-        """Helper for GET requests"""
+        """Helper for GET requests, retried on connection errors and 502/503/504"""
         url = f"{self.base_url}/api/{endpoint}"
-        try:
-            response = requests.get(url, headers=self.headers, timeout=5)
-            response.raise_for_status()
-            return response
-        except requests.RequestException as e:
-            print(f"Error connecting to HA: {e}")
-            raise
+        timeout = self._timeout_for(endpoint)
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.get(url, timeout=timeout)
+                if response.status_code in RETRY_STATUSES and attempt < self.retries:
+                    time.sleep(self._backoff_delay(attempt))
+                    continue
+                response.raise_for_status()
+                return response
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt < self.retries:
+                    time.sleep(self._backoff_delay(attempt))
+                    continue
+                print(f"Error connecting to HA: {e}")
+                raise
+            except requests.RequestException as e:
+                print(f"Error connecting to HA: {e}")
+                raise
 
     def _post(self, endpoint: str, data: Dict[str, Any] = None) -> requests.Response:
         """Helper for POST requests"""
         url = f"{self.base_url}/api/{endpoint}"
         try:
-            response = requests.post(url, headers=self.headers, json=data or {}, timeout=5)
+            response = self.session.post(url, json=data or {}, timeout=self._timeout_for(endpoint))
             response.raise_for_status()
             return response
         except requests.RequestException as e:
@@ -102,22 +183,28 @@ class HomeAssistantClient:
                 print(f"Failed to get areas from states: {e2}")
                 return []
     
+    def list_entity_registry(self) -> List[Dict[str, Any]]:
+        """Download the full entity registry (prefer the cached `registry` lookups)"""
+        response = self._get("config/entity_registry/list")
+        return response.json()
+
+    @property
+    def registry(self):
+        """Cached entity registry index shared by all threads"""
+        if self._registry is None:
+            from .ha_registry import EntityRegistryCache
+            with self._session_lock:
+                if self._registry is None:
+                    self._registry = EntityRegistryCache(self)
+        return self._registry
+
     def get_entities_in_area(self, area_id: str) -> List[str]:
         """
         Get all entity IDs in a specific area.
         Returns list of entity_ids.
         """
         try:
-            # Get all entities
-            response = self._get("config/entity_registry/list")
-            entities = response.json()
-            
-            # Filter by area_id
-            return [
-                entity['entity_id'] 
-                for entity in entities 
-                if entity.get('area_id') == area_id
-            ]
+            return self.registry.get_entities_in_area(area_id)
         except Exception as e:
             print(f"Error getting entities in area {area_id}: {e}")
             return []
@@ -128,14 +215,7 @@ class HomeAssistantClient:
         Different from get_state which only returns current state.
         """
         try:
-            response = self._get("config/entity_registry/list")
-            entities = response.json()
-            
-            for entity in entities:
-                if entity.get('entity_id') == entity_id:
-                    return entity
-            
-            return {}
+            return self.registry.get_entity(entity_id)
         except Exception as e:
             print(f"Error getting entity {entity_id}: {e}")
             return {}
@@ -154,6 +234,8 @@ class HomeAssistantClient:
             })
             if response.status_code in [200, 201]:
                 print(f"Permanently updated registry name for {entity_id} to {new_name}")
+                if self._registry is not None:
+                    self._registry.invalidate()
                 return True
         except Exception as e:
             print(f"Registry update failed, falling back to state update: {e}")
@@ -0,0 +1,91 @@
+import json
+from typing import Any, Dict, Iterable, List, Tuple
+
+from .ha_async_client import ServiceCall, call_services_concurrently, call_services_timed
+
+
+def _entity_ids(service_data: Dict[str, Any]) -> List[str]:
+    entity_id = service_data.get('entity_id')
+    if entity_id is None:
+        return []
+    if isinstance(entity_id, str):
+        return [entity_id]
+    return list(entity_id)
+
+
+def group_service_calls(calls: Iterable[ServiceCall]) -> List[Tuple[ServiceCall, List[int]]]:
+    """
+    Merge calls that only differ by target entity into one multi-entity call.
+
+    HA accepts a list for `entity_id`, so e.g. 40 light.turn_on calls with
+    the same extra data become a single request. Returns
+    (merged_call, indexes of the original calls it covers), in the order
+    each group first appears.
+    """
+    groups: Dict[Tuple[str, str, str], Tuple[str, str, Dict[str, Any], List[str], List[int]]] = {}
+    for index, (domain, service, service_data) in enumerate(calls):
+        service_data = service_data or {}
+        extra = {key: value for key, value in service_data.items() if key != 'entity_id'}
+        if 'entity_id' not in service_data:
+            # Calls without a target cannot be merged safely
+            key = (domain, service, f'#{index}')
+        else:
+            key = (domain, service, json.dumps(extra, sort_keys=True, default=str))
+
+        if key not in groups:
+            groups[key] = (domain, service, extra, [], [])
+        _, _, _, entity_ids, indexes = groups[key]
+        for entity_id in _entity_ids(service_data):
+            if entity_id not in entity_ids:
+                entity_ids.append(entity_id)
+        indexes.append(index)
+
+    grouped = []
+    for domain, service, extra, entity_ids, indexes in groups.values():
+        service_data = dict(extra)
+        if entity_ids:
+            service_data['entity_id'] = entity_ids[0] if len(entity_ids) == 1 else entity_ids
+        grouped.append(((domain, service, service_data), indexes))
+    return grouped
+
+
+def dispatch_service_calls(calls: Iterable[ServiceCall], limit: int = None, timeout: float = None) -> List[Any]:
+    """
+    Send service calls as one HA request per (domain, service, data) group,
+    with the groups running concurrently.
+    Returns one entry per original call: its group's HA response, or the
+    exception that group raised.
+    """
+    calls = list(calls)
+    if not calls:
+        return []
+
+    grouped = group_service_calls(calls)
+    group_results = call_services_concurrently([call for call, _ in grouped], limit, timeout)
+
+    results: List[Any] = [None] * len(calls)
+    for (_, indexes), result in zip(grouped, group_results):
+        for index in indexes:
+            results[index] = result
+    return results
+
+
+def dispatch_service_calls_timed(calls: Iterable[ServiceCall], limit: int = None, timeout: float = None,
+                                 call_timeout: float = None) -> List[Tuple[Any, float]]:
+    """
+    dispatch_service_calls with timings: one (response or exception,
+    seconds) per original call, where the seconds are those of the grouped
+    HA request that carried it. `call_timeout` bounds each HA request.
+    """
+    calls = list(calls)
+    if not calls:
+        return []
+
+    grouped = group_service_calls(calls)
+    group_results = call_services_timed([call for call, _ in grouped], limit, timeout, call_timeout)
+
+    results: List[Tuple[Any, float]] = [(None, 0.0)] * len(calls)
+    for (_, indexes), result in zip(grouped, group_results):
+        for index in indexes:
+            results[index] = result
+    return results
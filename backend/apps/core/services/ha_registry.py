@@ -0,0 +1,67 @@
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+
+
+class EntityRegistryCache:
+    """
+    In-memory index of the HA entity registry.
+
+    The registry is downloaded once and indexed by entity_id and by area_id,
+    so per-entity and per-area lookups are dictionary reads instead of a full
+    registry download each. The index expires after `ttl` seconds and can be
+    dropped explicitly with invalidate() (e.g. on `entity_registry_updated`).
+    """
+
+    def __init__(self, client, ttl: float = None):
+        self.client = client
+        self.ttl = ttl if ttl is not None else getattr(settings, 'HOMEASSISTANT_REGISTRY_TTL', 300)
+
+        self._entities: Dict[str, Dict[str, Any]] = {}
+        self._areas: Dict[str, List[str]] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_fresh(self) -> bool:
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def invalidate(self):
+        """Drop the index; the next lookup downloads the registry again"""
+        self._loaded_at = None
+
+    def on_registry_updated(self, event: Dict[str, Any]):
+        """State mirror listener for `entity_registry_updated` events"""
+        self.invalidate()
+
+    def _ensure_loaded(self):
+        if self.is_fresh:
+            return
+        with self._lock:
+            # Another thread may have refreshed while we waited
+            if self.is_fresh:
+                return
+            entries = self.client.list_entity_registry()
+            entities = {}
+            areas: Dict[str, List[str]] = {}
+            for entry in entries:
+                entity_id = entry.get('entity_id')
+                if not entity_id:
+                    continue
+                entities[entity_id] = entry
+                if entry.get('area_id'):
+                    areas.setdefault(entry['area_id'], []).append(entity_id)
+            self._entities, self._areas = entities, areas
+            self._loaded_at = time.monotonic()
+
+    def get_entity(self, entity_id: str) -> Dict[str, Any]:
+        """Registry entry for an entity, or {} if unknown"""
+        self._ensure_loaded()
+        return self._entities.get(entity_id, {})
+
+    def get_entities_in_area(self, area_id: str) -> List[str]:
+        """Entity ids assigned to an area"""
+        self._ensure_loaded()
+        return list(self._areas.get(area_id, []))
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .ha_state_mirror import state_mirror
+
+
+class SharedStateCache:
+    """
+    HA `get_states()` snapshot shared by all gunicorn workers.
+
+    Reads are answered from this worker's state mirror once it is synced,
+    without touching the cache; the shared snapshot only stands in for the
+    REST download while the mirror is not ready. The snapshot lives in a Django cache (CACHES[HOMEASSISTANT_STATE_CACHE_ALIAS]:
+    the database cache on Render, locmem in development and tests, where it
+    is only shared between the threads of one process) together with
+    a version number and an etag. Once it is older than `refresh_interval`,
+    the first worker to win a `cache.add` lock refreshes it while everybody
+    else keeps serving the previous snapshot, so HA sees one download per
+    interval however many workers there are.
+    """
+
+    KEY_PREFIX = 'ha_states'
+
+    def __init__(self, alias: str = None, refresh_interval: float = None, lock_timeout: float = None,
+                 source: Callable[[], List[Dict[str, Any]]] = None, mirror=None):
+        self.alias = alias or getattr(settings, 'HOMEASSISTANT_STATE_CACHE_ALIAS', 'default')
+        self.refresh_interval = (refresh_interval if refresh_interval is not None
+                                 else getattr(settings, 'HOMEASSISTANT_STATE_CACHE_INTERVAL', 5))
+        self.lock_timeout = lock_timeout if lock_timeout is not None else 30
+        self.mirror = mirror or state_mirror
+        # Downloads over REST (and starts the mirror) while the mirror is not synced
+        self.source = source or self.mirror.get_states
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _key(self, name: str) -> str:
+        return f'{self.KEY_PREFIX}:{name}'
+
+    # Read API
+
+    def get_snapshot(self) -> Dict[str, Any]:
+        """
+        The current snapshot: {'version', 'etag', 'fetched_at', 'states'}.
+        Refreshes it first when stale and no other worker is already doing so.
+        """
+        snapshot = self.cache.get(self._key('snapshot'))
+        if snapshot and time.time() - snapshot['fetched_at'] < self.refresh_interval:
+            return snapshot
+
+        if self.cache.add(self._key('lock'), 1, self.lock_timeout):
+            try:
+                return self.refresh()
+            finally:
+                self.cache.delete(self._key('lock'))
+
+        if snapshot:
+            # Someone else is refreshing: the previous snapshot is good enough
+            return snapshot
+        return self._wait_for_snapshot()
+
+    def get_states(self) -> List[Dict[str, Any]]:
+        if self.mirror.is_ready:
+            return self.mirror.get_states()
+        return self.get_snapshot()['states']
+
+    def get_states_map(self) -> Dict[str, Dict[str, Any]]:
+        if self.mirror.is_ready:
+            return self.mirror.get_states_map()
+        return {state['entity_id']: state for state in self.get_snapshot()['states']}
+
+    def get_etag(self) -> Optional[str]:
+        """Etag of the cached snapshot, without refreshing it"""
+        snapshot = self.cache.get(self._key('snapshot'))
+        return snapshot['etag'] if snapshot else None
+
+    # Write API
+
+    def refresh(self) -> Dict[str, Any]:
+        """Fetch states from the source and publish them as a new snapshot"""
+        return self.publish(self.source())
+
+    def publish(self, states: List[Dict[str, Any]]) -> Dict[str, Any]:
+        payload = json.dumps(states, sort_keys=True, default=str).encode()
+        etag = hashlib.sha1(payload).hexdigest()
+
+        previous = self.cache.get(self._key('snapshot'))
+        if previous and previous['etag'] == etag:
+            version = previous['version']
+        else:
+            version = (previous['version'] if previous else 0) + 1
+
+        snapshot = {'version': version, 'etag': etag, 'fetched_at': time.time(), 'states': states}
+        # Keep stale snapshots around well past the refresh interval so other
+        # workers can serve them while one worker refreshes
+        self.cache.set(self._key('snapshot'), snapshot, timeout=max(self.refresh_interval * 12, 60))
+        return snapshot
+
+    def invalidate(self):
+        self.cache.delete(self._key('snapshot'))
+
+    def _wait_for_snapshot(self) -> Dict[str, Any]:
+        # Cold cache and another worker holds the lock: wait for its result
+        # rather than sending a second download to HA
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            snapshot = self.cache.get(self._key('snapshot'))
+            if snapshot:
+                return snapshot
+            if self.cache.get(self._key('lock')) is None:
+                break
+        return self.refresh()
+
+
+# Singleton instance
+state_cache = SharedStateCache()
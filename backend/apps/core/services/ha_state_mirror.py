@@ -0,0 +1,270 @@
+import json
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from django.conf import settings
+from websockets.sync.client import connect
+
+from .ha_client import ha_client
+
+
+class HAStateMirror:
+    """
+    Long-lived, in-process mirror of Home Assistant entity states.
+
+    Connects to the HA WebSocket API, subscribes to `state_changed` events and
+    seeds its table with a single `get_states` call. Every applied change bumps
+    a global version counter, so readers can tell cheaply whether anything
+    moved since they last looked.
+    """
+
+    def __init__(self, url: str = None, token: str = None, reconnect_delay: float = 5):
+        self._url = url
+        self._token = token
+        self.reconnect_delay = reconnect_delay
+
+        self._states: Dict[str, Dict[str, Any]] = {}
+        self._entity_versions: Dict[str, int] = {}
+        self._version = 0
+        self._lock = threading.Lock()
+        self._listeners: List[Callable] = []
+        self._event_listeners: Dict[str, List[Callable]] = {}
+
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._message_id = 0
+
+    @property
+    def ws_url(self) -> str:
+        base_url = self._url or getattr(settings, 'HOMEASSISTANT_URL', 'http://homeassistant.local:8123')
+        base_url = base_url.rstrip('/')
+        if base_url.startswith('https://'):
+            base_url = 'wss://' + base_url[len('https://'):]
+        elif base_url.startswith('http://'):
+            base_url = 'ws://' + base_url[len('http://'):]
+        return f"{base_url}/api/websocket"
+
+    @property
+    def token(self) -> str:
+        return self._token if self._token is not None else getattr(settings, 'HOMEASSISTANT_TOKEN', '')
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
+
+    # Lifecycle
+
+    def start(self):
+        """Start the background connection thread (idempotent)"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='ha-state-mirror', daemon=True)
+        self._thread.start()
+
+    def ensure_started(self):
+        """Start the mirror unless disabled by HOMEASSISTANT_STATE_MIRROR_ENABLED"""
+        if getattr(settings, 'HOMEASSISTANT_STATE_MIRROR_ENABLED', True):
+            self.start()
+
+    def stop(self, timeout: float = 5):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        self._thread = None
+        self._ready.clear()
+
+    def wait_until_ready(self, timeout: float = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def add_listener(self, callback: Callable):
+        """
+        Register a callback(entity_id, old_state, new_state, version).
+        Called from the mirror thread for every applied change; new_state is
+        None when the entity was removed.
+        """
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback: Callable):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def add_event_listener(self, event_type: str, callback: Callable):
+        """
+        Register a callback(event) for another HA event type (e.g.
+        entity_registry_updated). The mirror subscribes to it on its next
+        (re)connection, so register before start().
+        """
+        self._event_listeners.setdefault(event_type, []).append(callback)
+
+    # Read API
+
+    def get_states(self) -> List[Dict[str, Any]]:
+        """
+        Get all states from memory.
+        Falls back to a REST download while the mirror is not synced yet.
+        """
+        if not self.is_ready:
+            self.ensure_started()
+            return ha_client.get_states()
+        with self._lock:
+            return list(self._states.values())
+
+    def get_states_map(self) -> Dict[str, Dict[str, Any]]:
+        """Same as get_states, keyed by entity_id"""
+        if not self.is_ready:
+            self.ensure_started()
+            return {state['entity_id']: state for state in ha_client.get_states()}
+        with self._lock:
+            return dict(self._states)
+
+    def get_state(self, entity_id: str) -> Optional[Dict[str, Any]]:
+        """Get the mirrored state of a single entity, or None if unknown"""
+        with self._lock:
+            return self._states.get(entity_id)
+
+    def get_entity_version(self, entity_id: str) -> int:
+        with self._lock:
+            return self._entity_versions.get(entity_id, 0)
+
+    def changed_since(self, version: int) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Entities changed after `version`, mapped to their current state
+        (None for entities that have been removed).
+        """
+        with self._lock:
+            return {
+                entity_id: self._states.get(entity_id)
+                for entity_id, entity_version in self._entity_versions.items()
+                if entity_version > version
+            }
+
+    # State table
+
+    def apply_snapshot(self, states: List[Dict[str, Any]]):
+        """Replace the table with a full `get_states` result and mark the mirror ready"""
+        new_states = {state['entity_id']: state for state in states}
+        changes = []
+        with self._lock:
+            for entity_id, new_state in new_states.items():
+                old_state = self._states.get(entity_id)
+                if old_state != new_state:
+                    changes.append((entity_id, old_state, new_state))
+            for entity_id, old_state in self._states.items():
+                if entity_id not in new_states:
+                    changes.append((entity_id, old_state, None))
+
+            self._states = new_states
+            for entity_id, _, _ in changes:
+                self._version += 1
+                self._entity_versions[entity_id] = self._version
+            version = self._version
+        self._ready.set()
+
+        for entity_id, old_state, new_state in changes:
+            self._notify(entity_id, old_state, new_state, version)
+
+    def apply_event(self, event: Dict[str, Any]):
+        """Apply a single `state_changed` event"""
+        data = event.get('data', {})
+        entity_id = data.get('entity_id')
+        if not entity_id:
+            return
+        new_state = data.get('new_state')
+
+        with self._lock:
+            old_state = self._states.get(entity_id)
+            if new_state is None:
+                self._states.pop(entity_id, None)
+            else:
+                self._states[entity_id] = new_state
+            self._version += 1
+            self._entity_versions[entity_id] = self._version
+            version = self._version
+
+        self._notify(entity_id, old_state, new_state, version)
+
+    def _notify_event(self, event: Dict[str, Any]):
+        event_type = event.get('event_type')
+        for listener in list(self._event_listeners.get(event_type, [])):
+            try:
+                listener(event)
+            except Exception as e:
+                print(f"State mirror: listener error for {event_type}: {e}")
+
+    def _notify(self, entity_id, old_state, new_state, version):
+        for listener in list(self._listeners):
+            try:
+                listener(entity_id, old_state, new_state, version)
+            except Exception as e:
+                print(f"State mirror: listener error for {entity_id}: {e}")
+
+    # WebSocket protocol
+
+    def _next_id(self) -> int:
+        self._message_id += 1
+        return self._message_id
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with connect(self.ws_url, max_size=None, open_timeout=10) as ws:
+                    self._session(ws)
+            except Exception as e:
+                print(f"State mirror: connection to HA lost: {e}")
+            self._ready.clear()
+            self._stop.wait(self.reconnect_delay)
+
+    def _session(self, ws):
+        message = json.loads(ws.recv(timeout=10))
+        if message.get('type') == 'auth_required':
+            ws.send(json.dumps({'type': 'auth', 'access_token': self.token}))
+            message = json.loads(ws.recv(timeout=10))
+        if message.get('type') != 'auth_ok':
+            raise ConnectionError(f"HA WebSocket authentication failed: {message.get('message', message)}")
+
+        # Subscribe before fetching the snapshot so no change falls in between
+        self._message_id = 0
+        subscribe_id = self._next_id()
+        ws.send(json.dumps({'id': subscribe_id, 'type': 'subscribe_events', 'event_type': 'state_changed'}))
+        for event_type in list(self._event_listeners):
+            ws.send(json.dumps({'id': self._next_id(), 'type': 'subscribe_events', 'event_type': event_type}))
+        states_id = self._next_id()
+        ws.send(json.dumps({'id': states_id, 'type': 'get_states'}))
+
+        while not self._stop.is_set():
+            try:
+                raw = ws.recv(timeout=1)
+            except TimeoutError:
+                continue
+
+            message = json.loads(raw)
+            # HA may coalesce several messages into one JSON array
+            for msg in message if isinstance(message, list) else [message]:
+                self._handle_message(msg, states_id)
+
+    def _handle_message(self, message: Dict[str, Any], states_id: int):
+        msg_type = message.get('type')
+        if msg_type == 'event':
+            event = message.get('event', {})
+            if event.get('event_type', 'state_changed') == 'state_changed':
+                self.apply_event(event)
+            else:
+                self._notify_event(event)
+        elif msg_type == 'result':
+            if not message.get('success', False):
+                raise ConnectionError(f"HA WebSocket command {message.get('id')} failed: {message.get('error')}")
+            if message.get('id') == states_id:
+                self.apply_snapshot(message.get('result') or [])
+                print(f"State mirror: synced {len(self._states)} entities from HA")
+
+
+# Singleton instance
+state_mirror = HAStateMirror()
+# Keep the cached entity registry in step with registry edits made in HA
+state_mirror.add_event_listener('entity_registry_updated', ha_client.registry.on_registry_updated)
@@ -1,5 +1,6 @@
 from django.contrib import admin
 from .models import Device
+from .services import DeviceService
 
 @admin.register(Device)
 class DeviceAdmin(admin.ModelAdmin):
@@ -8,3 +9,10 @@ class DeviceAdmin(admin.ModelAdmin):
     search_fields = ('name', 'room')
     list_editable = ('is_on', 'is_online')
     ordering = ('-created_at',)
+
+    def delete_model(self, request, obj):
+        DeviceService.delete_devices(Device.objects.filter(pk=obj.pk))
+
+    def delete_queryset(self, request, queryset):
+        # Tombstoned and announced like API deletes
+        DeviceService.delete_devices(queryset)
@@ -7,3 +7,9 @@ class DevicesConfig(AppConfig):
 
     def ready(self):
         import apps.devices.signals
+
+        from .events import device_events
+        from .reconciler import device_reconciler, should_autostart
+        if should_autostart():
+            device_reconciler.start()
+            device_events.start()
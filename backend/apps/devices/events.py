@@ -0,0 +1,193 @@
+"""
+In-process feed of device changes for the /api/devices/stream/ SSE endpoint.
+
+Every change is recorded as a small delta (device id, changed serializer
+fields, version) in a ring buffer, so a client reconnecting with
+Last-Event-ID only receives what it missed. Deltas come from two sources:
+HA state changes seen by the local state mirror (every worker sees all of
+them) and writes made through this process (API edits, toggles, syncs).
+"""
+import copy
+import threading
+import uuid
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from apps.core.services.ha_state_mirror import state_mirror
+
+# Serializer fields that change on every save and carry no state
+IGNORED_FIELDS = ('createdAt', 'updatedAt')
+
+
+class DeviceEventBus:
+    """
+    Ring buffer of device deltas with blocking waits for stream readers.
+
+    Event ids are "<epoch>-<seq>": the epoch changes on every process start,
+    so ids from another worker or an earlier process are recognised as
+    unknown and answered with a fresh snapshot instead of a partial replay.
+    """
+
+    def __init__(self, buffer_size: int = None, mirror=None):
+        self.buffer_size = buffer_size or getattr(settings, 'DEVICE_STREAM_BUFFER_SIZE', 1000)
+        self.mirror = mirror or state_mirror
+        self.epoch = uuid.uuid4().hex[:8]
+
+        self._events = deque(maxlen=self.buffer_size)
+        self._seq = 0
+        self._condition = threading.Condition()
+        # Last published serializer data per device id, to emit only real changes
+        self._published: Dict[int, Dict[str, Any]] = {}
+        # In-memory devices by entity_id, to turn HA states into deltas
+        self._devices: Optional[Dict[str, Any]] = None
+        self._started = False
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    def event_id(self, seq: int) -> str:
+        return f"{self.epoch}-{seq}"
+
+    def parse_event_id(self, event_id: str) -> Optional[int]:
+        """Sequence number of an event id from this process, else None"""
+        epoch, _, seq = (event_id or '').partition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def start(self):
+        """Feed the bus from the local HA state mirror (idempotent)"""
+        if self._started:
+            return
+        self._started = True
+        self.mirror.add_listener(self.on_state_changed)
+        self.mirror.ensure_started()
+
+    def stop(self):
+        self.mirror.remove_listener(self.on_state_changed)
+        self._started = False
+
+    # Publishing
+
+    def _append(self, event: Dict[str, Any]):
+        with self._condition:
+            self._seq += 1
+            event['version'] = self._seq
+            self._events.append((self._seq, event))
+            self._condition.notify_all()
+
+    def publish_device(self, device):
+        """Record the fields of `device` that differ from what was last published"""
+        from .serializers import DeviceEventSerializer
+        data = {key: value for key, value in DeviceEventSerializer(device).data.items() if key not in IGNORED_FIELDS}
+        # attributes is the instance's own dict, which later saves mutate in place
+        data = copy.deepcopy(data)
+
+        with self._condition:
+            previous = self._published.get(device.pk)
+            self._published[device.pk] = data
+            if self._devices is not None and device.entity_id:
+                self._devices[device.entity_id] = copy.copy(device)
+
+        fields = data if previous is None else {
+            key: value for key, value in data.items() if previous.get(key) != value
+        }
+        if fields:
+            self._append({'type': 'delta', 'id': device.pk, 'fields': fields})
+
+    def publish_devices(self, devices):
+        for device in devices:
+            self.publish_device(device)
+
+    def publish_removed(self, device_id: int, entity_id: str = None):
+        with self._condition:
+            self._published.pop(device_id, None)
+            if self._devices is not None and entity_id:
+                self._devices.pop(entity_id, None)
+        self._append({'type': 'delta', 'id': device_id, 'removed': True})
+
+    def publish_reset(self):
+        """Tell readers to fetch a new snapshot (e.g. after bulk creates)"""
+        with self._condition:
+            self._devices = None
+        self._append({'type': 'reset'})
+
+    # HA feed
+
+    def _load_devices(self) -> Dict[str, Any]:
+        from .models import Device
+        close_old_connections()
+        try:
+            devices = Device.objects.exclude(entity_id__isnull=True)
+            return {device.entity_id: device for device in devices}
+        finally:
+            close_old_connections()
+
+    def _seed_published(self, devices):
+        # Clients start from a DB snapshot, so the first HA change of a
+        # device should only carry the fields that moved
+        from .serializers import DeviceEventSerializer
+        for device in devices:
+            if device.pk not in self._published:
+                data = DeviceEventSerializer(device).data
+                self._published.setdefault(device.pk, copy.deepcopy({
+                    key: value for key, value in data.items() if key not in IGNORED_FIELDS
+                }))
+
+    def on_state_changed(self, entity_id, old_state, new_state, version):
+        """State mirror listener: publish HA-side changes of known devices"""
+        from .services import DeviceService
+        if new_state is None:
+            return
+        if self._devices is None:
+            devices = self._load_devices()
+            with self._condition:
+                if self._devices is None:
+                    self._devices = devices
+            self._seed_published(devices.values())
+
+        device = self._devices.get(entity_id)
+        if device is None or DeviceService.in_grace_period(device):
+            return
+        if DeviceService.diff_device_from_ha(device, new_state):
+            self.publish_device(device)
+
+    # Reading
+
+    def events_since(self, seq: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        Events after `seq`, oldest first, or None if some of them already
+        fell out of the buffer (or a reset happened) and the reader needs a
+        snapshot.
+        """
+        with self._condition:
+            return self._events_since(seq)
+
+    def _events_since(self, seq: int) -> Optional[List[Dict[str, Any]]]:
+        if seq > self._seq:
+            return None
+        if seq == self._seq:
+            return []
+        if not self._events or self._events[0][0] > seq + 1:
+            return None
+        events = []
+        for event_seq, event in self._events:
+            if event_seq > seq:
+                if event['type'] == 'reset':
+                    return None
+                events.append(event)
+        return events
+
+    def wait_for_events(self, seq: int, timeout: float) -> Optional[List[Dict[str, Any]]]:
+        """Block until there are events after `seq` (or `timeout`); see events_since"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._seq != seq, timeout)
+            return self._events_since(seq)
+
+
+# Singleton instance
+device_events = DeviceEventBus()
@@ -0,0 +1,122 @@
+import random
+import statistics
+import threading
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+
+from apps.core.services.ha_state_mirror import HAStateMirror
+from apps.devices.models import Device
+from apps.devices.reconciler import DeviceReconciler
+
+BENCH_PREFIX = 'light.nezu_bench_'
+
+
+class QueryCounter:
+    """execute_wrapper that counts statements by their leading keyword"""
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        self.counts[sql.split(None, 1)[0].upper()] += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark GET /api/devices/ with concurrent pollers against a simulated HA state feed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=500)
+        parser.add_argument('--pollers', type=int, default=20)
+        parser.add_argument('--rounds', type=int, default=10)
+        parser.add_argument('--churn', type=float, default=0.05, help='Fraction of entities changing state per round')
+
+    def handle(self, *args, **options):
+        device_count = options['devices']
+        pollers = options['pollers']
+
+        states = [
+            {'entity_id': f'{BENCH_PREFIX}{i}', 'state': 'off', 'attributes': {'friendly_name': f'Bench {i}'}}
+            for i in range(device_count)
+        ]
+        mirror = HAStateMirror()
+        mirror.apply_snapshot(states)
+        reconciler = DeviceReconciler(mirror=mirror)
+        mirror.add_listener(reconciler.on_state_changed)
+
+        Device.objects.filter(entity_id__startswith=BENCH_PREFIX).delete()
+        Device.objects.bulk_create([
+            Device(name=f'Bench {i}', type='light', room='', entity_id=f'{BENCH_PREFIX}{i}', ha_domain='light')
+            for i in range(device_count)
+        ])
+
+        latencies = []
+        request_queries = Counter()
+        reconcile_queries = Counter()
+        changed_total = 0
+        results_lock = threading.Lock()
+
+        def poll(barrier):
+            client = Client(SERVER_NAME='localhost')
+            counter = QueryCounter()
+            barrier.wait()
+            with connection.execute_wrapper(counter):
+                started = time.perf_counter()
+                response = client.get('/api/devices/')
+                elapsed = time.perf_counter() - started
+            connection.close()
+            with results_lock:
+                latencies.append(elapsed)
+                request_queries.update(counter.counts)
+                if response.status_code != 200:
+                    request_queries['ERRORS'] += 1
+
+        try:
+            started = time.perf_counter()
+            for _ in range(options['rounds']):
+                # Simulate HA activity between polls
+                for state in random.sample(states, int(device_count * options['churn'])):
+                    new_state = dict(state, state='on' if state['state'] == 'off' else 'off')
+                    states[states.index(state)] = new_state
+                    mirror.apply_event({'data': {'entity_id': state['entity_id'], 'new_state': new_state}})
+                    changed_total += 1
+
+                counter = QueryCounter()
+                with connection.execute_wrapper(counter):
+                    reconciler.flush_pending()
+                reconcile_queries.update(counter.counts)
+
+                barrier = threading.Barrier(pollers)
+                threads = [threading.Thread(target=poll, args=(barrier,)) for _ in range(pollers)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            wall_time = time.perf_counter() - started
+        finally:
+            Device.objects.filter(entity_id__startswith=BENCH_PREFIX).delete()
+
+        requests = len(latencies)
+        latencies_ms = sorted(latency * 1000 for latency in latencies)
+        request_writes = request_queries['INSERT'] + request_queries['UPDATE'] + request_queries['DELETE']
+        reconcile_writes = reconcile_queries['INSERT'] + reconcile_queries['UPDATE'] + reconcile_queries['DELETE']
+
+        self.stdout.write(f'Devices: {device_count}, pollers: {pollers}, rounds: {options["rounds"]}, wall time: {wall_time:.2f}s')
+        self.stdout.write(
+            f'GET /api/devices/: {requests} requests, '
+            f'p50 {statistics.median(latencies_ms):.1f}ms, '
+            f'p95 {latencies_ms[int(len(latencies_ms) * 0.95) - 1]:.1f}ms, '
+            f'max {latencies_ms[-1]:.1f}ms, errors {request_queries["ERRORS"]}'
+        )
+        self.stdout.write(
+            f'Request path: {sum(request_queries[k] for k in ("SELECT", "INSERT", "UPDATE", "DELETE")) / requests:.1f} queries/request, '
+            f'{request_writes / requests:.2f} writes/request'
+        )
+        self.stdout.write(
+            f'Reconciler: {reconcile_writes} writes for {changed_total} HA changes '
+            f'({reconcile_writes / max(changed_total, 1):.2f} writes/change)'
+        )
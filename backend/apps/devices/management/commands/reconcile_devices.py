@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.devices.reconciler import DeviceReconciler
+
+
+class Command(BaseCommand):
+    help = 'Continuously apply Home Assistant state changes to the Device table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run a single full reconciliation pass and exit')
+        parser.add_argument('--interval', type=float, default=None, help='Seconds between full passes')
+
+    def handle(self, *args, **options):
+        reconciler = DeviceReconciler(interval=options['interval'])
+
+        if options['once']:
+            updated = reconciler.reconcile_all()
+            self.stdout.write(self.style.SUCCESS(f'Reconciled devices. Updated: {updated}'))
+            return
+
+        self.stdout.write('Reconciling devices from Home Assistant (Ctrl+C to stop)...')
+        reconciler.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            reconciler.stop()
+            self.stdout.write(self.style.SUCCESS('Reconciler stopped.'))
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-17 18:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0007_device_last_user_command'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device_id', models.BigIntegerField()),
+                ('entity_id', models.CharField(blank=True, max_length=100, null=True)),
+                ('version', models.BigIntegerField(db_index=True)),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='version',
+            field=models.BigIntegerField(db_index=True, default=0),
+        ),
+    ]
@@ -1,4 +1,38 @@
+import datetime
+import threading
+import time
+
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
+
+_version_lock = threading.Lock()
+_last_version = 0
+
+
+def next_version() -> int:
+    """
+    A new Device/DeviceTombstone version: the current time in microseconds,
+    kept strictly increasing within the process. Taking one costs no query
+    and no lock shared with other writers.
+    """
+    global _last_version
+    with _version_lock:
+        _last_version = max(time.time_ns() // 1000, _last_version + 1)
+        return _last_version
+
+
+def version_at(when: datetime.datetime) -> int:
+    return int(when.timestamp() * 1_000_000)
+
+
+def settled_version() -> int:
+    """
+    Versions up to this one belong to committed writes: a write commits
+    within DEVICE_VERSION_OVERLAP seconds of taking its version, so readers
+    never hand out a `since` above it.
+    """
+    return version_at(timezone.now()) - int(getattr(settings, 'DEVICE_VERSION_OVERLAP', 5) * 1_000_000)
 
 
 class Device(models.Model):
@@ -49,6 +83,121 @@ class Device(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     last_user_command = models.DateTimeField(null=True, blank=True, help_text='Timestamp of last user-initiated command')
+    # next_version() at this row's last write (GET /api/devices/?since=)
+    version = models.BigIntegerField(default=0, db_index=True)
+
+    # Fields whose initial values are remembered so the save signals can
+    # detect changes without re-reading the row
+    TRACKED_FIELDS = ('is_on', 'name', 'room_obj_id')
 
     def __str__(self):
         return f"{self.name} ({self.room})"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._snapshot_tracked_fields()
+        return instance
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'version' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['version']
+        self.version = next_version()
+        super().save(*args, **kwargs)
+        # Signals have seen the changes; the saved values are the new baseline
+        self._snapshot_tracked_fields(kwargs.get('update_fields'))
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self._snapshot_tracked_fields(fields)
+
+    def _snapshot_tracked_fields(self, update_fields=None):
+        if not hasattr(self, '_initial_values'):
+            self._initial_values = {}
+        for attname in self.TRACKED_FIELDS:
+            # Deferred fields are not in __dict__ and are left out
+            if attname not in self.__dict__:
+                continue
+            if update_fields is not None and self._meta.get_field(attname).name not in update_fields \
+                    and attname not in update_fields:
+                continue
+            self._initial_values[attname] = self.__dict__[attname]
+
+    def has_changed(self, field):
+        """
+        True if a tracked field differs from the value it had when loaded or
+        last saved. Every field counts as changed on unsaved instances.
+        """
+        if self._state.adding:
+            return True
+        if field not in self.__dict__:
+            # Deferred and never touched
+            return False
+        initial_values = getattr(self, '_initial_values', {})
+        if field not in initial_values:
+            return True
+        return self.__dict__[field] != initial_values[field]
+
+    @property
+    def changed_fields(self):
+        return [field for field in self.TRACKED_FIELDS if self.has_changed(field)]
+
+    @classmethod
+    def etag_part(cls) -> str:
+        """
+        ETag value for lists built from Device rows (ConditionalListMixin),
+        in one query: the row count, the newest settled version and the sum
+        of the unsettled versions. A write that commits late with an older
+        version than one already seen still changes the sum.
+        """
+        from django.db.models import Count, Max, Q, Sum
+        settled = settled_version()
+        table = cls.objects.aggregate(count=Count('id'),
+                                      settled=Max('version', filter=Q(version__lte=settled)),
+                                      unsettled=Sum('version', filter=Q(version__gt=settled)))
+        return f"devices={table['count']}:{table['settled'] or 0}:{table['unsettled'] or 0}"
+
+
+class DeviceTombstone(models.Model):
+    """
+    Marks a deleted device so `?since=` clients can drop it.
+    `device_id` is the old primary key (no FK: the row is gone). Tombstones
+    are kept DEVICE_TOMBSTONE_RETENTION_DAYS; older `since` values get the
+    full list again (see retention_version()).
+    """
+    device_id = models.BigIntegerField()
+    entity_id = models.CharField(max_length=100, null=True, blank=True)
+    version = models.BigIntegerField(db_index=True)
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Deleted device {self.device_id} (v{self.version})"
+
+    @classmethod
+    def record(cls, devices, version=None):
+        """
+        Tombstone (device_id, entity_id) pairs under one version (a new one
+        unless given). Call inside the transaction that deletes the devices.
+        """
+        devices = list(devices)
+        if not devices:
+            return
+        if version is None:
+            version = next_version()
+        cls.objects.bulk_create([
+            cls(device_id=device_id, entity_id=entity_id, version=version)
+            for device_id, entity_id in devices
+        ])
+
+    @staticmethod
+    def retention_version() -> int:
+        """Oldest version whose tombstones are still kept"""
+        days = getattr(settings, 'DEVICE_TOMBSTONE_RETENTION_DAYS', 7)
+        return version_at(timezone.now() - datetime.timedelta(days=days))
+
+    @classmethod
+    def prune(cls) -> int:
+        """Delete tombstones older than the retention window; returns how many"""
+        deleted, _ = cls.objects.filter(version__lt=cls.retention_version()).delete()
+        return deleted
@@ -0,0 +1,194 @@
+"""
+Background HA -> DB reconciliation for devices and the scene catalog.
+
+Keeps the Device and Scene tables in step with Home Assistant outside of the
+request path, so GET /api/devices/ and GET /api/scenes/ can be pure reads.
+Every gunicorn worker starts one, but only the holder of a lease in the
+shared cache (CACHES) reconciles; the others wait to take over.
+"""
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from apps.core.services.ha_state_mirror import state_mirror
+from apps.routines.services import SceneCatalogSync
+from .models import DeviceTombstone
+from .services import DeviceSyncEngine
+
+
+class DeviceReconciler:
+    """
+    Applies HA state diffs to the Device table.
+
+    Entity ids reported by the state mirror are queued and flushed in one
+    batch after a short debounce; a full pass over all devices also runs
+    every `interval` seconds to catch anything the event feed missed, and
+    expired DeviceTombstones are pruned at most every `prune_interval`.
+
+    The worker thread only does this while it holds the reconciler lease,
+    a cache key renewed every `lease_timeout` / 3 seconds; if its holder
+    dies, another process takes over once the key expires.
+    """
+
+    LEASE_KEY = 'device_reconciler:lease'
+
+    def __init__(self, interval: float = None, debounce: float = None, mirror=None, prune_interval: float = 3600,
+                 lease_timeout: float = None):
+        self.mirror = mirror or state_mirror
+        # Only apply state: creating and removing devices is left to the manual sync
+        self.engine = DeviceSyncEngine(create=False, delete=False)
+        self.scene_sync = SceneCatalogSync()
+        self.interval = interval if interval is not None else getattr(settings, 'DEVICE_RECONCILE_INTERVAL', 30)
+        self.debounce = debounce if debounce is not None else getattr(settings, 'DEVICE_RECONCILE_DEBOUNCE', 0.5)
+        self.prune_interval = prune_interval
+        self._pruned_at = None
+        self.lease_timeout = (lease_timeout if lease_timeout is not None
+                              else getattr(settings, 'DEVICE_RECONCILER_LEASE', 60))
+        self.identity = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._leading = False
+
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the worker thread, which reconciles once it holds the lease (idempotent)"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='device-reconciler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        self._stop.set()
+        self._wakeup.set()
+        self.mirror.remove_listener(self.on_state_changed)
+        if self._thread:
+            self._thread.join(timeout)
+        self._thread = None
+        if self._leading:
+            self._leading = False
+            self._safe(self._release_lease)
+
+    def on_state_changed(self, entity_id, old_state, new_state, version):
+        with self._lock:
+            self._pending.add(entity_id)
+        self._wakeup.set()
+
+    def _run(self):
+        next_pass = None
+        while not self._stop.is_set():
+            if not self._safe(self._hold_lease):
+                if self._leading:
+                    print("Reconciler: lease lost, another worker reconciles devices")
+                    self._leading = False
+                    self.mirror.remove_listener(self.on_state_changed)
+                self._stop.wait(self.lease_timeout / 3)
+                continue
+            if not self._leading:
+                # Start with a full pass so the table is fresh after a restart or a takeover
+                self._leading = True
+                self.mirror.add_listener(self.on_state_changed)
+                self.mirror.ensure_started()
+                next_pass = time.monotonic()
+
+            now = time.monotonic()
+            if now >= next_pass:
+                self._safe(self.reconcile_all)
+                self._safe(self._maybe_prune)
+                next_pass = time.monotonic() + self.interval
+                continue
+            # Wake up in time to renew the lease
+            woken = self._wakeup.wait(min(next_pass - now, self.lease_timeout / 3))
+            if self._stop.is_set():
+                break
+            if woken:
+                # Let bursts of events (e.g. a scene) coalesce into one flush
+                self._stop.wait(self.debounce)
+                self._wakeup.clear()
+                self._safe(self.flush_pending)
+
+    def _hold_lease(self) -> bool:
+        """Take or renew the reconciler lease; True while this process holds it"""
+        if cache.add(self.LEASE_KEY, self.identity, timeout=self.lease_timeout):
+            return True
+        if cache.get(self.LEASE_KEY) != self.identity:
+            return False
+        cache.touch(self.LEASE_KEY, timeout=self.lease_timeout)
+        return True
+
+    def _release_lease(self):
+        # Let another worker take over right away instead of after the timeout
+        if cache.get(self.LEASE_KEY) == self.identity:
+            cache.delete(self.LEASE_KEY)
+
+    def _safe(self, func):
+        close_old_connections()
+        try:
+            return func()
+        except Exception as e:
+            print(f"Reconciler: error syncing devices from HA: {e}")
+        finally:
+            close_old_connections()
+
+    def _maybe_prune(self):
+        now = time.monotonic()
+        if self._pruned_at is not None and now - self._pruned_at < self.prune_interval:
+            return
+        self._pruned_at = now
+        pruned = DeviceTombstone.prune()
+        if pruned:
+            print(f"Reconciler: pruned {pruned} device tombstones")
+
+    def flush_pending(self) -> int:
+        """Reconcile only the devices whose entities changed since the last flush"""
+        with self._lock:
+            entity_ids, self._pending = self._pending, set()
+        if not entity_ids:
+            return 0
+        states_map = self.mirror.get_states_map()
+        if any(entity_id.split('.')[0] in SceneCatalogSync.DOMAINS for entity_id in entity_ids):
+            self.scene_sync.sync(states_map.values())
+        return self.reconcile(states_map, entity_ids)
+
+    def reconcile_all(self) -> int:
+        with self._lock:
+            self._pending.clear()
+        states_map = self.mirror.get_states_map()
+        self.scene_sync.sync(states_map.values())
+        return self.reconcile(states_map)
+
+    def reconcile(self, ha_states_map, entity_ids=None) -> int:
+        updated_count = self.engine.sync(ha_states_map, entity_ids)['updated']
+        if updated_count > 0:
+            print(f"Reconciler: synced {updated_count} devices from Home Assistant")
+        return updated_count
+
+
+def should_autostart() -> bool:
+    """
+    Only start the in-process reconciler in processes that serve requests:
+    gunicorn workers or the reloaded runserver child, never in migrate,
+    test, shell or other management commands.
+    """
+    if not getattr(settings, 'DEVICE_RECONCILER_ENABLED', True):
+        return False
+    program = os.path.basename(sys.argv[0]) if sys.argv else ''
+    if any(server in program for server in ('gunicorn', 'uvicorn', 'daphne')):
+        return True
+    if program == 'manage.py' and sys.argv[1:2] == ['runserver']:
+        return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv
+    return False
+
+
+# Singleton instance
+device_reconciler = DeviceReconciler()
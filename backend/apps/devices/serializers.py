@@ -12,3 +12,15 @@ class DeviceSerializer(serializers.ModelSerializer):
     class Meta:
         model = Device
         fields = ['id', 'entity_id', 'name', 'type', 'room', 'room_obj', 'room_name', 'isOn', 'value', 'unit', 'isOnline', 'attributes', 'createdAt', 'updatedAt']
+
+
+class DeviceEventSerializer(DeviceSerializer):
+    """
+    DeviceSerializer for stream events. room_name comes from the legacy `room`
+    field (kept equal to room_obj.name by signals) so serializing a device
+    never costs a query for its room.
+    """
+    room_name = serializers.SerializerMethodField()
+
+    def get_room_name(self, device):
+        return device.room if device.room_obj_id else None
@@ -1,23 +1,112 @@
-from .models import Device
+from concurrent import futures
+
+from django.db import transaction
+from .models import Device, DeviceTombstone, next_version
 from apps.core.services.ha_client import ha_client
+from apps.core.services.ha_dispatcher import dispatch_service_calls
 
 class DeviceService:
+    @staticmethod
+    def ha_command_for(device, is_on):
+        """
+        Build the (domain, service, service_data) HA call that sets a device
+        on/off, or None if the device is not controllable.
+        """
+        if not device.entity_id:
+            return None
+
+        domain = device.ha_domain or device.entity_id.split('.')[0]
+        service = 'turn_on' if is_on else 'turn_off'
+
+        if domain == 'lock':
+            service = 'unlock' if is_on else 'lock'
+
+        if domain not in ['light', 'switch', 'lock']:
+            return None
+        return domain, service, {'entity_id': device.entity_id}
+
     @staticmethod
     def send_ha_command(device, is_on):
         """
         Send the turn_on/turn_off command to Home Assistant.
         """
-        if device.entity_id:
-            domain = device.ha_domain
-            service = 'turn_on' if is_on else 'turn_off'
-            service_data = {'entity_id': device.entity_id}
-            
-            if domain == 'lock':
-                service = 'unlock' if is_on else 'lock'
-                
-            if domain in ['light', 'switch', 'lock']:
-                ha_client.call_service(domain, service, service_data)
-                print(f"Sent command to HA: {domain}.{service} for {device.entity_id}")
+        command = DeviceService.ha_command_for(device, is_on)
+        if command:
+            domain, service, service_data = command
+            ha_client.call_service(domain, service, service_data)
+            print(f"Sent command to HA: {domain}.{service} for {device.entity_id}")
+
+    @staticmethod
+    def send_ha_commands(devices, is_on, timeout=None):
+        """
+        Send turn_on/turn_off to many devices at once.
+        Devices sharing a (domain, service) go out as one multi-entity call and
+        the calls run concurrently, so the wait is about one HA round-trip.
+        With a `timeout`, stops waiting after that many seconds and leaves the
+        remaining calls in flight.
+        Returns the number of devices whose command failed.
+        """
+        commands = [command for command in (DeviceService.ha_command_for(d, is_on) for d in devices) if command]
+        if not commands:
+            return 0
+
+        try:
+            results = dispatch_service_calls(commands, timeout=timeout)
+        except futures.TimeoutError:
+            print(f"Sent {len(commands)} commands to HA, still waiting for answers after {timeout}s")
+            return 0
+        failed = 0
+        for (domain, service, service_data), result in zip(commands, results):
+            if isinstance(result, Exception):
+                failed += 1
+                print(f"Error sending {domain}.{service} for {service_data['entity_id']}: {result}")
+        print(f"Sent {len(commands) - failed}/{len(commands)} commands to HA")
+        return failed
+
+    @staticmethod
+    def set_power_many(devices, is_on, timeout=None):
+        """
+        Turn many devices on/off: one UPDATE for the local state, then all HA
+        commands concurrently (waiting at most `timeout` seconds for them).
+        The UPDATE bypasses the save signals, so each command is sent exactly
+        once.
+        Returns the number of devices whose local state changed.
+        """
+        from django.utils import timezone
+        devices = list(devices)
+        changed = [device for device in devices if device.is_on != is_on]
+        if changed:
+            now = timezone.now()
+            version = next_version()
+            Device.objects.filter(pk__in=[device.pk for device in changed]).update(
+                is_on=is_on, last_user_command=now, version=version
+            )
+            for device in changed:
+                device.is_on = is_on
+                device.last_user_command = now
+                device.version = version
+
+            from .events import device_events
+            device_events.publish_devices(changed)
+
+        DeviceService.send_ha_commands(devices, is_on, timeout=timeout)
+        return len(changed)
+
+    @staticmethod
+    def set_room_power(room_id, is_on, timeout=None):
+        """
+        Turn every device of a room on/off with set_power_many: a fixed number
+        of queries whatever the room size, and at most `timeout` seconds
+        waiting for HA. Returns the number of devices in the room.
+        Raises Room.DoesNotExist for unknown rooms.
+        """
+        from apps.rooms.models import Room
+        devices = list(Device.objects.filter(room_obj_id=room_id))
+        # Only an empty result needs telling "no devices" from "no room"
+        if not devices and not Room.objects.filter(id=room_id).exists():
+            raise Room.DoesNotExist(f"Room {room_id} does not exist")
+        DeviceService.set_power_many(devices, is_on, timeout=timeout)
+        return len(devices)
 
     @staticmethod
     def toggle_device(device_id, is_on):
@@ -26,84 +115,230 @@ class DeviceService:
         """
         try:
             device = Device.objects.get(id=device_id)
-            
-            # Update local state
-            from django.utils import timezone
-            if device.is_on != is_on:
-                device.is_on = is_on
-                device.last_user_command = timezone.now()
-                device.save(update_fields=['is_on', 'last_user_command'])
-                        
-            return device
+            return DeviceService.set_power(device, is_on)
         except Exception as e:
             print(f"Error toggling device {device_id}: {e}")
             raise e
 
+    @staticmethod
+    def set_power(device, is_on):
+        """
+        Update the local state of an already loaded device.
+        The signal will handle HA sync.
+        """
+        from django.utils import timezone
+        if device.is_on != is_on:
+            device.is_on = is_on
+            device.last_user_command = timezone.now()
+            device.save(update_fields=['is_on', 'last_user_command'])
+        return device
+
+    @staticmethod
+    def in_grace_period(device):
+        """
+        True if the device was commanded BY USER in the last 5 seconds.
+        This prevents overwriting optimistic updates with stale HA data.
+        """
+        if not device.last_user_command:
+            return False
+
+        from django.utils import timezone
+        # Ensure last_user_command is aware
+        if timezone.is_naive(device.last_user_command):
+            device.last_user_command = timezone.make_aware(device.last_user_command)
+
+        return (timezone.now() - device.last_user_command).total_seconds() < 5
+
+    @staticmethod
+    def diff_device_from_ha(device, ha_state):
+        """
+        Apply an HA state object to the device in memory.
+        Returns the list of fields that changed (nothing is saved).
+        """
+        changed_fields = []
+        state_str = ha_state.get('state', 'off')
+
+        # Determine availability
+        is_online = state_str not in ['unavailable', 'unknown']
+
+        # Determine is_on based on domain and state string
+        is_on = state_str not in ['off', 'unavailable', 'unknown', 'closed', 'locked']
+
+        if device.is_online != is_online:
+            device.is_online = is_online
+            changed_fields.append('is_online')
+
+        if device.is_on != is_on:
+            device.is_on = is_on
+            changed_fields.append('is_on')
+
+        # Update value (for sensors)
+        if device.value != state_str:
+            device.value = state_str
+            changed_fields.append('value')
+
+        # Update unit (for sensors)
+        # Copy: ha_state may be shared with the state mirror
+        attributes = dict(ha_state.get('attributes', {}))
+        unit = attributes.get('unit_of_measurement', '')
+        if device.unit != unit:
+            device.unit = unit
+            changed_fields.append('unit')
+
+        # Update attributes (location, battery, etc)
+        # Ensure we keep our clean name in the local attributes storage
+        # to prevent HA from reverting it in our database views.
+        attributes['friendly_name'] = device.name
+
+        if device.attributes != attributes:
+            device.attributes = attributes
+            changed_fields.append('attributes')
+
+        return changed_fields
+
     @staticmethod
     def sync_device_from_ha(device, ha_states_map):
         """
         Sync a single device state from Home Assistant data.
         """
         if device.entity_id and device.entity_id in ha_states_map:
-            # Grace period: Don't sync if updated BY USER in the last 5 seconds
-            # This prevents overwriting optimistic updates with stale HA data
-            from django.utils import timezone
-            import datetime
-            
-            if device.last_user_command:
-                now = timezone.now()
-                # Ensure last_user_command is aware
-                if timezone.is_naive(device.last_user_command):
-                    device.last_user_command = timezone.make_aware(device.last_user_command)
-                    
-                if (now - device.last_user_command).total_seconds() < 5:
-                    return False
-
-            ha_state = ha_states_map[device.entity_id]
-            state_str = ha_state.get('state', 'off')
-            
-            # Determine availability
-            is_online = state_str not in ['unavailable', 'unknown']
-            
-            # Determine is_on based on domain and state string
-            is_on = state_str not in ['off', 'unavailable', 'unknown', 'closed', 'locked']
-            
-            # Update if changed
-            has_changes = False
-            
-            if device.is_online != is_online:
-                device.is_online = is_online
-                has_changes = True
-                
-            if device.is_on != is_on:
-                device.is_on = is_on
-                has_changes = True
-            
-            # Update value (for sensors)
-            if device.value != state_str:
-                device.value = state_str
-                has_changes = True
-            
-            # Update unit (for sensors)
-            attributes = ha_state.get('attributes', {})
-            unit = attributes.get('unit_of_measurement', '')
-            if device.unit != unit:
-                device.unit = unit
-                has_changes = True
-                
-            # Update attributes (location, battery, etc)
-            # Ensure we keep our clean name in the local attributes storage
-            # to prevent HA from reverting it in our database views.
-            attributes['friendly_name'] = device.name
-            
-            if device.attributes != attributes:
-                print(f"[DEBUG] Sync: Device={device.id}, Name='{device.name}', Old Attr Name='{device.attributes.get('friendly_name')}', New Attr Name='{attributes.get('friendly_name')}'")
-                device.attributes = attributes
-                has_changes = True
-
-            if has_changes:
+            if DeviceService.in_grace_period(device):
+                return False
+
+            changed_fields = DeviceService.diff_device_from_ha(device, ha_states_map[device.entity_id])
+            if changed_fields:
                 # Set flag to prevent signal from sending command back to HA
                 device._from_ha_sync = True
-                device.save(update_fields=['is_on', 'is_online', 'value', 'unit', 'attributes'])
+                device.save(update_fields=changed_fields)
                 return True
         return False
+
+    @staticmethod
+    def delete_devices(queryset):
+        """
+        Delete devices with a single DELETE, tombstoning them for ?since=
+        readers and announcing the change (devices_changed, the stream).
+        Returns the number deleted.
+        """
+        from .events import device_events
+        from .signals import devices_changed
+        with transaction.atomic():
+            devices = list(queryset.values_list('pk', 'entity_id'))
+            if not devices:
+                return 0
+            DeviceTombstone.record(devices)
+            Device.objects.filter(pk__in=[device_id for device_id, _ in devices]).delete()
+            devices_changed.send(sender=Device)
+
+            def publish():
+                for device_id, entity_id in devices:
+                    device_events.publish_removed(device_id, entity_id)
+            transaction.on_commit(publish)
+        return len(devices)
+
+
+class DeviceSyncEngine:
+    """
+    Diff-based HA -> DB device sync.
+
+    Loads the relevant devices once, computes creates, updates and deletes in
+    memory and applies them with bulk queries inside a single transaction, so
+    the number of queries does not grow with the number of entities. Bulk
+    queries bypass the Device save signals, which also means changes that
+    came from HA are never echoed back to it.
+    """
+    SUPPORTED_DOMAINS = {
+        'light': 'light',
+        'switch': 'switch',
+        'sensor': 'sensor',
+        'binary_sensor': 'sensor',
+        'climate': 'climate',
+        'lock': 'lock',
+    }
+
+    def __init__(self, create=True, delete=True):
+        self.create = create
+        self.delete = delete
+
+    def sync(self, ha_states_map, entity_ids=None):
+        """
+        Reconcile the Device table with `ha_states_map` ({entity_id: state}).
+        If `entity_ids` is given, only those entities are considered.
+        Returns a summary dict with new/updated/removed counts.
+        """
+        devices = Device.objects.exclude(entity_id__isnull=True)
+        if entity_ids is not None:
+            devices = devices.filter(entity_id__in=entity_ids)
+        existing_devices = {device.entity_id: device for device in devices}
+
+        to_create = []
+        to_update = {}  # changed fields -> [devices]
+        to_delete = []
+
+        candidates = ha_states_map if entity_ids is None else {
+            entity_id: ha_states_map[entity_id] for entity_id in entity_ids if entity_id in ha_states_map
+        }
+        for entity_id, ha_state in candidates.items():
+            device = existing_devices.get(entity_id)
+            if device is not None:
+                if DeviceService.in_grace_period(device):
+                    continue
+                changed_fields = DeviceService.diff_device_from_ha(device, ha_state)
+                if changed_fields:
+                    to_update.setdefault(tuple(changed_fields), []).append(device)
+            elif self.create:
+                domain = entity_id.split('.')[0]
+                if domain in self.SUPPORTED_DOMAINS:
+                    to_create.append(self._new_device(entity_id, domain, ha_state))
+
+        if self.delete:
+            to_delete = [
+                device for entity_id, device in existing_devices.items()
+                if entity_id not in ha_states_map
+            ]
+
+        if to_create or to_update or to_delete:
+            with transaction.atomic():
+                # One version for the whole pass
+                version = next_version()
+                if to_create:
+                    for device in to_create:
+                        device.version = version
+                    Device.objects.bulk_create(to_create)
+                for fields, group in to_update.items():
+                    for device in group:
+                        device.version = version
+                    Device.objects.bulk_update(group, fields + ('version',))
+                if to_delete:
+                    DeviceTombstone.record(((device.pk, device.entity_id) for device in to_delete), version)
+                    Device.objects.filter(pk__in=[device.pk for device in to_delete]).delete()
+
+            # Bulk queries skip the save signals: notify stream readers here
+            from .events import device_events
+            from .signals import devices_changed
+            if to_create or to_delete:
+                device_events.publish_reset()
+                devices_changed.send(sender=Device)
+            else:
+                for group in to_update.values():
+                    device_events.publish_devices(group)
+
+        return {
+            'new': len(to_create),
+            'updated': sum(len(group) for group in to_update.values()),
+            'removed': len(to_delete),
+        }
+
+    def _new_device(self, entity_id, domain, ha_state):
+        attributes = dict(ha_state.get('attributes', {}))
+        name = attributes.get('friendly_name', entity_id)
+        device = Device(
+            entity_id=entity_id,
+            name=name,
+            type=self.SUPPORTED_DOMAINS[domain],
+            ha_domain=domain,
+            # Ignore HA area, set as Unassigned for Nezu control
+            room='',
+        )
+        DeviceService.diff_device_from_ha(device, ha_state)
+        return device
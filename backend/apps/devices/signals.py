@@ -1,69 +1,115 @@
-from django.db.models.signals import post_save, pre_save
-from django.dispatch import receiver
-from .models import Device
+from django.db import transaction
+from django.db.models.signals import post_save, pre_delete, pre_save
+from django.dispatch import Signal, receiver
+from .events import device_events
+from .models import Device, next_version
+from .services import DeviceService
+from apps.core.models import ChangeCounter
 from apps.core.services.ha_client import ha_client
 
+# Sent (sender=Device) when devices are added or removed without a save per
+# row: the sync engine's bulk queries and API deletes. Device has no
+# post_delete receivers, which keeps bulk deletes a single DELETE.
+devices_changed = Signal()
+
+# ETag counter of the room list's deviceCount
+ROOM_DEVICES_COUNTER = 'room_devices'
+
 @receiver(pre_save, sender=Device)
-def track_previous_state(sender, instance, **kwargs):
+def sync_derived_fields(sender, instance, **kwargs):
     """
-    Track the previous state of is_on and name to detect changes.
+    Keep derived fields in sync before saving.
+    Changes are detected from the in-memory snapshot (Device.has_changed),
+    so no extra SELECT is needed.
     """
-    if instance.pk:
-        try:
-            old_instance = Device.objects.get(pk=instance.pk)
-            instance._old_is_on = old_instance.is_on
-            instance._old_name = old_instance.name
-            print(f"[DEBUG] Pre-save: ID={instance.id}, Old Name='{old_instance.name}', New Name='{instance.name}'")
-        except Device.DoesNotExist:
-            instance._old_is_on = None
-            instance._old_name = None
-            
     # Mirror name to attributes['friendly_name'] for consistency in the JSON field
     if not instance.attributes:
         instance.attributes = {}
     instance.attributes['friendly_name'] = instance.name
 
-    # Sync room_obj name to legacy room field
-    if instance.room_obj:
-        instance.room = instance.room_obj.name
-    elif instance.room_obj_id is None:
-        instance.room = ''
+    # Sync room_obj name to legacy room field. Renames of the room itself are
+    # propagated by the Room post_save signal.
+    if instance.has_changed('room_obj_id'):
+        if instance.room_obj:
+            instance.room = instance.room_obj.name
+        elif instance.room_obj_id is None:
+            instance.room = ''
 
 @receiver(post_save, sender=Device)
-def sync_to_home_assistant(sender, instance, created, **kwargs):
+def sync_to_home_assistant(sender, instance, created, update_fields=None, **kwargs):
     """
     Send command to Home Assistant when is_on or name changes.
     """
     # Skip if this update came from a HA sync
-    if getattr(instance, '_from_ha_sync', False):
+    if created or getattr(instance, '_from_ha_sync', False):
         return
 
-    # Check if is_on changed
-    old_is_on = getattr(instance, '_old_is_on', None)
-    
-    if not created and old_is_on != instance.is_on:
-        # Send command
-        if instance.entity_id:
-            domain = instance.ha_domain or instance.entity_id.split('.')[0]
-            service = 'turn_on' if instance.is_on else 'turn_off'
-            service_data = {'entity_id': instance.entity_id}
-            
-            if domain == 'lock':
-                service = 'unlock' if instance.is_on else 'lock'
-                
-            if domain in ['light', 'switch', 'lock']:
-                try:
-                    ha_client.call_service(domain, service, service_data)
-                    print(f"Signal: Sent command to HA: {domain}.{service} for {instance.entity_id}")
-                except Exception as e:
-                    print(f"Signal: Error sending command to HA: {e}")
+    changed_fields = instance.changed_fields
+    if update_fields is not None:
+        # Fields left out of update_fields were not written
+        changed_fields = [field for field in changed_fields if field in update_fields]
+    if not changed_fields or not instance.entity_id:
+        return
 
-    # Check if name changed
-    old_name = getattr(instance, '_old_name', None)
-    if not created and old_name != instance.name:
-        if instance.entity_id:
+    # Check if is_on changed
+    if 'is_on' in changed_fields:
+        command = DeviceService.ha_command_for(instance, instance.is_on)
+        if command:
+            domain, service, service_data = command
             try:
-                ha_client.update_entity_name(instance.entity_id, instance.name)
-                print(f"Signal: Updated name in HA for {instance.entity_id} to {instance.name}")
+                ha_client.call_service(domain, service, service_data)
+                print(f"Signal: Sent command to HA: {domain}.{service} for {instance.entity_id}")
             except Exception as e:
-                print(f"Signal: Error updating name in HA: {e}")
+                print(f"Signal: Error sending command to HA: {e}")
+
+    # Check if name changed
+    if 'name' in changed_fields:
+        try:
+            ha_client.update_entity_name(instance.entity_id, instance.name)
+            print(f"Signal: Updated name in HA for {instance.entity_id} to {instance.name}")
+        except Exception as e:
+            print(f"Signal: Error updating name in HA: {e}")
+
+@receiver(post_save, sender=Device)
+def bump_room_membership(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Room lists (deviceCount) depend on which devices are in each room, not
+    on their state: only new devices and room moves invalidate them
+    """
+    moved = 'room_obj_id' in instance.changed_fields and (update_fields is None or 'room_obj' in update_fields)
+    if created or moved:
+        ChangeCounter.next_on_commit(ROOM_DEVICES_COUNTER)
+
+
+@receiver(devices_changed)
+def bump_room_membership_in_bulk(sender, **kwargs):
+    ChangeCounter.next_on_commit(ROOM_DEVICES_COUNTER)
+
+
+@receiver(pre_delete, sender='users.User')
+def delete_user_devices(sender, instance, **kwargs):
+    """
+    A user's devices go with them (CASCADE); delete them first the way the
+    API does, so discovery and ?since= readers don't keep listing them
+    """
+    DeviceService.delete_devices(Device.objects.filter(user=instance))
+
+
+@receiver(pre_delete, sender='rooms.Room')
+def detach_room_devices(sender, instance, **kwargs):
+    """
+    Devices outlive their room (SET_NULL). Detach them here with a new
+    version, so ?since= readers and the stream see the move.
+    """
+    if Device.objects.filter(room_obj=instance).update(room_obj=None, room='', version=next_version()):
+        devices_changed.send(sender=Device)
+        transaction.on_commit(device_events.publish_reset)
+
+
+@receiver(post_save, sender=Device)
+def publish_device_change(sender, instance, **kwargs):
+    """
+    Push the saved device to /api/devices/stream/ readers.
+    Only fields that differ from the last published state are sent.
+    """
+    device_events.publish_device(instance)
@@ -1,3 +1,896 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
 
-# Create your tests here.
+import requests
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from unittest import mock
+from websockets.sync.server import serve
+
+from apps.core.checks import check_shared_cache
+from apps.core.services.ha_async_client import AsyncHomeAssistantClient, EventLoopThread
+from apps.core.services.ha_client import HomeAssistantClient
+from apps.core.services.ha_dispatcher import dispatch_service_calls, group_service_calls
+from apps.core.services.ha_state_cache import SharedStateCache
+from apps.core.services.ha_state_mirror import HAStateMirror
+from .events import DeviceEventBus
+from .models import Device, DeviceTombstone, next_version
+from .reconciler import DeviceReconciler
+from .views import stream_slots
+from .services import DeviceService, DeviceSyncEngine
+
+
+def load_ha_dump(domains=('light', 'switch')):
+    """
+    Build HA state objects from the entity list in backend/ha_dump.txt
+    (one "entity_id | friendly name" per line).
+    """
+    states = []
+    with open(Path(settings.BASE_DIR) / 'ha_dump.txt', encoding='utf-8') as dump:
+        for line in dump:
+            if '|' not in line:
+                continue
+            entity_id, friendly_name = [part.strip() for part in line.split('|', 1)]
+            if entity_id.split('.')[0] in domains:
+                states.append({
+                    'entity_id': entity_id,
+                    'state': 'off',
+                    'attributes': {'friendly_name': friendly_name},
+                })
+    return states
+
+
+class FakeHAWebSocketServer:
+    """
+    Minimal Home Assistant WebSocket API: authenticates, answers get_states
+    and replays a recorded list of state_changed payloads to subscribers.
+    """
+
+    def __init__(self, states, events, token='test-token'):
+        self.states = states
+        self.events = events
+        self.token = token
+        self.connections = 0
+
+    def __enter__(self):
+        self.server = serve(self._handler, 'localhost', 0)
+        self.url = f"http://localhost:{self.server.socket.getsockname()[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.thread.join(5)
+
+    def _handler(self, ws):
+        self.connections += 1
+        ws.send(json.dumps({'type': 'auth_required'}))
+        auth = json.loads(ws.recv())
+        if auth.get('access_token') != self.token:
+            ws.send(json.dumps({'type': 'auth_invalid', 'message': 'Invalid access token'}))
+            return
+        ws.send(json.dumps({'type': 'auth_ok'}))
+
+        subscription_id = None
+        for raw in ws:
+            message = json.loads(raw)
+            if message['type'] == 'subscribe_events':
+                subscription_id = message['id']
+                ws.send(json.dumps({'id': message['id'], 'type': 'result', 'success': True, 'result': None}))
+            elif message['type'] == 'get_states':
+                ws.send(json.dumps({'id': message['id'], 'type': 'result', 'success': True, 'result': self.states}))
+                for data in self.events:
+                    ws.send(json.dumps({
+                        'id': subscription_id,
+                        'type': 'event',
+                        'event': {'event_type': 'state_changed', 'data': data},
+                    }))
+
+
+class FakeHAHttpServer:
+    """
+    Threaded fake of the HA REST API (states, entity registry, services).
+    Counts accepted TCP connections and requests, records service calls, and
+    can add latency to every request or answer the first `fail_first` GETs
+    with 503.
+    """
+
+    def __init__(self, states=None, latency=0, fail_first=0, registry=None):
+        self.states = states or []
+        self.registry = registry or []
+        self.latency = latency
+        self.fail_first = fail_first
+        self.connections = 0
+        self.requests = 0
+        self.service_calls = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        fake = self
+
+        class CountingServer(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 128
+
+            def get_request(self):
+                request = super().get_request()
+                with fake._lock:
+                    fake.connections += 1
+                return request
+
+            def handle_error(self, request, client_address):
+                # Clients that gave up (timeouts) are expected, not test failures
+                if not isinstance(sys.exc_info()[1], ConnectionError):
+                    super().handle_error(request, client_address)
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _begin(self):
+                with fake._lock:
+                    fake.requests += 1
+                    failing = fake.fail_first > 0
+                    if failing and self.command == 'GET':
+                        fake.fail_first -= 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                return failing and self.command == 'GET'
+
+            def do_GET(self):
+                if self._begin():
+                    return self._reply(503, {'message': 'Unavailable'})
+                if self.path == '/api/states':
+                    return self._reply(200, fake.states)
+                if self.path == '/api/config/entity_registry/list':
+                    return self._reply(200, fake.registry)
+                return self._reply(200, {'message': 'API running.'})
+
+            def do_POST(self):
+                self._begin()
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                if self.path.startswith('/api/services/'):
+                    domain, service = self.path[len('/api/services/'):].split('/')
+                    with fake._lock:
+                        fake.service_calls.append((domain, service, body))
+                    return self._reply(200, [])
+                return self._reply(404, {'message': 'Not found'})
+
+        self.server = CountingServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(5)
+
+
+class HomeAssistantClientTests(TestCase):
+    def test_sequential_requests_reuse_one_connection(self):
+        with FakeHAHttpServer(states=load_ha_dump()) as server:
+            client = HomeAssistantClient(base_url=server.url, token='t')
+            for _ in range(20):
+                client.get_states()
+            client.call_service('light', 'turn_on', {'entity_id': 'light.ingreso_switch_1'})
+            client.close()
+
+        self.assertEqual(server.requests, 21)
+        self.assertEqual(server.connections, 1)
+
+    def test_concurrent_threads_stay_within_pool(self):
+        with FakeHAHttpServer(latency=0.01) as server:
+            client = HomeAssistantClient(base_url=server.url, token='t', pool_size=4)
+            threads = [
+                threading.Thread(target=lambda: [client.check_connection() for _ in range(10)])
+                for _ in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            client.close()
+
+        self.assertEqual(server.requests, 80)
+        self.assertLessEqual(server.connections, 4)
+
+    def test_get_is_retried_with_backoff(self):
+        with FakeHAHttpServer(fail_first=2) as server:
+            client = HomeAssistantClient(base_url=server.url, token='t', retries=2, backoff=0.01)
+            self.assertEqual(client.get_states(), [])
+
+        self.assertEqual(server.requests, 3)
+
+    def test_post_is_never_retried(self):
+        with FakeHAHttpServer() as server:
+            client = HomeAssistantClient(base_url=server.url, token='t', retries=2, backoff=0.01)
+            with mock.patch.object(client.session, 'post', side_effect=requests.ConnectionError('down')) as post:
+                with self.assertRaises(requests.ConnectionError):
+                    client.call_service('light', 'turn_on', {'entity_id': 'light.x'})
+
+        self.assertEqual(post.call_count, 1)
+
+    def test_per_endpoint_timeouts(self):
+        client = HomeAssistantClient(base_url='http://ha.invalid', token='t', timeouts={'services': 2})
+        self.assertEqual(client._timeout_for('states'), (3.05, 15))
+        self.assertEqual(client._timeout_for('states/light.x'), (3.05, 15))
+        self.assertEqual(client._timeout_for('services/light/turn_on'), 2)
+        self.assertEqual(client._timeout_for(''), (3.05, 5))
+
+
+class AsyncHomeAssistantClientTests(TestCase):
+    def test_fan_out_costs_about_one_round_trip(self):
+        latency = 0.05
+        calls = [('light', 'turn_on', {'entity_id': f'light.bulk_{i}'}) for i in range(50)]
+        with FakeHAHttpServer(latency=latency) as server:
+            client = AsyncHomeAssistantClient(base_url=server.url, token='t', concurrency=50)
+            loop = EventLoopThread()
+            # Warm up: event loop, client and TLS context creation are one-off costs
+            loop.run(client.get_states())
+            started = time.perf_counter()
+            results = loop.run(client.call_services_concurrently(calls))
+            elapsed = time.perf_counter() - started
+
+        self.assertEqual(results, [[]] * 50)
+        self.assertEqual(sorted(call[2]['entity_id'] for call in server.service_calls),
+                         sorted(call[2]['entity_id'] for call in calls))
+        # Serially this would take 50 x latency = 2.5 s
+        self.assertLess(elapsed, 10 * latency)
+
+    def test_concurrency_limit_and_failures(self):
+        async def fake_call(domain, service, service_data):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            if service_data['entity_id'] == 'light.bad':
+                raise ValueError('boom')
+            return []
+
+        in_flight = peak = 0
+        client = AsyncHomeAssistantClient(base_url='http://ha.invalid', token='t')
+        client.call_service = fake_call
+        calls = [('light', 'turn_on', {'entity_id': f'light.{i}'}) for i in range(20)]
+        calls[5] = ('light', 'turn_on', {'entity_id': 'light.bad'})
+
+        results = asyncio.run(client.call_services_concurrently(calls, limit=3))
+
+        self.assertEqual(peak, 3)
+        self.assertIsInstance(results[5], ValueError)
+        self.assertEqual(sum(1 for result in results if result == []), 19)
+
+
+class ServiceCallDispatcherTests(TestCase):
+    def test_groups_by_domain_service_and_data(self):
+        calls = [
+            ('light', 'turn_on', {'entity_id': 'light.a'}),
+            ('switch', 'turn_on', {'entity_id': 'switch.a'}),
+            ('light', 'turn_on', {'entity_id': 'light.b'}),
+            ('light', 'turn_on', {'entity_id': 'light.c', 'brightness': 100}),
+            ('light', 'turn_on', {'entity_id': ['light.a', 'light.d']}),
+            ('homeassistant', 'restart', None),
+        ]
+
+        self.assertEqual(group_service_calls(calls), [
+            (('light', 'turn_on', {'entity_id': ['light.a', 'light.b', 'light.d']}), [0, 2, 4]),
+            (('switch', 'turn_on', {'entity_id': 'switch.a'}), [1]),
+            (('light', 'turn_on', {'brightness': 100, 'entity_id': 'light.c'}), [3]),
+            (('homeassistant', 'restart', {}), [5]),
+        ])
+
+    def test_zone_toggle_is_one_request_per_domain(self):
+        calls = [('light', 'turn_off', {'entity_id': f'light.zone_{i}'}) for i in range(40)]
+        calls += [('switch', 'turn_off', {'entity_id': f'switch.zone_{i}'}) for i in range(5)]
+        with FakeHAHttpServer() as server, \
+                mock.patch('apps.core.services.ha_async_client.async_ha_client',
+                           AsyncHomeAssistantClient(base_url=server.url, token='t')):
+            results = dispatch_service_calls(calls)
+
+        self.assertEqual(server.requests, 2)
+        self.assertEqual(results, [[]] * 45)
+        self.assertEqual(sorted(server.service_calls[0][2]['entity_id'] + server.service_calls[1][2]['entity_id']),
+                         sorted(call[2]['entity_id'] for call in calls))
+
+
+class EntityRegistryCacheTests(TestCase):
+    def setUp(self):
+        self.registry = [
+            {'entity_id': f'light.luz_{i}', 'area_id': 'sala' if i % 2 else 'cocina', 'name': None}
+            for i in range(20)
+        ]
+        self.registry.append({'entity_id': 'sensor.sin_area', 'area_id': None, 'name': None})
+
+    def test_lookups_share_one_download(self):
+        with FakeHAHttpServer(registry=self.registry) as server:
+            client = HomeAssistantClient(base_url=server.url, token='t')
+            self.assertEqual(len(client.get_entities_in_area('sala')), 10)
+            self.assertEqual(len(client.get_entities_in_area('cocina')), 10)
+            self.assertEqual(client.get_entities_in_area('garaje'), [])
+            for entry in self.registry:
+                self.assertEqual(client.get_entity(entry['entity_id']), entry)
+            self.assertEqual(client.get_entity('light.unknown'), {})
+            self.assertEqual(server.requests, 1)
+
+            client.registry.invalidate()
+            client.get_entity('light.luz_0')
+            self.assertEqual(server.requests, 2)
+
+    def test_ttl_expiry_and_registry_events(self):
+        with FakeHAHttpServer(registry=self.registry) as server:
+            client = HomeAssistantClient(base_url=server.url, token='t')
+            client.registry.ttl = 0.05
+            client.get_entity('light.luz_0')
+            client.get_entity('light.luz_1')
+            time.sleep(0.06)
+            client.get_entity('light.luz_2')
+            self.assertEqual(server.requests, 2)
+
+            server.registry = [dict(self.registry[0], area_id='garaje')]
+            mirror = HAStateMirror()
+            mirror.add_event_listener('entity_registry_updated', client.registry.on_registry_updated)
+            mirror._handle_message({'type': 'event', 'event': {
+                'event_type': 'entity_registry_updated',
+                'data': {'action': 'update', 'entity_id': 'light.luz_0', 'changes': {'area_id': 'cocina'}},
+            }}, states_id=0)
+            self.assertEqual(client.get_entities_in_area('garaje'), ['light.luz_0'])
+
+
+@override_settings(CACHES={'ha_states': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'ha-states-tests'}})
+class SharedStateCacheTests(TestCase):
+    def setUp(self):
+        self.downloads = 0
+        self.states = [{'entity_id': 'light.a', 'state': 'off', 'attributes': {}}]
+
+    def tearDown(self):
+        caches['ha_states'].clear()
+
+    def _source(self):
+        self.downloads += 1
+        time.sleep(0.05)
+        return list(self.states)
+
+    def _worker_cache(self, **kwargs):
+        # One instance per simulated worker; they only share the cache backend
+        kwargs.setdefault('mirror', HAStateMirror())
+        return SharedStateCache(alias='ha_states', source=self._source, **kwargs)
+
+    def test_one_download_per_interval_regardless_of_workers(self):
+        workers = [self._worker_cache(refresh_interval=0.2) for _ in range(16)]
+
+        def poll(barrier, cache, results):
+            barrier.wait()
+            results.append(cache.get_states())
+
+        for _ in range(2):
+            barrier = threading.Barrier(len(workers))
+            results = []
+            threads = [threading.Thread(target=poll, args=(barrier, cache, results)) for cache in workers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(results, [self.states] * len(workers))
+
+        self.assertEqual(self.downloads, 1)
+        time.sleep(0.25)
+        for cache in workers:
+            cache.get_states()
+        self.assertEqual(self.downloads, 2)
+
+    def test_a_synced_mirror_is_read_directly(self):
+        mirror = HAStateMirror()
+        mirror.apply_snapshot(self.states)
+        with mock.patch.object(caches['ha_states'], 'get') as cache_get:
+            cache = self._worker_cache(mirror=mirror)
+            self.assertEqual(cache.get_states(), self.states)
+            self.assertEqual(list(cache.get_states_map()), ['light.a'])
+        cache_get.assert_not_called()
+        self.assertEqual(self.downloads, 0)
+
+    def test_version_and_etag_follow_content(self):
+        cache = self._worker_cache(refresh_interval=0)
+        first = cache.get_snapshot()
+        self.assertEqual(cache.get_snapshot()['version'], first['version'])
+
+        self.states = [{'entity_id': 'light.a', 'state': 'on', 'attributes': {}}]
+        second = cache.get_snapshot()
+        self.assertEqual(second['version'], first['version'] + 1)
+        self.assertNotEqual(second['etag'], first['etag'])
+        self.assertEqual(cache.get_etag(), second['etag'])
+
+    def test_database_cache_is_shared(self):
+        # The backend render.yaml configures (CACHE_URL=dbcache://nezu_cache)
+        database_cache = {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'nezu_cache'}
+        with override_settings(CACHES={'default': database_cache, 'ha_states': database_cache}):
+            call_command('createcachetable', verbosity=0)
+            self.assertEqual(check_shared_cache(None), [])
+            self.assertEqual(self._worker_cache().get_states(), self.states)
+            self.assertEqual(self._worker_cache().get_states(), self.states)
+        self.assertEqual(self.downloads, 1)
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertEqual([error.id for error in check_shared_cache(None)], ['core.W001'])
+
+
+class HAStateMirrorTests(TestCase):
+    def setUp(self):
+        self.states = load_ha_dump()
+        self.events = []
+        for state in self.states[:10]:
+            new_state = dict(state, state='on')
+            self.events.append({'entity_id': state['entity_id'], 'old_state': state, 'new_state': new_state})
+        # A removed entity arrives with new_state = None
+        self.events.append({'entity_id': self.states[10]['entity_id'], 'old_state': self.states[10], 'new_state': None})
+
+    def _wait_for_version(self, mirror, version):
+        done = threading.Event()
+        mirror.add_listener(lambda *args: mirror.version >= version and done.set())
+        if mirror.version < version:
+            done.wait(5)
+
+    def test_replays_recorded_stream(self):
+        with FakeHAWebSocketServer(self.states, self.events) as server:
+            mirror = HAStateMirror(url=server.url, token='test-token')
+            mirror.start()
+            try:
+                self.assertTrue(mirror.wait_until_ready(5))
+                snapshot_version = len(self.states)
+                self._wait_for_version(mirror, snapshot_version + len(self.events))
+
+                states = mirror.get_states_map()
+                self.assertEqual(len(states), len(self.states) - 1)
+                for state in self.states[:10]:
+                    self.assertEqual(states[state['entity_id']]['state'], 'on')
+                self.assertNotIn(self.states[10]['entity_id'], states)
+
+                changed = mirror.changed_since(snapshot_version)
+                self.assertEqual(len(changed), 11)
+                self.assertIsNone(changed[self.states[10]['entity_id']])
+            finally:
+                mirror.stop()
+
+    def test_rejected_token_never_becomes_ready(self):
+        with FakeHAWebSocketServer(self.states, []) as server:
+            mirror = HAStateMirror(url=server.url, token='wrong', reconnect_delay=0.1)
+            mirror.start()
+            try:
+                self.assertFalse(mirror.wait_until_ready(0.5))
+                self.assertGreaterEqual(server.connections, 1)
+            finally:
+                mirror.stop()
+
+    def test_listeners_receive_old_and_new_state(self):
+        mirror = HAStateMirror()
+        seen = []
+        mirror.add_listener(lambda entity_id, old, new, version: seen.append((entity_id, old, new, version)))
+
+        mirror.apply_snapshot([{'entity_id': 'light.a', 'state': 'off', 'attributes': {}}])
+        mirror.apply_snapshot([{'entity_id': 'light.a', 'state': 'off', 'attributes': {}}])
+        mirror.apply_event({'data': {
+            'entity_id': 'light.a',
+            'new_state': {'entity_id': 'light.a', 'state': 'on', 'attributes': {}},
+        }})
+
+        self.assertEqual([(entity_id, version) for entity_id, _, _, version in seen], [('light.a', 1), ('light.a', 2)])
+        self.assertEqual(seen[1][1]['state'], 'off')
+        self.assertEqual(seen[1][2]['state'], 'on')
+
+
+@override_settings(HOMEASSISTANT_STATE_MIRROR_ENABLED=False)
+class DeviceReconcilerTests(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(
+            name='Acuario', type='light', room='', entity_id='light.ingreso_switch_1', ha_domain='light'
+        )
+        self.mirror = HAStateMirror()
+        self.mirror.apply_snapshot([{'entity_id': 'light.ingreso_switch_1', 'state': 'off', 'attributes': {}}])
+        self.reconciler = DeviceReconciler(mirror=self.mirror)
+        self.mirror.add_listener(self.reconciler.on_state_changed)
+
+    def test_list_is_a_pure_read(self):
+        self.mirror.apply_event({'data': {
+            'entity_id': 'light.ingreso_switch_1',
+            'new_state': {'entity_id': 'light.ingreso_switch_1', 'state': 'on', 'attributes': {}},
+        }})
+        with mock.patch('apps.core.services.ha_client.ha_client.get_states') as get_states, \
+                CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/devices/')
+
+        get_states.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        # ETag counters, device table summary, rows; no writes
+        self.assertEqual([query['sql'].split()[0] for query in queries.captured_queries], ['SELECT'] * 3)
+        self.assertFalse(response.json()[0]['isOn'])
+
+    def test_flush_applies_only_pending_entities(self):
+        self.mirror.apply_event({'data': {
+            'entity_id': 'light.ingreso_switch_1',
+            'new_state': {'entity_id': 'light.ingreso_switch_1', 'state': 'on', 'attributes': {}},
+        }})
+
+        self.assertEqual(self.reconciler.flush_pending(), 1)
+        self.assertEqual(self.reconciler.flush_pending(), 0)
+        self.device.refresh_from_db()
+        self.assertTrue(self.device.is_on)
+
+    def test_one_worker_holds_the_lease(self):
+        self.addCleanup(caches['default'].delete, DeviceReconciler.LEASE_KEY)
+        other_worker = DeviceReconciler(mirror=self.mirror)
+        self.assertTrue(self.reconciler._hold_lease())
+        self.assertFalse(other_worker._hold_lease())
+        # Renewals keep it; releasing it lets the other worker take over
+        self.assertTrue(self.reconciler._hold_lease())
+        self.reconciler._release_lease()
+        self.assertTrue(other_worker._hold_lease())
+        self.assertFalse(self.reconciler._hold_lease())
+
+
+class DeviceSyncEngineTests(TestCase):
+    def _states(self, count, state='off'):
+        return {
+            f'light.bulk_{i}': {'entity_id': f'light.bulk_{i}', 'state': state, 'attributes': {'friendly_name': f'Bulk {i}'}}
+            for i in range(count)
+        }
+
+    def test_initial_sync_creates_devices(self):
+        states = self._states(20)
+        states['automation.ignored'] = {'entity_id': 'automation.ignored', 'state': 'on', 'attributes': {}}
+
+        summary = DeviceSyncEngine().sync(states)
+
+        self.assertEqual(summary, {'new': 20, 'updated': 0, 'removed': 0})
+        device = Device.objects.get(entity_id='light.bulk_3')
+        self.assertEqual((device.name, device.ha_domain, device.room), ('Bulk 3', 'light', ''))
+        self.assertEqual(device.attributes['friendly_name'], 'Bulk 3')
+
+    def test_steady_state_is_a_single_select(self):
+        states = self._states(1000)
+        DeviceSyncEngine().sync(states)
+
+        with self.assertNumQueries(1):
+            summary = DeviceSyncEngine().sync(states)
+        self.assertEqual(summary, {'new': 0, 'updated': 0, 'removed': 0})
+
+    def test_query_count_does_not_grow_with_entity_count(self):
+        for count in (100, 1000):
+            with self.subTest(count=count):
+                Device.objects.all().delete()
+                states = self._states(count)
+                DeviceSyncEngine().sync(states)
+
+                # 50 toggled, 10 removed from HA, 20 new in HA
+                for i in range(50):
+                    states[f'light.bulk_{i}'] = dict(states[f'light.bulk_{i}'], state='on')
+                for i in range(count - 10, count):
+                    del states[f'light.bulk_{i}']
+                states.update({
+                    f'switch.new_{i}': {'entity_id': f'switch.new_{i}', 'state': 'on', 'attributes': {}}
+                    for i in range(20)
+                })
+
+                # SELECT, SAVEPOINT, INSERT, UPDATE, tombstones INSERT, DELETE, RELEASE
+                with self.assertNumQueries(7):
+                    summary = DeviceSyncEngine().sync(states)
+
+                self.assertEqual(summary, {'new': 20, 'updated': 50, 'removed': 10})
+                self.assertEqual(Device.objects.filter(is_on=True).count(), 70)
+                self.assertEqual(Device.objects.count(), count + 10)
+
+    def test_sync_does_not_echo_commands_to_ha(self):
+        states = self._states(5)
+        DeviceSyncEngine().sync(states)
+        states['light.bulk_0'] = dict(states['light.bulk_0'], state='on')
+
+        with mock.patch('apps.devices.signals.ha_client') as signal_client:
+            DeviceSyncEngine().sync(states)
+
+        signal_client.call_service.assert_not_called()
+        self.assertTrue(Device.objects.get(entity_id='light.bulk_0').is_on)
+
+
+@mock.patch('apps.devices.signals.ha_client')
+class SyncHaDevicesCommandTests(TestCase):
+    @mock.patch('apps.devices.management.commands.sync_ha_devices.ha_client')
+    def test_adds_and_updates_without_deleting(self, ha, signals_ha):
+        from apps.rooms.models import Room
+        from apps.users.models import User
+        user = User.objects.create_user(username='owner', password='x')
+        kept = Device.objects.create(name='Vieja', type='light', room='Sala', entity_id='light.vieja')
+        placed = Device.objects.create(name='Mesa', type='light', room='', entity_id='light.mesa',
+                                       room_obj=Room.objects.create(name='Comedor', user=user))
+        ha.get_states.return_value = [
+            {'entity_id': 'light.nueva', 'state': 'on', 'attributes': {'friendly_name': 'Nueva'}},
+            {'entity_id': 'light.mesa', 'state': 'on', 'attributes': {}},
+        ]
+        ha.render_template.return_value = '{"light.nueva": "Cocina", "light.mesa": "Sin Asignar"}'
+
+        call_command('sync_ha_devices', stdout=io.StringIO())
+
+        # Devices missing from HA stay; rooms come from HA areas unless set in the app
+        self.assertTrue(Device.objects.filter(pk=kept.pk).exists())
+        self.assertEqual(Device.objects.get(entity_id='light.nueva').room, 'Cocina')
+        placed.refresh_from_db()
+        self.assertEqual((placed.room, placed.is_on), ('Comedor', True))
+
+
+@mock.patch('apps.devices.signals.ha_client')
+class DeviceChangeTrackingTests(TestCase):
+    def setUp(self):
+        from apps.rooms.models import Room
+        from apps.users.models import User
+        self.user = User.objects.create_user(username='owner', password='x')
+        self.room = Room.objects.create(name='Sala', user=self.user)
+        self.devices = [
+            Device.objects.create(
+                name=f'Luz {i}', type='light', room='', room_obj=self.room,
+                entity_id=f'light.luz_{i}', ha_domain='light',
+            )
+            for i in range(10)
+        ]
+
+    def test_snapshot_tracks_changes(self, ha):
+        device = Device.objects.get(pk=self.devices[0].pk)
+        self.assertEqual(device.changed_fields, [])
+        device.is_on = True
+        self.assertTrue(device.has_changed('is_on'))
+        self.assertFalse(device.has_changed('name'))
+        device.save()
+        self.assertEqual(device.changed_fields, [])
+
+    def test_toggle_device_skips_previous_state_select(self, ha):
+        # SELECT device + UPDATE
+        with self.assertNumQueries(2):
+            DeviceService.toggle_device(self.devices[0].pk, True)
+        ha.call_service.assert_called_once_with('light', 'turn_on', {'entity_id': 'light.luz_0'})
+
+    def test_batch_toggle_query_count(self, ha):
+        ids = [str(device.pk) for device in self.devices]
+        # SELECT devices (with rooms) + a single UPDATE
+        with mock.patch('apps.core.services.ha_dispatcher.call_services_concurrently', return_value=[[]]) as fan_out, \
+                self.assertNumQueries(2):
+            response = self.client.post('/api/devices/batch_toggle/', {'ids': ids, 'isOn': True}, content_type='application/json')
+
+        self.assertEqual([device['id'] for device in response.json()], [device.pk for device in self.devices])
+        self.assertTrue(all(device['isOn'] for device in response.json()))
+        # All ten lights go out as one multi-entity call
+        self.assertEqual(fan_out.call_args[0][0], [
+            ('light', 'turn_on', {'entity_id': [device.entity_id for device in self.devices]}),
+        ])
+        ha.call_service.assert_not_called()
+
+    def test_unchanged_save_sends_nothing_to_ha(self, ha):
+        device = Device.objects.get(pk=self.devices[0].pk)
+        device.value = '42'
+        device.save()
+        ha.call_service.assert_not_called()
+        ha.update_entity_name.assert_not_called()
+
+    def test_rename_and_room_change(self, ha):
+        from apps.rooms.models import Room
+        other_room = Room.objects.create(name='Cocina', user=self.user)
+        device = Device.objects.get(pk=self.devices[0].pk)
+        device.name = 'Lámpara'
+        device.room_obj = other_room
+        device.save()
+
+        ha.update_entity_name.assert_called_once_with('light.luz_0', 'Lámpara')
+        ha.call_service.assert_not_called()
+        device.refresh_from_db()
+        self.assertEqual((device.room, device.attributes['friendly_name']), ('Cocina', 'Lámpara'))
+
+
+@override_settings(DEVICE_VERSION_OVERLAP=0)
+@mock.patch('apps.devices.signals.ha_client')
+class DeviceDeltaListTests(TestCase):
+    def setUp(self):
+        self.devices = [
+            Device.objects.create(name=f'Luz {i}', type='light', room='', entity_id=f'light.luz_{i}', ha_domain='light')
+            for i in range(5)
+        ]
+
+    def _changes(self, since):
+        response = self.client.get('/api/devices/', {'since': since})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_since_returns_only_changed_rows_and_tombstones(self, ha):
+        full = self._changes(0)
+        self.assertEqual(len(full['devices']), 5)
+        version = full['version']
+        self.assertEqual(self._changes(version), {'devices': [], 'deleted': [], 'version': version, 'reset': False})
+
+        DeviceService.toggle_device(self.devices[0].pk, True)
+        self.client.patch(f'/api/devices/{self.devices[1].pk}/', {'name': 'Lámpara'}, content_type='application/json')
+        self.client.delete(f'/api/devices/{self.devices[2].pk}/')
+
+        changes = self._changes(version)
+        self.assertEqual(sorted(device['id'] for device in changes['devices']), [self.devices[0].pk, self.devices[1].pk])
+        self.assertEqual(changes['deleted'], [self.devices[2].pk])
+        self.assertGreater(changes['version'], version)
+        self.assertEqual(self._changes(changes['version'])['devices'], [])
+
+    def test_bulk_writes_bump_versions(self, ha):
+        version = self._changes(0)['version']
+        with mock.patch('apps.devices.services.dispatch_service_calls', return_value=[]):
+            DeviceService.set_power_many(self.devices[:2], True)
+        states = {
+            device.entity_id: {'entity_id': device.entity_id, 'state': 'on', 'attributes': {}}
+            for device in self.devices[2:4]
+        }
+        DeviceSyncEngine(create=False, delete=False).sync(states, [device.entity_id for device in self.devices[2:4]])
+
+        changes = self._changes(version)
+        self.assertEqual(sorted(device['id'] for device in changes['devices']), [device.pk for device in self.devices[:4]])
+        self.assertTrue(all(device['isOn'] for device in changes['devices']))
+
+    def test_unchanged_list_is_a_304_without_serialization(self, ha):
+        first = self.client.get('/api/devices/')
+        etag = first['ETag']
+
+        # Device table + rooms counter
+        with self.assertNumQueries(2), \
+                mock.patch('apps.devices.views.DeviceSerializer.to_representation') as to_representation:
+            response = self.client.get('/api/devices/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        to_representation.assert_not_called()
+
+        # since= responses are tagged separately
+        self.assertNotEqual(self.client.get('/api/devices/', {'since': 0})['ETag'], etag)
+
+        DeviceService.toggle_device(self.devices[0].pk, True)
+        response = self.client.get('/api/devices/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_plain_list_is_unchanged(self, ha):
+        response = self.client.get('/api/devices/')
+        self.assertEqual(len(response.json()), 5)
+        self.assertEqual(self.client.get('/api/devices/', {'since': 'x'}).status_code, 400)
+
+    def test_unsettled_writes_are_sent_again(self, ha):
+        version = self._changes(0)['version']
+        with override_settings(DEVICE_VERSION_OVERLAP=60):
+            DeviceService.toggle_device(self.devices[0].pk, True)
+            etag = self.client.get('/api/devices/')['ETag']
+            self.assertEqual(self.client.get('/api/devices/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            # A write committing late, with a version older than the one seen
+            late = Device.objects.get(pk=self.devices[0].pk).version - 1
+            Device.objects.filter(pk=self.devices[1].pk).update(is_on=True, version=late)
+            self.assertEqual(self.client.get('/api/devices/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+            Device.objects.filter(pk=self.devices[1].pk).update(is_on=False, version=0)
+
+            changes = self._changes(version)
+            # Still sent after being seen once: an older write may be committing
+            self.assertEqual([device['id'] for device in changes['devices']], [self.devices[0].pk])
+            self.assertEqual(changes['version'], version)
+        self.assertEqual(self._changes(version)['version'], Device.objects.get(pk=self.devices[0].pk).version)
+
+    def test_old_since_gets_the_full_list(self, ha):
+        self.client.delete(f'/api/devices/{self.devices[0].pk}/')
+        DeviceTombstone.objects.update(version=1)
+        self.assertEqual(DeviceTombstone.prune(), 1)
+
+        changes = self._changes(2)
+        self.assertTrue(changes['reset'])
+        self.assertEqual(len(changes['devices']), 4)
+
+    def test_versions_increase(self, ha):
+        versions = [next_version() for _ in range(1000)]
+        self.assertEqual(versions, sorted(set(versions)))
+
+
+@mock.patch('apps.devices.signals.ha_client')
+class DeviceStreamTests(TestCase):
+    def setUp(self):
+        self.mirror = HAStateMirror()
+        self.bus = DeviceEventBus(buffer_size=5, mirror=self.mirror)
+        self.mirror.add_listener(self.bus.on_state_changed)
+        patcher = mock.patch('apps.devices.signals.device_events', self.bus)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.devices = [
+            Device.objects.create(name=f'Luz {i}', type='light', room='', entity_id=f'light.luz_{i}', ha_domain='light')
+            for i in range(3)
+        ]
+
+    def _read_stream(self, last_event_id=None):
+        headers = {'HTTP_LAST_EVENT_ID': last_event_id} if last_event_id else {}
+        with mock.patch('apps.devices.views.device_events', self.bus), \
+                override_settings(DEVICE_STREAM_MAX_AGE=0):
+            response = self.client.get('/api/devices/stream/', HTTP_ACCEPT='text/event-stream', **headers)
+            body = b''.join(response.streaming_content).decode()
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        messages = []
+        for block in body.strip().split('\n\n'):
+            fields = dict(line.split(': ', 1) for line in block.splitlines() if ': ' in line)
+            if 'event' in fields:
+                messages.append((fields.get('id'), fields['event'], json.loads(fields['data'])))
+        return messages
+
+    def test_deltas_only_carry_changed_fields(self, ha):
+        device = self.devices[0]
+        start = self.bus.seq
+        device.name = 'Lámpara'
+        device.save()
+        self.mirror.apply_event({'data': {
+            'entity_id': 'light.luz_1',
+            'new_state': {'entity_id': 'light.luz_1', 'state': 'on', 'attributes': {}},
+        }})
+        # Unknown entities and unchanged devices produce nothing
+        self.mirror.apply_event({'data': {'entity_id': 'sensor.x', 'new_state': {'entity_id': 'sensor.x', 'state': '1'}}})
+        device.save()
+
+        events = self.bus.events_since(start)
+        self.assertEqual([(event['id'], sorted(event['fields'])) for event in events], [
+            (device.pk, ['attributes', 'name']),
+            (self.devices[1].pk, ['isOn', 'unit', 'value']),
+        ])
+        self.assertEqual(events[1]['fields']['isOn'], True)
+
+    def test_snapshot_then_replay_from_last_event_id(self, ha):
+        messages = self._read_stream()
+        self.assertEqual([event for _, event, _ in messages], ['snapshot'])
+        event_id, _, snapshot = messages[0]
+        self.assertEqual(len(snapshot['devices']), 3)
+
+        DeviceService.toggle_device(self.devices[2].pk, True)
+        messages = self._read_stream(last_event_id=event_id)
+        self.assertEqual(messages, [
+            (self.bus.event_id(self.bus.seq), 'delta',
+             {'type': 'delta', 'id': self.devices[2].pk, 'fields': {'isOn': True}, 'version': self.bus.seq}),
+        ])
+
+    def test_unknown_or_expired_event_id_gets_a_snapshot(self, ha):
+        first_id = self.bus.event_id(self.bus.seq)
+        for i in range(1, 7):
+            self.devices[0].name = f'Luz {i}'
+            self.devices[0].save()
+
+        self.assertIsNone(self.bus.events_since(self.bus.parse_event_id(first_id)))
+        for last_event_id in (first_id, 'deadbeef-1'):
+            self.assertEqual([event for _, event, _ in self._read_stream(last_event_id)], ['snapshot'])
+
+    def test_streams_are_capped_per_worker(self, ha):
+        with mock.patch('apps.devices.views.device_events', self.bus), \
+                override_settings(DEVICE_STREAM_MAX_CONNECTIONS=1, DEVICE_STREAM_MAX_AGE=0):
+            open_stream = self.client.get('/api/devices/stream/', HTTP_ACCEPT='text/event-stream')
+            refused = self.client.get('/api/devices/stream/', HTTP_ACCEPT='text/event-stream')
+            self.assertEqual((refused.status_code, refused['Retry-After']), (503, '60'))
+
+            # Closing a stream gives its thread back
+            open_stream.close()
+            reopened = self.client.get('/api/devices/stream/', HTTP_ACCEPT='text/event-stream')
+            self.assertEqual(reopened.status_code, 200)
+            reopened.close()
+        self.assertEqual(stream_slots.active, 0)
+
+    def test_waiting_reader_is_woken_by_publish(self, ha):
+        seq = self.bus.seq
+        threading.Timer(0.05, lambda: self.bus.publish_removed(self.devices[0].pk)).start()
+        events = self.bus.wait_for_events(seq, timeout=5)
+        self.assertEqual(events, [{'type': 'delta', 'id': self.devices[0].pk, 'removed': True, 'version': seq + 1}])
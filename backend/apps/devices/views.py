@@ -1,39 +1,135 @@
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, StreamingHttpResponse
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.renderers import BaseRenderer
 from rest_framework.response import Response
-from .models import Device
+from .events import device_events
+from apps.core.mixins import ConditionalListMixin
+from .models import Device, DeviceTombstone, settled_version
 from .serializers import DeviceSerializer
-from apps.core.services.ha_client import ha_client
-from .services import DeviceService
+from apps.core.services.ha_state_cache import state_cache
+from .services import DeviceService, DeviceSyncEngine
 from datetime import datetime
 
-class DeviceViewSet(viewsets.ModelViewSet):
+class EventStreamRenderer(BaseRenderer):
+    """Lets content negotiation accept `Accept: text/event-stream` (EventSource)"""
+    media_type = 'text/event-stream'
+    format = 'sse'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
+
+
+def sse_message(event, data, event_id=None):
+    lines = []
+    if event_id:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, default=str)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+class StreamSlots:
+    """
+    Caps the SSE streams one worker serves at once (DEVICE_STREAM_MAX_CONNECTIONS):
+    each open stream holds a request thread, so without a cap a handful of
+    dashboard tabs could starve every other request, Alexa directives included.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.active = 0
+
+    def acquire(self) -> bool:
+        with self._lock:
+            if self.active >= getattr(settings, 'DEVICE_STREAM_MAX_CONNECTIONS', 4):
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+
+class SlotStream:
+    """Iterator for StreamingHttpResponse that gives its slot back when the response is closed"""
+
+    def __init__(self, events, slots):
+        self.events = events
+        self.slots = slots
+        self._released = False
+
+    def __iter__(self):
+        return self.events
+
+    def close(self):
+        self.events.close()
+        if not self._released:
+            self._released = True
+            self.slots.release()
+
+
+stream_slots = StreamSlots()
+
+
+class DeviceViewSet(ConditionalListMixin, viewsets.ModelViewSet):
+    # list is a pure read: HA state is applied by apps.devices.reconciler
     queryset = Device.objects.all()
     serializer_class = DeviceSerializer
+    # room_name follows Room renames and deletions
+    etag_counters = ('rooms',)
+
+    def get_etag_parts(self, request):
+        return [Device.etag_part()]
 
     def list(self, request, *args, **kwargs):
-        # Sync with Home Assistant before listing
+        """
+        Without parameters: every device, as before.
+        With ?since=<version>: {"devices": rows written after that version,
+        "deleted": ids of devices deleted after it, "version": the `since`
+        to send next time, "reset": true when `devices` is the full list
+        (since=0, or a `since` older than the kept tombstones)}.
+        """
+        since = request.query_params.get('since')
+        if since is None:
+            return super().list(request, *args, **kwargs)
         try:
-            ha_states = ha_client.get_states()
-            # Create a lookup dict for faster access: {entity_id: state_obj}
-            ha_states_map = {state['entity_id']: state for state in ha_states}
-            
-            devices = self.get_queryset()
-            updated_count = 0
-            
-            for device in devices:
-                if DeviceService.sync_device_from_ha(device, ha_states_map):
-                    updated_count += 1
-                        
-            if updated_count > 0:
-                print(f"Synced {updated_count} devices from Home Assistant")
-                
-        except Exception as e:
-            print(f"Error syncing with HA during list: {e}")
-            # Continue even if sync fails, returning cached data
-            
-        return super().list(request, *args, **kwargs)
+            since = int(since)
+        except ValueError:
+            return Response({"error": "since must be an integer"}, status=400)
+
+        def changes():
+            devices = self.filter_queryset(self.get_queryset())
+            tombstones = []
+            reset = since < DeviceTombstone.retention_version()
+            if not reset:
+                devices = devices.filter(version__gt=since)
+                tombstones = list(DeviceTombstone.objects.filter(version__gt=since).values_list('device_id', 'version'))
+            devices = list(devices)
+
+            # The newest version seen, held back to the settled one: a write
+            # still committing with an older version is sent next time
+            # (again, if it was seen already) instead of being skipped
+            newest = max([device.version for device in devices] + [version for _, version in tombstones], default=0)
+            version = max(since, min(newest, settled_version()))
+            return Response({
+                'devices': self.get_serializer(devices, many=True).data,
+                'deleted': [device_id for device_id, _ in tombstones],
+                'version': version,
+                'reset': reset,
+            })
+
+        return self.conditional_response(request, changes)
 
+    def perform_destroy(self, instance):
+        DeviceService.delete_devices(Device.objects.filter(pk=instance.pk))
 
     @action(detail=False, methods=['post'])
     def batch_toggle(self, request):
@@ -47,16 +143,78 @@ class DeviceViewSet(viewsets.ModelViewSet):
         if not ids:
             return Response({"error": "No ids provided"}, status=400)
             
-        updated_devices = []
-        
-        for device_id in ids:
-            try:
-                device = DeviceService.toggle_device(device_id, is_on)
-                updated_devices.append(DeviceSerializer(device).data)
-            except Exception as e:
-                print(f"Error toggling device {device_id} in batch: {e}")
+        devices = {
+            str(device.id): device
+            for device in Device.objects.select_related('room_obj').filter(id__in=ids)
+        }
+        missing = [device_id for device_id in ids if str(device_id) not in devices]
+        if missing:
+            print(f"Devices not found in batch toggle: {missing}")
+
+        found = [devices[str(device_id)] for device_id in ids if str(device_id) in devices]
+        DeviceService.set_power_many(found, is_on)
                 
-        return Response(updated_devices)
+        return Response(DeviceSerializer(found, many=True).data)
+
+    @action(detail=False, methods=['get'], renderer_classes=[EventStreamRenderer])
+    def stream(self, request):
+        """
+        Server-Sent Events feed of device changes.
+        Sends a `snapshot` event with every device, then one `delta` event
+        ({id, fields, version} or {id, removed}) per change. Reconnecting
+        with Last-Event-ID replays only the missed deltas when possible.
+        The stream ends after DEVICE_STREAM_MAX_AGE seconds; EventSource
+        reconnects by itself. Past DEVICE_STREAM_MAX_CONNECTIONS open streams
+        the answer is a 503, and clients fall back to ?since= polling.
+        """
+        if not stream_slots.acquire():
+            response = HttpResponse(status=503)
+            response['Retry-After'] = 60
+            return response
+
+        last_event_id = request.headers.get('Last-Event-ID') or request.query_params.get('lastEventId')
+        last_seq = device_events.parse_event_id(last_event_id)
+        max_age = getattr(settings, 'DEVICE_STREAM_MAX_AGE', 300)
+        heartbeat = getattr(settings, 'DEVICE_STREAM_HEARTBEAT', 15)
+
+        def snapshot():
+            # Take the position first: changes racing the query are replayed, not lost
+            seq = device_events.seq
+            devices = Device.objects.select_related('room_obj')
+            data = {'devices': DeviceSerializer(devices, many=True).data, 'version': seq}
+            # Don't pin a DB connection for the lifetime of the stream
+            connection.close()
+            return seq, sse_message('snapshot', data, device_events.event_id(seq))
+
+        def events():
+            seq = last_seq
+            missed = device_events.events_since(seq) if seq is not None else None
+            yield 'retry: 3000\n\n'
+            if missed is None:
+                seq, message = snapshot()
+                yield message
+            else:
+                for event in missed:
+                    seq = event['version']
+                    yield sse_message('delta', event, device_events.event_id(seq))
+
+            deadline = time.monotonic() + max_age
+            while time.monotonic() < deadline:
+                new_events = device_events.wait_for_events(seq, timeout=heartbeat)
+                if new_events is None:
+                    seq, message = snapshot()
+                    yield message
+                elif new_events:
+                    for event in new_events:
+                        seq = event['version']
+                        yield sse_message('delta', event, device_events.event_id(seq))
+                else:
+                    yield ': keep-alive\n\n'
+
+        response = StreamingHttpResponse(SlotStream(events(), stream_slots), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
 
     @action(detail=False, methods=['post'])
     def sync(self, request):
@@ -66,56 +224,9 @@ class DeviceViewSet(viewsets.ModelViewSet):
         """
         try:
             # Get all devices from Home Assistant
-            ha_states = ha_client.get_states()
-            ha_states_map = {state['entity_id']: state for state in ha_states}
-            
-            # Get current devices in our database
-            existing_devices = {device.entity_id: device for device in Device.objects.all()}
-            
-            new_count = 0
-            updated_count = 0
-            removed_count = 0
-            
-            # Check for new and updated devices
-            for entity_id, ha_state in ha_states_map.items():
-                # Supported domains
-                domain = entity_id.split('.')[0]
-                if domain not in ['light', 'switch', 'sensor', 'binary_sensor', 'climate', 'lock']:
-                    # print(f"Skipping unsupported domain: {domain} for {entity_id}")
-                    continue
-                    
-                if entity_id in existing_devices:
-                    # Update existing device
-                    device = existing_devices[entity_id]
-                    if DeviceService.sync_device_from_ha(device, ha_states_map):
-                        updated_count += 1
-                else:
-                    # Create new device
-                    try:
-                        attributes = ha_state.get('attributes', {})
-                        device_type = domain
-                        if domain == 'binary_sensor':
-                            device_type = 'sensor'
-                            
-                        Device.objects.create(
-                            entity_id=entity_id,
-                            name=attributes.get('friendly_name', entity_id),
-                            type=device_type,
-                            is_on=ha_state.get('state') not in ['off', 'unavailable', 'unknown', 'closed', 'locked'],
-                            is_online=ha_state.get('state') not in ['unavailable', 'unknown'],
-                            # Ignore HA area, set as Unassigned for Nezu control
-                            room='' 
-                        )
-                        new_count += 1
-                    except Exception as e:
-                        print(f"Error creating device {entity_id}: {e}")
+            ha_states_map = state_cache.get_states_map()
             
-            # Check for removed devices (devices in DB but not in HA)
-            ha_entity_ids = set(ha_states_map.keys())
-            for entity_id, device in existing_devices.items():
-                if entity_id not in ha_entity_ids:
-                    device.delete()
-                    removed_count += 1
+            summary = DeviceSyncEngine().sync(ha_states_map)
             
             # Get updated device list
             devices = Device.objects.all()
@@ -126,9 +237,9 @@ class DeviceViewSet(viewsets.ModelViewSet):
                 'timestamp': datetime.now().isoformat(),
                 'summary': {
                     'total': len(devices),
-                    'new': new_count,
-                    'updated': updated_count,
-                    'removed': removed_count
+                    'new': summary['new'],
+                    'updated': summary['updated'],
+                    'removed': summary['removed']
                 },
                 'devices': serialized_devices
             })
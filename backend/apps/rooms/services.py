@@ -107,6 +107,9 @@ class RoomSyncService:
         }
         
         try:
+            # Start from a fresh registry; per-area lookups below hit the cache
+            ha_client.registry.invalidate()
+
             # Get all areas from Home Assistant
             ha_areas = ha_client.get_areas()
             
@@ -1,6 +1,11 @@
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from .models import Room
+from apps.core.models import ChangeCounter
+from .models import Room, Zone
+
+# ETag counters for the room and zone lists
+ChangeCounter.track(Room, 'rooms')
+ChangeCounter.track(Zone, 'zones')
 
 
 @receiver(post_save, sender=Room)
@@ -1,3 +1,114 @@
+from unittest import mock
+
+from django.db import transaction
 from django.test import TestCase
 
-# Create your tests here.
+from apps.core.models import ChangeCounter
+from apps.core.services.ha_client import HomeAssistantClient
+from apps.devices.models import Device, next_version
+from apps.users.models import User
+from .models import Room, Zone
+from .services import RoomSyncService
+
+
+class RoomSyncServiceTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', password='x')
+        self.areas = [{'area_id': f'area_{a}', 'name': f'Area {a}'} for a in range(5)]
+        self.registry = []
+        for a in range(5):
+            for i in range(4):
+                entity_id = f'light.area_{a}_{i}'
+                self.registry.append({'entity_id': entity_id, 'area_id': f'area_{a}'})
+                Device.objects.create(name=entity_id, type='light', room='', entity_id=entity_id, user=self.user)
+
+    @mock.patch('apps.devices.signals.ha_client')
+    def test_registry_is_downloaded_once_per_sync(self, signals_ha):
+        client = HomeAssistantClient(base_url='http://ha.invalid', token='t')
+        with mock.patch.object(client, 'get_areas', return_value=self.areas), \
+                mock.patch.object(client, 'list_entity_registry', return_value=self.registry) as list_registry:
+            stats = RoomSyncService.sync_areas_from_ha(client, self.user)
+            room = Room.objects.get(ha_area_id='area_0')
+            device = Device.objects.get(entity_id='light.area_0_0')
+            device.room_obj = None
+            RoomSyncService.sync_device_area(client, device, self.user)
+
+        self.assertEqual(list_registry.call_count, 1)
+        self.assertEqual((stats['created'], stats['devices_assigned']), (5, 20))
+        self.assertEqual(device.room_obj, room)
+
+
+class ConditionalListTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='owner', password='x')
+        self.other = User.objects.create_user(username='other', password='x')
+        self.zone = Zone.objects.create(name='Planta baja', user=self.owner)
+        self.room = Room.objects.create(name='Sala', user=self.owner, zone=self.zone)
+
+    def _get(self, url, user, etag=None):
+        self.client.force_login(user)
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(url, **headers)
+
+    def test_etag_is_per_user(self):
+        etag = self._get('/api/rooms/', self.owner)['ETag']
+        self.assertEqual(self._get('/api/rooms/', self.owner, etag).status_code, 304)
+
+        response = self._get('/api/rooms/', self.other, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [])
+
+    @mock.patch('apps.devices.signals.ha_client')
+    def test_dependent_tables_invalidate(self, signals_ha):
+        rooms_etag = self._get('/api/rooms/', self.owner)['ETag']
+        zones_etag = self._get('/api/zones/', self.owner)['ETag']
+
+        # deviceCount changes when a device joins the room
+        with self.captureOnCommitCallbacks(execute=True):
+            Device.objects.create(name='Luz', type='light', room='', room_obj=self.room, entity_id='light.luz')
+        self.assertEqual(self._get('/api/rooms/', self.owner, rooms_etag).status_code, 200)
+        self.assertEqual(self._get('/api/zones/', self.owner, zones_etag).status_code, 304)
+
+        self.zone.name = 'Primer piso'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.zone.save()
+        self.assertEqual(self._get('/api/zones/', self.owner, zones_etag).status_code, 200)
+
+    def test_counters_are_bumped_once_per_transaction(self):
+        before = ChangeCounter.values(['rooms', 'zones'])
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                for name in ('Sala', 'Comedor', 'Cocina'):
+                    self.room.name = name
+                    self.room.save()
+                self.zone.save()
+                # Nothing is written (or locked) until commit
+                self.assertEqual(ChangeCounter.values(['rooms', 'zones']), before)
+        after = ChangeCounter.values(['rooms', 'zones'])
+        self.assertEqual(after, {'rooms': before['rooms'] + 1, 'zones': before['zones'] + 1})
+
+    @mock.patch('apps.devices.signals.ha_client')
+    def test_only_room_membership_invalidates_rooms(self, signals_ha):
+        device = Device.objects.create(name='Luz', type='light', room='', room_obj=self.room, entity_id='light.luz')
+        rooms_etag = self._get('/api/rooms/', self.owner)['ETag']
+
+        # State writes (toggles, the reconciler) leave deviceCount alone
+        device.is_on = True
+        device.save(update_fields=['is_on'])
+        Device.objects.filter(pk=device.pk).update(value='21', version=next_version())
+        self.assertEqual(self._get('/api/rooms/', self.owner, rooms_etag).status_code, 304)
+
+        device.room_obj = None
+        with self.captureOnCommitCallbacks(execute=True):
+            device.save(update_fields=['room_obj'])
+        self.assertEqual(self._get('/api/rooms/', self.owner, rooms_etag).status_code, 200)
+
+    @mock.patch('apps.devices.signals.ha_client')
+    def test_deleted_rooms_detach_their_devices(self, signals_ha):
+        device = Device.objects.create(name='Luz', type='light', room='', room_obj=self.room, entity_id='light.luz')
+        version = device.version
+        self.room.delete()
+        device.refresh_from_db()
+        self.assertEqual((device.room_obj, device.room), (None, ''))
+        # ?since= readers see the move
+        self.assertGreater(device.version, version)
@@ -2,13 +2,15 @@ from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from apps.core.mixins import ConditionalListMixin
 from .models import Room, Zone
 from .serializers import RoomSerializer, ZoneSerializer
 from apps.devices.models import Device
 
 
-class ZoneViewSet(viewsets.ModelViewSet):
+class ZoneViewSet(ConditionalListMixin, viewsets.ModelViewSet):
     serializer_class = ZoneSerializer
+    etag_counters = ('zones', 'rooms')
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
@@ -47,22 +49,9 @@ class ZoneViewSet(viewsets.ModelViewSet):
         # Get all devices in these rooms
         devices = Device.objects.filter(room_obj__in=rooms)
         
-        # Update all devices and send commands to HA
+        # Update all devices and send commands to HA concurrently
         from apps.devices.services import DeviceService
-        updated_count = 0
-        
-        for device in devices:
-            try:
-                # Update local state
-                if device.is_on != is_on:
-                    device.is_on = is_on
-                    device.save(update_fields=['is_on'])
-                    updated_count += 1
-                
-                # Send command to HA
-                DeviceService.send_ha_command(device, is_on)
-            except Exception as e:
-                print(f"Error toggling device {device.entity_id}: {e}")
+        updated_count = DeviceService.set_power_many(devices, is_on)
         
         return Response({
             'status': 'success',
@@ -71,8 +60,11 @@ class ZoneViewSet(viewsets.ModelViewSet):
         })
 
 
-class RoomViewSet(viewsets.ModelViewSet):
+class RoomViewSet(ConditionalListMixin, viewsets.ModelViewSet):
     serializer_class = RoomSerializer
+    # deviceCount and zoneName come from the other tables
+    # 'room_devices' is bumped when devices join or leave a room (deviceCount)
+    etag_counters = ('rooms', 'zones', 'room_devices')
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
@@ -108,22 +100,9 @@ class RoomViewSet(viewsets.ModelViewSet):
         # Get all devices in this room
         devices = Device.objects.filter(room_obj=room)
         
-        # Update all devices and send commands to HA
+        # Update all devices and send commands to HA concurrently
         from apps.devices.services import DeviceService
-        updated_count = 0
-        
-        for device in devices:
-            try:
-                # Update local state
-                if device.is_on != is_on:
-                    device.is_on = is_on
-                    device.save(update_fields=['is_on'])
-                    updated_count += 1
-                
-                # Send command to HA
-                DeviceService.send_ha_command(device, is_on)
-            except Exception as e:
-                print(f"Error toggling device {device.entity_id}: {e}")
+        updated_count = DeviceService.set_power_many(devices, is_on)
         
         return Response({
             'status': 'success',
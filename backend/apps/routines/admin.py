@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Scene, NezuRoutine, RoutineAction
+from .models import Scene, NezuRoutine, RoutineAction, RoutineRun, RoutineActionResult
 
 @admin.register(Scene)
 class SceneAdmin(admin.ModelAdmin):
@@ -16,3 +16,15 @@ class NezuRoutineAdmin(admin.ModelAdmin):
     list_display = ('name', 'created_at')
     search_fields = ('name',)
     inlines = [RoutineActionInline]
+
+class RoutineActionResultInline(admin.TabularInline):
+    model = RoutineActionResult
+    extra = 0
+    readonly_fields = ('action_id', 'entity_id', 'action_type', 'status', 'ha_ms', 'duration_ms', 'error')
+
+@admin.register(RoutineRun)
+class RoutineRunAdmin(admin.ModelAdmin):
+    list_display = ('routine', 'status', 'started_at', 'duration_ms')
+    list_filter = ('status',)
+    readonly_fields = ('run_id', 'routine', 'status', 'error', 'started_at', 'finished_at', 'duration_ms')
+    inlines = [RoutineActionResultInline]
@@ -3,3 +3,14 @@ from django.apps import AppConfig
 class RoutinesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.routines'
+
+    def ready(self):
+        import apps.routines.signals  # noqa
+
+        from django.conf import settings
+        from apps.devices.reconciler import should_autostart
+        from .scheduler import routine_scheduler
+        from .triggers import trigger_engine
+        if should_autostart() and getattr(settings, 'ROUTINE_TRIGGERS_ENABLED', True):
+            trigger_engine.start()
+            routine_scheduler.start()
@@ -0,0 +1,195 @@
+"""
+Persistent history of routine runs.
+
+Each finished run is written as one RoutineRun row plus its
+RoutineActionResult rows (a single bulk_create), and old runs are pruned in
+batches. stats() turns the history into p50/p95 execution times per routine
+and failure rates per entity.
+"""
+import datetime
+import math
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import RoutineActionResult, RoutineRun
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """Nearest-rank percentile of `values` (None when empty)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+class RunHistory:
+    """
+    Writes finished RoutineExecutions to the database and prunes runs older
+    than `retention_days`, at most once per `prune_interval` seconds.
+    """
+
+    def __init__(self, retention_days: int = None, prune_interval: float = 3600, batch_size: int = 500):
+        self.retention_days = (retention_days if retention_days is not None
+                               else getattr(settings, 'ROUTINE_RUN_RETENTION_DAYS', 30))
+        self.prune_interval = prune_interval
+        self.batch_size = batch_size
+        self._pruned_at = None
+        self._lock = threading.Lock()
+
+    def record(self, execution) -> RoutineRun:
+        """Store a finished execution: one INSERT for the run, one for its actions"""
+        snapshot = execution.snapshot()
+        started_at = parse_datetime(snapshot['started_at'] or snapshot['created_at'])
+        finished_at = parse_datetime(snapshot['finished_at'])
+
+        with transaction.atomic():
+            run = RoutineRun.objects.create(
+                run_id=snapshot['id'],
+                routine_id=snapshot['routine_id'],
+                status=snapshot['status'],
+                error=snapshot['error'] or '',
+                started_at=started_at,
+                finished_at=finished_at,
+                duration_ms=(finished_at - started_at).total_seconds() * 1000,
+            )
+            RoutineActionResult.objects.bulk_create([
+                RoutineActionResult(
+                    run=run,
+                    action_id=action['action_id'],
+                    entity_id=action['device_id'],
+                    action_type=action['type'],
+                    status=action['status'],
+                    ha_ms=action.get('ha_ms'),
+                    duration_ms=action['duration_ms'],
+                    error=action['error'] or '',
+                )
+                for action in snapshot['actions']
+            ])
+        self._maybe_prune()
+        return run
+
+    def record_safely(self, execution):
+        """record() for the runtime's worker threads: never raises"""
+        close_old_connections()
+        try:
+            self.record(execution)
+        except Exception as e:
+            print(f"Could not record routine run {execution.id}: {e}")
+        finally:
+            close_old_connections()
+
+    def _maybe_prune(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._pruned_at is not None and now - self._pruned_at < self.prune_interval:
+                return
+            self._pruned_at = now
+        self.prune()
+
+    def prune(self, before: datetime.datetime = None) -> int:
+        """
+        Delete runs started before `before` (default: the retention window)
+        in batches of `batch_size`, so no single DELETE holds the table for
+        long. Returns the number of runs deleted.
+        """
+        before = before or timezone.now() - datetime.timedelta(days=self.retention_days)
+        deleted = 0
+        while True:
+            ids = list(RoutineRun.objects.filter(started_at__lt=before)
+                       .order_by('started_at').values_list('id', flat=True)[:self.batch_size])
+            if not ids:
+                break
+            # The cascade to RoutineActionResult is a single fast DELETE by run id
+            RoutineRun.objects.filter(id__in=ids).delete()
+            deleted += len(ids)
+        if deleted:
+            print(f"Pruned {deleted} routine runs older than {before:%Y-%m-%d}")
+        return deleted
+
+    @staticmethod
+    def get_run(run_id: str) -> Optional[Dict[str, Any]]:
+        """A stored run in the shape of RoutineExecution.snapshot(), or None"""
+        run = RoutineRun.objects.select_related('routine').filter(run_id=run_id).first()
+        if run is None:
+            return None
+        return {
+            'id': run.run_id,
+            'routine_id': run.routine_id,
+            'routine_name': run.routine.name,
+            'status': run.status,
+            'error': run.error or None,
+            # Queue time is not stored
+            'created_at': run.started_at.isoformat(),
+            'started_at': run.started_at.isoformat(),
+            'finished_at': run.finished_at.isoformat(),
+            'actions': [
+                {
+                    'action_id': result.action_id,
+                    'device_id': result.entity_id,
+                    'type': result.action_type,
+                    'status': result.status,
+                    'started_at': None,
+                    'finished_at': None,
+                    'duration_ms': result.duration_ms,
+                    'ha_ms': result.ha_ms,
+                    'error': result.error or None,
+                }
+                # Stored in plan order by one bulk_create
+                for result in run.action_results.order_by('id')
+            ],
+        }
+
+    @staticmethod
+    def stats(since: datetime.datetime = None) -> Dict[str, Any]:
+        """
+        Per routine: runs, errors, p50/p95/max duration and last run.
+        Per entity: calls, errors, error rate and p50/p95 HA latency.
+        """
+        runs = RoutineRun.objects.all()
+        results = RoutineActionResult.objects.exclude(entity_id__isnull=True).exclude(status='skipped')
+        if since is not None:
+            runs = runs.filter(started_at__gte=since)
+            results = results.filter(run__started_at__gte=since)
+
+        routines: Dict[int, Dict[str, Any]] = {}
+        for routine_id, name, status, duration_ms, started_at in runs.values_list(
+                'routine_id', 'routine__name', 'status', 'duration_ms', 'started_at').order_by('started_at'):
+            entry = routines.setdefault(routine_id, {
+                'routine_id': routine_id, 'name': name, 'runs': 0, 'errors': 0, 'durations': [],
+            })
+            entry['runs'] += 1
+            entry['errors'] += status == 'error'
+            entry['durations'].append(duration_ms)
+            entry['last_run'] = started_at.isoformat()
+
+        entities: Dict[str, Dict[str, Any]] = {}
+        for entity_id, status, ha_ms in results.values_list('entity_id', 'status', 'ha_ms'):
+            entry = entities.setdefault(entity_id, {'entity_id': entity_id, 'calls': 0, 'errors': 0, 'latencies': []})
+            entry['calls'] += 1
+            entry['errors'] += status == 'error'
+            if ha_ms is not None:
+                entry['latencies'].append(ha_ms)
+
+        for entry in routines.values():
+            durations = entry.pop('durations')
+            entry.update(p50_ms=percentile(durations, 0.5), p95_ms=percentile(durations, 0.95), max_ms=max(durations))
+        for entry in entities.values():
+            latencies = entry.pop('latencies')
+            entry.update(error_rate=entry['errors'] / entry['calls'],
+                         p50_ms=percentile(latencies, 0.5), p95_ms=percentile(latencies, 0.95))
+
+        return {
+            # Slowest first / flakiest first
+            'routines': sorted(routines.values(), key=lambda entry: -entry['p95_ms']),
+            'entities': sorted(entities.values(), key=lambda entry: (-entry['error_rate'], -(entry['p95_ms'] or 0))),
+        }
+
+
+# Singleton instance
+run_history = RunHistory()
@@ -0,0 +1,72 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.routines.models import RoutineTrigger
+from apps.routines.triggers import CompiledTrigger, TriggerIndex
+
+
+class Command(BaseCommand):
+    help = 'Benchmark device_state trigger matching: indexed lookup vs scanning every trigger'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--triggers', type=int, default=10000)
+        parser.add_argument('--entities', type=int, default=2000)
+        parser.add_argument('--rate', type=int, default=1000, help='Events per second to replay')
+        parser.add_argument('--seconds', type=int, default=5)
+
+    def handle(self, *args, **options):
+        trigger_count = options['triggers']
+        entity_count = options['entities']
+        conditions = [('>', '25'), ('<', '10'), ('==', 'on'), ('!=', 'off')]
+
+        # Unsaved rows: only the compiled index is being measured
+        triggers = []
+        for i in range(trigger_count):
+            condition, value = random.choice(conditions)
+            triggers.append(RoutineTrigger(id=i, routine_id=i, type='device_state',
+                                           entity_id=f'sensor.bench_{random.randrange(entity_count)}',
+                                           condition=condition, value=value))
+        started = time.perf_counter()
+        index = TriggerIndex()
+        index.load(triggers)
+        build_ms = (time.perf_counter() - started) * 1000
+        flat = [CompiledTrigger.from_trigger(trigger) for trigger in triggers]
+
+        event_count = options['rate'] * options['seconds']
+        events = []
+        for _ in range(event_count):
+            entity_id = f'sensor.bench_{random.randrange(entity_count)}'
+            old, new = random.sample(['5', '20', '30', 'on', 'off'], 2)
+            events.append((entity_id, {'state': old}, {'state': new}))
+
+        # Replay at the target rate and record per-event latency
+        latencies = []
+        fired = 0
+        interval = 1 / options['rate']
+        deadline = time.perf_counter()
+        for entity_id, old_state, new_state in events:
+            deadline += interval
+            started = time.perf_counter()
+            fired += len(index.match(entity_id, old_state, new_state))
+            latencies.append(time.perf_counter() - started)
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        started = time.perf_counter()
+        for entity_id, old_state, new_state in events[:1000]:
+            [t for t in flat if t.entity_id == entity_id and t.fires(old_state, new_state)]
+        scan_us = (time.perf_counter() - started) / min(len(events), 1000) * 1e6
+
+        latencies_us = sorted(latency * 1e6 for latency in latencies)
+        self.stdout.write(f'Triggers: {trigger_count} on {entity_count} entities, index built in {build_ms:.1f}ms')
+        self.stdout.write(
+            f'Indexed: {event_count} events at {options["rate"]}/s, {fired} fired, '
+            f'p50 {statistics.median(latencies_us):.1f}us, '
+            f'p99 {latencies_us[int(len(latencies_us) * 0.99) - 1]:.1f}us, '
+            f'max {latencies_us[-1]:.1f}us per event'
+        )
+        self.stdout.write(f'Full scan: {scan_us:.1f}us per event')
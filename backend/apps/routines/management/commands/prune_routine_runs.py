@@ -0,0 +1,20 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.routines.history import RunHistory
+
+
+class Command(BaseCommand):
+    help = 'Delete routine run history older than the retention window (ROUTINE_RUN_RETENTION_DAYS)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None, help='Keep this many days instead')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        history = RunHistory(retention_days=options['days'], batch_size=options['batch_size'])
+        before = timezone.now() - datetime.timedelta(days=history.retention_days)
+        deleted = history.prune(before)
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} runs started before {before:%Y-%m-%d %H:%M}'))
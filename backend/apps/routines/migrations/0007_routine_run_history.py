@@ -0,0 +1,52 @@
+# Generated by Django 3.2.25 on 2026-10-17 19:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routines', '0006_auto_20251205_1733'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoutineRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_id', models.CharField(max_length=32, unique=True)),
+                ('status', models.CharField(choices=[('success', 'Success'), ('error', 'Error')], max_length=10)),
+                ('error', models.TextField(blank=True, default='')),
+                ('started_at', models.DateTimeField(db_index=True)),
+                ('finished_at', models.DateTimeField()),
+                ('duration_ms', models.FloatField()),
+                ('routine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='runs', to='routines.nezuroutine')),
+            ],
+            options={
+                'ordering': ['-started_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='RoutineActionResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action_id', models.IntegerField(null=True)),
+                ('entity_id', models.CharField(blank=True, max_length=100, null=True)),
+                ('action_type', models.CharField(max_length=100)),
+                ('status', models.CharField(max_length=10)),
+                ('ha_ms', models.FloatField(null=True)),
+                ('duration_ms', models.FloatField(null=True)),
+                ('error', models.TextField(blank=True, default='')),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='action_results', to='routines.routinerun')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='routinerun',
+            index=models.Index(fields=['routine', 'started_at'], name='routines_ro_routine_41734c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='routineactionresult',
+            index=models.Index(fields=['entity_id'], name='routines_ro_entity__cb221c_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2.25 on 2026-10-17 19:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routines', '0007_routine_run_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TriggerClaim',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('occurrence', models.CharField(max_length=150)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('routine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trigger_claims', to='routines.nezuroutine')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='triggerclaim',
+            constraint=models.UniqueConstraint(fields=('routine', 'occurrence'), name='unique_trigger_claim'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-17 19:54
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routines', '0008_trigger_claims'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='routineaction',
+            options={'ordering': ['order', 'id']},
+        ),
+    ]
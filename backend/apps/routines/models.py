@@ -1,4 +1,8 @@
-from django.db import models
+import datetime
+import time
+
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
 
 class Scene(models.Model):
     TYPE_CHOICES = [
@@ -66,4 +70,84 @@ class RoutineAction(models.Model):
     order = models.IntegerField(default=0)
 
     class Meta:
-        ordering = ['order']
+        ordering = ['order', 'id']
+
+
+class RoutineRun(models.Model):
+    """One finished execution of a routine, written when the run ends"""
+    STATUS_CHOICES = [
+        ('success', 'Success'),
+        ('error', 'Error'),
+    ]
+
+    run_id = models.CharField(max_length=32, unique=True)
+    routine = models.ForeignKey(NezuRoutine, related_name='runs', on_delete=models.CASCADE)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES)
+    error = models.TextField(blank=True, default='')
+    started_at = models.DateTimeField(db_index=True)
+    finished_at = models.DateTimeField()
+    duration_ms = models.FloatField()
+
+    class Meta:
+        ordering = ['-started_at']
+        indexes = [models.Index(fields=['routine', 'started_at'])]
+
+    def __str__(self):
+        return f"{self.routine_id} - {self.status} ({self.duration_ms:.0f} ms)"
+
+
+class RoutineActionResult(models.Model):
+    run = models.ForeignKey(RoutineRun, related_name='action_results', on_delete=models.CASCADE)
+    # Plain copies: actions are recreated whenever a routine is edited
+    action_id = models.IntegerField(null=True)
+    entity_id = models.CharField(max_length=100, blank=True, null=True)
+    action_type = models.CharField(max_length=100)
+    status = models.CharField(max_length=10)
+    ha_ms = models.FloatField(null=True)
+    duration_ms = models.FloatField(null=True)
+    error = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [models.Index(fields=['entity_id'])]
+
+
+class TriggerClaim(models.Model):
+    """
+    One firing of a routine by a trigger. Every worker sees the same HA
+    events and runs the same schedule; the unique row lets only the first
+    of them start the routine.
+    """
+    routine = models.ForeignKey(NezuRoutine, related_name='trigger_claims', on_delete=models.CASCADE)
+    # What fired: the HA state change or the scheduled instant
+    occurrence = models.CharField(max_length=150)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    # Claims only matter while the workers race for them
+    RETENTION = datetime.timedelta(days=1)
+    PRUNE_INTERVAL = 3600
+    _pruned_at = 0.0
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['routine', 'occurrence'], name='unique_trigger_claim'),
+        ]
+
+    @classmethod
+    def claim(cls, routine_id: int, occurrence: str) -> bool:
+        """True for the one caller that records this occurrence first"""
+        cls.prune()
+        try:
+            with transaction.atomic():
+                cls.objects.create(routine_id=routine_id, occurrence=occurrence[:150])
+        except IntegrityError:
+            return False
+        return True
+
+    @classmethod
+    def prune(cls, force: bool = False):
+        """Drop claims past RETENTION (at most every PRUNE_INTERVAL seconds)"""
+        now = time.monotonic()
+        if not force and now - cls._pruned_at < cls.PRUNE_INTERVAL:
+            return
+        cls._pruned_at = now
+        cls.objects.filter(created_at__lt=timezone.now() - cls.RETENTION).delete()
@@ -0,0 +1,171 @@
+"""
+Compiled execution plans for NezuRoutines.
+
+A plan is the immutable, pre-parsed form of a routine: its steps in order,
+each either a stage of HA service calls or a delay. Actions sharing an
+`order` value form one stage and run concurrently; stages run one after
+another, and a delay is always a barrier between them. Plans are cached
+per routine, so running a routine (from the API, Alexa or a trigger) costs
+no database queries once its plan is compiled.
+"""
+import math
+import threading
+import time
+from typing import Any, Dict, NamedTuple, Optional, Tuple, Union
+
+from django.conf import settings
+
+ROUTINES_COUNTER = 'routines'
+
+
+class PlannedAction(NamedTuple):
+    index: int
+    action_id: int
+    entity_id: str
+    domain: str
+    service: str
+    service_data: Dict[str, Any]
+
+    @property
+    def call(self):
+        return self.domain, self.service, self.service_data
+
+
+class Delay(NamedTuple):
+    index: int
+    action_id: int
+    seconds: float
+
+
+class Stage(NamedTuple):
+    order: int
+    actions: Tuple[PlannedAction, ...]
+
+
+class RoutinePlan(NamedTuple):
+    routine_id: int
+    name: str
+    steps: Tuple[Union[Stage, Delay], ...]
+    # One entry per routine action, in order: (action_id, entity_id, type)
+    actions: Tuple[Tuple[int, Optional[str], str], ...]
+
+    @property
+    def total_delay(self) -> float:
+        return sum(step.seconds for step in self.steps if isinstance(step, Delay))
+
+    @property
+    def call_count(self) -> int:
+        return sum(len(step.actions) for step in self.steps if isinstance(step, Stage))
+
+    def estimated_duration(self, call_seconds: float, max_fanout: int) -> float:
+        """
+        Rough wall time of a run: every delay, plus one HA round-trip of
+        `call_seconds` per stage (per wave of `max_fanout` calls in a stage)
+        """
+        waves = sum(math.ceil(len(step.actions) / max_fanout) for step in self.steps if isinstance(step, Stage))
+        return self.total_delay + waves * call_seconds
+
+
+def compile_plan(routine, actions) -> RoutinePlan:
+    """
+    Turn a routine and its actions (sorted by `order`) into a plan:
+    consecutive service actions with the same order form one stage, and a
+    `delay` is always a step of its own, i.e. a barrier between stages.
+    Raises ValueError for a service action without an entity.
+    """
+    steps = []
+    stage = []
+    summary = []
+
+    def close_stage():
+        if stage:
+            steps.append(Stage(stage[0][0], tuple(action for _, action in stage)))
+            stage.clear()
+
+    for index, action in enumerate(actions):
+        summary.append((action.id, action.device_id, action.action_type))
+        if action.action_type == 'delay':
+            close_stage()
+            steps.append(Delay(index, action.id, action.value))
+            continue
+        if not action.device_id:
+            raise ValueError(f"Action {action.id} ({action.action_type}) has no device")
+        if stage and stage[0][0] != action.order:
+            close_stage()
+        entity_id = action.device_id
+        stage.append((action.order, PlannedAction(index, action.id, entity_id, entity_id.split('.')[0],
+                                                  action.action_type, {'entity_id': entity_id})))
+    close_stage()
+    return RoutinePlan(routine.id, routine.name, tuple(steps), tuple(summary))
+
+
+class PlanCache:
+    """
+    Compiled plans by routine id.
+
+    Local edits drop the affected plan through the routine signals. Edits
+    made by other processes are noticed through the 'routines' change
+    counter, checked at most every `recheck_interval` seconds, so the hot
+    path stays query-free in between. A plan is only stored if nothing was
+    invalidated while it compiled.
+    """
+
+    def __init__(self, recheck_interval: float = None):
+        self.recheck_interval = (recheck_interval if recheck_interval is not None
+                                 else getattr(settings, 'ROUTINE_PLAN_RECHECK_INTERVAL', 5))
+        self._plans: Dict[int, RoutinePlan] = {}
+        self._lock = threading.Lock()
+        self._counter = None
+        self._checked_at = None
+        # Bumped by every invalidation
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._plans)
+
+    def _check_for_remote_edits(self):
+        from apps.core.models import ChangeCounter
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.recheck_interval:
+            return
+        counter = ChangeCounter.current(ROUTINES_COUNTER)
+        with self._lock:
+            if counter != self._counter:
+                self._plans.clear()
+                self._generation += 1
+                self._counter = counter
+            self._checked_at = now
+
+    def get(self, routine_id) -> RoutinePlan:
+        """Plan of a routine, compiling it on a miss. Raises NezuRoutine.DoesNotExist."""
+        from .models import NezuRoutine
+        routine_id = int(routine_id)
+        self._check_for_remote_edits()
+        with self._lock:
+            plan = self._plans.get(routine_id)
+            generation = self._generation
+        if plan is not None:
+            return plan
+
+        routine = NezuRoutine.objects.prefetch_related('actions').get(id=routine_id)
+        plan = compile_plan(routine, routine.actions.all())
+        with self._lock:
+            # An edit landed while compiling: the plan may predate it
+            if self._generation == generation:
+                self._plans[routine_id] = plan
+        return plan
+
+    def invalidate(self, routine_id):
+        with self._lock:
+            self._plans.pop(int(routine_id), None)
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+            self._generation += 1
+            self._checked_at = None
+
+
+# Singleton instance
+routine_plans = PlanCache()
@@ -0,0 +1,315 @@
+"""
+Background execution of NezuRoutines.
+
+RoutineRuntime.submit() takes the routine's cached plan (see plans.py),
+hands it to a small worker pool and returns a RoutineExecution straight
+away, so neither the API request nor an Alexa directive waits for the
+routine to finish. `delay` steps are entries in a TimerQueue rather than
+sleeping threads: when one comes due, the rest of the plan is queued on the
+pool again.
+
+Progress snapshots are written to the Django cache under the run id.
+Finished runs are also stored in the database by RunHistory (see
+history.py), which GET /api/nezu-routines/runs/<id>/ falls back to, so a
+finished run is found from any worker. Runs still in progress on another
+worker are only visible with a shared cache (CACHE_URL, see settings.py).
+"""
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from apps.core.services.ha_dispatcher import dispatch_service_calls_timed
+from .models import NezuRoutine
+from .plans import Delay, RoutinePlan, Stage, routine_plans
+from .timers import TimerQueue
+
+
+class RoutineExecution:
+    """
+    State of one routine run: overall status plus per-action progress.
+
+    Run status: queued -> running (<-> waiting during delays) -> success | error.
+    Action status: pending -> running | waiting -> success | error, or
+    skipped when an earlier action failed.
+    """
+
+    def __init__(self, plan: RoutinePlan):
+        self.id = uuid.uuid4().hex
+        self.plan = plan
+        self.routine_id = plan.routine_id
+        self.routine_name = plan.name
+        self.status = 'queued'
+        self.error = None
+        self.exception: Optional[Exception] = None
+        self.created_at = timezone.now()
+        self.started_at = None
+        self.finished_at = None
+        self.progress: List[Dict[str, Any]] = [
+            {
+                'action_id': action_id,
+                'device_id': device_id,
+                'type': action_type,
+                'status': 'pending',
+                'started_at': None,
+                'finished_at': None,
+                'duration_ms': None,
+                'ha_ms': None,
+                'error': None,
+            }
+            for action_id, device_id, action_type in plan.actions
+        ]
+
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._started = {}
+        self._callbacks = []
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """Block until the run finishes; False on timeout"""
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, callback) -> bool:
+        """
+        Call callback(execution) from the thread that finishes the run.
+        Returns False, without calling it, if the run has already finished.
+        """
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self._callbacks.append(callback)
+            return True
+
+    # Transitions (called from the runtime's threads)
+
+    def set_status(self, status: str):
+        with self._lock:
+            if self.started_at is None:
+                self.started_at = timezone.now()
+            self.status = status
+
+    def action_started(self, index: int, status: str = 'running'):
+        with self._lock:
+            self._started[index] = time.monotonic()
+            self.progress[index].update(status=status, started_at=timezone.now().isoformat())
+
+    def action_finished(self, index: int, error: Exception = None, ha_seconds: float = None):
+        with self._lock:
+            entry = self.progress[index]
+            started = self._started.pop(index, None)
+            if started is not None:
+                entry['duration_ms'] = round((time.monotonic() - started) * 1000, 1)
+            if ha_seconds is not None:
+                entry['ha_ms'] = round(ha_seconds * 1000, 1)
+            entry['finished_at'] = timezone.now().isoformat()
+            entry['status'] = 'error' if error else 'success'
+            entry['error'] = str(error) if error else None
+
+    def finish(self, exception: Exception = None):
+        with self._lock:
+            for entry in self.progress:
+                if entry['status'] == 'pending':
+                    entry['status'] = 'skipped'
+            self.status = 'error' if exception else 'success'
+            self.exception = exception
+            self.error = str(exception) if exception else None
+            self.finished_at = timezone.now()
+            callbacks, self._callbacks = self._callbacks, []
+            self._done.set()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"Routine run {self.id}: done callback failed: {e}")
+
+    # Reading
+
+    def results(self) -> List[Dict[str, Any]]:
+        """Results of the completed actions, in the shape execute_routine returns"""
+        results = []
+        for entry in self.progress:
+            if entry['status'] != 'success':
+                continue
+            if entry['type'] == 'delay':
+                results.append({'action_id': entry['action_id'], 'type': 'delay', 'status': 'success'})
+            else:
+                results.append({'action_id': entry['action_id'], 'device_id': entry['device_id'], 'status': 'success'})
+        return results
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'id': self.id,
+                'routine_id': self.routine_id,
+                'routine_name': self.routine_name,
+                'status': self.status,
+                'error': self.error,
+                'created_at': self.created_at.isoformat(),
+                'started_at': self.started_at.isoformat() if self.started_at else None,
+                'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+                'actions': [dict(entry) for entry in self.progress],
+            }
+
+
+class RoutineRuntime:
+    """
+    Runs routines on a bounded thread pool, with delays parked on a timer
+    queue so that a waiting routine holds no thread. Within a stage at most
+    `max_fanout` HA requests are in flight, each bounded by `action_timeout`.
+    """
+
+    KEY_PREFIX = 'routine_runs'
+
+    def __init__(self, max_workers: int = None, timers: TimerQueue = None,
+                 cache_alias: str = None, run_ttl: float = None,
+                 max_fanout: int = None, action_timeout: float = None, history=None):
+        self.max_workers = max_workers or getattr(settings, 'ROUTINE_RUNTIME_WORKERS', 4)
+        self.max_fanout = max_fanout or getattr(settings, 'ROUTINE_MAX_FANOUT', 10)
+        self.action_timeout = action_timeout or getattr(settings, 'ROUTINE_ACTION_TIMEOUT', 10)
+        self.timers = timers or TimerQueue()
+        self.cache_alias = cache_alias or getattr(settings, 'ROUTINE_RUN_CACHE_ALIAS', 'default')
+        self.run_ttl = run_ttl if run_ttl is not None else getattr(settings, 'ROUTINE_RUN_TTL', 3600)
+        # RunHistory for finished runs; None uses the shared one (if ROUTINE_RUN_HISTORY)
+        self.history = history
+
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        # Unfinished runs of this process, by id
+        self._active: Dict[str, RoutineExecution] = {}
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix='routine-worker')
+        return self._executor
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def _key(self, run_id: str) -> str:
+        return f'{self.KEY_PREFIX}:{run_id}'
+
+    # Public API
+
+    def submit(self, routine) -> RoutineExecution:
+        """
+        Start a routine (instance or id) in the background and return its
+        execution. Raises NezuRoutine.DoesNotExist for unknown ids.
+        """
+        routine_id = routine.id if isinstance(routine, NezuRoutine) else routine
+        plan = routine_plans.get(routine_id)
+
+        execution = RoutineExecution(plan)
+        print(f"Executing routine: {plan.name} with {len(plan.actions)} actions (run {execution.id})")
+        self._active[execution.id] = execution
+        self._publish(execution)
+        self.executor.submit(self._run_from, execution, 0)
+        return execution
+
+    def get_run(self, run_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Progress snapshot of a run: this worker's own runs, then the cache,
+        then the stored history. None if unknown or expired.
+        """
+        execution = self._active.get(run_id)
+        if execution is not None:
+            return execution.snapshot()
+        run = self.cache.get(self._key(run_id))
+        history = self._history()
+        if run is None and history is not None:
+            run = history.get_run(run_id)
+        return run
+
+    # Execution
+
+    def _publish(self, execution: RoutineExecution):
+        self.cache.set(self._key(execution.id), execution.snapshot(), timeout=self.run_ttl)
+
+    def _finish(self, execution: RoutineExecution, exception: Exception = None):
+        execution.finish(exception)
+        self._active.pop(execution.id, None)
+        self._publish(execution)
+        self._record(execution)
+        if exception:
+            print(f"Error executing routine {execution.routine_id}: {exception}")
+        else:
+            print(f"Routine executed successfully: {len(execution.results())} actions completed")
+
+    def _history(self):
+        if self.history is not None:
+            return self.history
+        if not getattr(settings, 'ROUTINE_RUN_HISTORY', True):
+            return None
+        from .history import run_history
+        return run_history
+
+    def _record(self, execution: RoutineExecution):
+        history = self._history()
+        if history is not None:
+            history.record_safely(execution)
+
+    def _run_from(self, execution: RoutineExecution, step_index: int):
+        """Run plan steps from `step_index` until a delay (or the end)"""
+        try:
+            execution.set_status('running')
+            steps = execution.plan.steps
+            while step_index < len(steps):
+                step = steps[step_index]
+                if isinstance(step, Delay):
+                    print(f"Waiting for {step.seconds} seconds...")
+                    execution.action_started(step.index, status='waiting')
+                    execution.set_status('waiting')
+                    self._publish(execution)
+                    self.timers.call_later(step.seconds,
+                                           lambda: self.executor.submit(self._resume, execution, step_index))
+                    return
+
+                error = self._dispatch(execution, step)
+                if error:
+                    self._finish(execution, error)
+                    return
+                step_index += 1
+            self._finish(execution)
+        except Exception as e:
+            self._finish(execution, e)
+
+    def _resume(self, execution: RoutineExecution, delay_step: int):
+        execution.action_finished(execution.plan.steps[delay_step].index)
+        self._run_from(execution, delay_step + 1)
+
+    def _dispatch(self, execution: RoutineExecution, stage: Stage) -> Optional[Exception]:
+        """
+        Send a stage's calls to HA concurrently; actions sharing a domain and
+        service become one multi-entity call. Returns the first error.
+        """
+        for action in stage.actions:
+            print(f"Calling HA service: {action.domain}.{action.service} for {action.entity_id}")
+            execution.action_started(action.index)
+        self._publish(execution)
+
+        first_error = None
+        results = dispatch_service_calls_timed([action.call for action in stage.actions],
+                                               limit=self.max_fanout, call_timeout=self.action_timeout)
+        for action, (result, seconds) in zip(stage.actions, results):
+            error = result if isinstance(result, Exception) else None
+            execution.action_finished(action.index, error, seconds)
+            first_error = first_error or error
+        self._publish(execution)
+        return first_error
+
+
+# Singleton instance
+routine_runtime = RoutineRuntime()
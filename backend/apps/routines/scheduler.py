@@ -0,0 +1,380 @@
+"""
+Scheduler for `time` and `sun` RoutineTriggers.
+
+Each trigger's next fire instant is computed once and pushed onto a heap;
+the scheduler thread sleeps until the earliest one, starts the routine and
+pushes that trigger's following occurrence. Edits replace one routine's
+entries (stale heap entries are skipped when popped), so nothing ever
+rescans every routine and there is no per-minute tick.
+"""
+import datetime
+import heapq
+import itertools
+import json
+import threading
+from typing import Callable, Dict, FrozenSet, List, Optional, Tuple
+
+import pytz
+from django.conf import settings
+from django.db import close_old_connections
+
+WEEKDAYS = frozenset(range(5))
+WEEKENDS = frozenset((5, 6))
+ALL_DAYS = frozenset(range(7))
+# Monday = 0; English and Spanish names, matched on their first three letters
+DAY_NAMES = {
+    'mon': 0, 'tue': 1, 'wed': 2, 'thu': 3, 'fri': 4, 'sat': 5, 'sun': 6,
+    'lun': 0, 'mar': 1, 'mie': 2, 'mié': 2, 'jue': 3, 'vie': 4, 'sab': 5, 'sáb': 5, 'dom': 6,
+}
+
+
+def parse_days(days) -> FrozenSet[int]:
+    """
+    Weekdays (Monday = 0) a trigger runs on: 'daily', 'weekdays', 'weekends'
+    or a JSON list of day numbers/names. Raises ValueError when unreadable.
+    """
+    if days is None or str(days).strip().lower() in ('', 'daily'):
+        return ALL_DAYS
+    value = str(days).strip().lower()
+    if value == 'weekdays':
+        return WEEKDAYS
+    if value == 'weekends':
+        return WEEKENDS
+
+    try:
+        entries = json.loads(value)
+    except json.JSONDecodeError:
+        raise ValueError(f"Unknown days value {days!r}")
+    if not isinstance(entries, list):
+        raise ValueError(f"Unknown days value {days!r}")
+
+    parsed = set()
+    for entry in entries:
+        if isinstance(entry, int) and 0 <= entry <= 6:
+            parsed.add(entry)
+        elif isinstance(entry, str) and entry.strip().lower()[:3] in DAY_NAMES:
+            parsed.add(DAY_NAMES[entry.strip().lower()[:3]])
+        else:
+            raise ValueError(f"Unknown day {entry!r}")
+    if not parsed:
+        raise ValueError("No days selected")
+    return frozenset(parsed)
+
+
+def home_timezone():
+    return pytz.timezone(getattr(settings, 'HOME_TIME_ZONE', settings.TIME_ZONE))
+
+
+def next_time_of_day(at: datetime.time, days: FrozenSet[int], after: datetime.datetime,
+                     tz=None) -> datetime.datetime:
+    """
+    First instant strictly after `after` that is `at` local time on one of
+    `days`. A time skipped by a DST change fires at the shifted instant.
+    """
+    tz = tz or home_timezone()
+    local_after = after.astimezone(tz)
+    for offset in range(8):
+        day = local_after.date() + datetime.timedelta(days=offset)
+        if day.weekday() not in days:
+            continue
+        candidate = tz.normalize(tz.localize(datetime.datetime.combine(day, at), is_dst=False))
+        if candidate > after:
+            return candidate
+    raise ValueError("No matching day")
+
+
+def next_sun_event(event: str, offset: float, days: FrozenSet[int], after: datetime.datetime,
+                   tz=None) -> datetime.datetime:
+    """
+    First instant strictly after `after` that is `event` plus `offset`
+    seconds, on a day (local date of the event) in `days`.
+    """
+    from .sun import get_sun_table
+    tz = tz or home_timezone()
+    search_from = after - datetime.timedelta(seconds=offset)
+    # Bounded: a polar night can hide sunrise for weeks, not years
+    for _ in range(400):
+        table = get_sun_table(search_from)
+        candidate = table.next_event(event, search_from)
+        if candidate is None:
+            search_from = datetime.datetime.combine(table.end, datetime.time(), datetime.timezone.utc)
+            continue
+        if candidate.astimezone(tz).weekday() in days:
+            return candidate + datetime.timedelta(seconds=offset)
+        search_from = candidate
+    raise ValueError(f"No {event} found")
+
+
+class SystemClock:
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    def wait(self, condition: threading.Condition, seconds: Optional[float]):
+        condition.wait(seconds)
+
+
+class ManualClock:
+    """
+    Clock for tests: time only moves on advance(). Drive the scheduler with
+    run_due() after advancing instead of starting its thread.
+    """
+
+    def __init__(self, start: datetime.datetime):
+        self._now = start
+
+    def now(self) -> datetime.datetime:
+        return self._now
+
+    def advance(self, seconds: float = 0, **kwargs):
+        self._now += datetime.timedelta(seconds=seconds, **kwargs)
+
+    def set(self, when: datetime.datetime):
+        self._now = when
+
+    def wait(self, condition: threading.Condition, seconds: Optional[float]):
+        # Deadlines are in manual time: poll so that advance() is noticed
+        condition.wait(0.01)
+
+
+class ScheduledTrigger:
+    __slots__ = ('trigger_id', 'routine_id', 'type', 'next_fire')
+
+    def __init__(self, trigger_id, routine_id, type, next_fire: Callable[[datetime.datetime], datetime.datetime]):
+        self.trigger_id = trigger_id
+        self.routine_id = routine_id
+        self.type = type
+        self.next_fire = next_fire
+
+
+def compile_schedule(trigger, tz=None) -> ScheduledTrigger:
+    """Pre-parse a trigger into a next-fire function. Raises ValueError if unusable."""
+    if trigger.type == 'time':
+        if trigger.time is None:
+            raise ValueError("time trigger without a time")
+        at, days, tz = trigger.time, parse_days(trigger.days), tz or home_timezone()
+        return ScheduledTrigger(trigger.id, trigger.routine_id, trigger.type,
+                                lambda after: next_time_of_day(at, days, after, tz))
+    if trigger.type == 'sun':
+        from .sun import get_sun_table, parse_sun_value
+        event, offset = parse_sun_value(trigger.value)
+        days, tz = parse_days(trigger.days), tz or home_timezone()
+        # Fails early (and the trigger is skipped) without home coordinates
+        get_sun_table()
+        return ScheduledTrigger(trigger.id, trigger.routine_id, trigger.type,
+                                lambda after: next_sun_event(event, offset, days, after, tz))
+    raise ValueError(f"Unsupported scheduled trigger type {trigger.type!r}")
+
+
+class RoutineScheduler:
+    """
+    Heap of (next fire instant, trigger) for scheduled routine triggers.
+
+    The thread sleeps until the earliest deadline and is woken early by the
+    routine signals when a routine is saved or deleted in this process.
+    Edits from other processes are noticed through the 'routines' change
+    counter, read only when the thread wakes up. With several workers the
+    first to claim an occurrence in the database starts the routine.
+    """
+
+    TYPES = ('time', 'sun')
+
+    def __init__(self, runtime=None, clock=None, tz=None):
+        self.clock = clock or SystemClock()
+        self.tz = tz or home_timezone()
+        self._runtime = runtime
+
+        self._heap: List[Tuple[float, int, int]] = []
+        self._counter = itertools.count()
+        # trigger_id -> (scheduled trigger, timestamp of its live heap entry)
+        self._entries: Dict[int, Tuple[ScheduledTrigger, float]] = {}
+        self._triggers_by_routine: Dict[int, set] = {}
+        self._condition = threading.Condition()
+        self._loaded_counter = None
+        self._thread = None
+        self._stop = False
+
+    @property
+    def runtime(self):
+        if self._runtime is None:
+            from .runtime import routine_runtime
+            self._runtime = routine_runtime
+        return self._runtime
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Loading
+
+    @classmethod
+    def _queryset(cls):
+        from .models import RoutineTrigger
+        return RoutineTrigger.objects.filter(type__in=cls.TYPES, routine__is_active=True)
+
+    def _compile(self, triggers) -> List[ScheduledTrigger]:
+        compiled = []
+        for trigger in triggers:
+            try:
+                compiled.append(compile_schedule(trigger, self.tz))
+            except ValueError as e:
+                print(f"Skipping trigger {trigger.id} of routine {trigger.routine_id}: {e}")
+        return compiled
+
+    def _push(self, scheduled: ScheduledTrigger, after: datetime.datetime) -> bool:
+        """
+        Schedule the next occurrence after `after`. A trigger whose next
+        occurrence can't be computed is dropped (False) without affecting
+        the others.
+        """
+        try:
+            fire_at = scheduled.next_fire(after).timestamp()
+        except Exception as e:
+            print(f"Scheduler: dropping trigger {scheduled.trigger_id} of routine {scheduled.routine_id}: {e}")
+            self._entries.pop(scheduled.trigger_id, None)
+            return False
+        self._entries[scheduled.trigger_id] = (scheduled, fire_at)
+        heapq.heappush(self._heap, (fire_at, next(self._counter), scheduled.trigger_id))
+        return True
+
+    def load(self, triggers=None):
+        """(Re)build the whole schedule from the database unless `triggers` is given"""
+        from apps.core.models import ChangeCounter
+        if triggers is None:
+            self._loaded_counter = ChangeCounter.current('routines')
+            triggers = self._queryset()
+        compiled = self._compile(triggers)
+        now = self.clock.now()
+        with self._condition:
+            self._heap, self._entries, self._triggers_by_routine = [], {}, {}
+            for scheduled in compiled:
+                if self._push(scheduled, now):
+                    self._triggers_by_routine.setdefault(scheduled.routine_id, set()).add(scheduled.trigger_id)
+            self._condition.notify()
+
+    def refresh_routine(self, routine_id: int, triggers=None):
+        """Replace one routine's entries; old heap entries go stale"""
+        compiled = self._compile(self._queryset().filter(routine_id=routine_id) if triggers is None else triggers)
+        now = self.clock.now()
+        with self._condition:
+            for trigger_id in self._triggers_by_routine.pop(routine_id, set()):
+                self._entries.pop(trigger_id, None)
+            pushed = {scheduled.trigger_id for scheduled in compiled if self._push(scheduled, now)}
+            if pushed:
+                self._triggers_by_routine[routine_id] = pushed
+            self._condition.notify()
+
+    def routine_changed(self, routine_id: int):
+        if self._thread is None:
+            return
+        from apps.core.models import ChangeCounter
+        self.refresh_routine(routine_id)
+        self._loaded_counter = ChangeCounter.current('routines')
+
+    def routine_removed(self, routine_id: int):
+        if self._thread is not None:
+            self.refresh_routine(routine_id, triggers=[])
+
+    # Firing
+
+    def next_deadline(self) -> Optional[datetime.datetime]:
+        with self._condition:
+            self._drop_stale()
+            if not self._heap:
+                return None
+            return datetime.datetime.fromtimestamp(self._heap[0][0], datetime.timezone.utc)
+
+    def _drop_stale(self):
+        while self._heap:
+            fire_at, _, trigger_id = self._heap[0]
+            entry = self._entries.get(trigger_id)
+            if entry is not None and entry[1] == fire_at:
+                return
+            heapq.heappop(self._heap)
+
+    def _pop_due(self, now: datetime.datetime) -> List[Tuple[ScheduledTrigger, float]]:
+        due = []
+        timestamp = now.timestamp()
+        with self._condition:
+            self._drop_stale()
+            while self._heap and self._heap[0][0] <= timestamp:
+                fire_at, _, trigger_id = heapq.heappop(self._heap)
+                scheduled, _ = self._entries[trigger_id]
+                due.append((scheduled, fire_at))
+                # Count the next occurrence from now: after a long pause
+                # (suspend, restart) missed occurrences are not replayed.
+                # A trigger that fails here still fires this time.
+                if not self._push(scheduled, now):
+                    self._triggers_by_routine.get(scheduled.routine_id, set()).discard(trigger_id)
+                self._drop_stale()
+        return due
+
+    def _claim(self, scheduled: ScheduledTrigger, fire_at: float) -> bool:
+        from .models import TriggerClaim
+        return TriggerClaim.claim(scheduled.routine_id, f'{scheduled.type}:{int(fire_at)}')
+
+    def run_due(self) -> List[int]:
+        """Start the routines whose triggers are due; returns their ids"""
+        routine_ids = []
+        for scheduled, fire_at in self._pop_due(self.clock.now()):
+            if scheduled.routine_id in routine_ids or not self._claim(scheduled, fire_at):
+                continue
+            routine_ids.append(scheduled.routine_id)
+            print(f"Scheduler: {scheduled.type} trigger {scheduled.trigger_id}, starting routine {scheduled.routine_id}")
+            try:
+                self.runtime.submit(scheduled.routine_id)
+            except Exception as e:
+                print(f"Scheduler: could not start routine {scheduled.routine_id}: {e}")
+        return routine_ids
+
+    # Thread
+
+    def start(self):
+        """Load the schedule and start the scheduler thread (idempotent)"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop = False
+        self._safe(self.load)
+        self._thread = threading.Thread(target=self._run, name='routine-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        with self._condition:
+            self._stop = True
+            self._condition.notify()
+        if self._thread:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _safe(self, func):
+        close_old_connections()
+        try:
+            return func()
+        except Exception as e:
+            print(f"Scheduler: {e}")
+        finally:
+            close_old_connections()
+
+    def _check_for_remote_edits(self):
+        from apps.core.models import ChangeCounter
+        if ChangeCounter.current('routines') != self._loaded_counter:
+            self.load()
+
+    def _run(self):
+        while not self._stop:
+            self._safe(self.run_due)
+
+            # Sleep until the next deadline (forever without one): edits in
+            # this process notify the condition, stop() too
+            with self._condition:
+                if self._stop:
+                    break
+                deadline = self.next_deadline()
+                timeout = None
+                if deadline is not None:
+                    timeout = max((deadline - self.clock.now()).total_seconds(), 0)
+                self.clock.wait(self._condition, timeout)
+            # Woken up: catch up with edits made by other processes before firing
+            self._safe(self._check_for_remote_edits)
+
+
+# Singleton instance
+routine_scheduler = RoutineScheduler()
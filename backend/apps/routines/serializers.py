@@ -48,7 +48,7 @@ class NezuRoutineSerializer(serializers.ModelSerializer):
             
         for action_data in actions_data:
             RoutineAction.objects.create(routine=routine, **action_data)
-            
+
         return routine
 
     def update(self, instance, validated_data):
@@ -77,5 +77,5 @@ class NezuRoutineSerializer(serializers.ModelSerializer):
             instance.actions.all().delete()
             for action_data in actions_data:
                 RoutineAction.objects.create(routine=instance, **action_data)
-        
+
         return instance
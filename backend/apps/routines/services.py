@@ -1,48 +1,101 @@
-from .models import NezuRoutine
-from apps.core.services.ha_client import ha_client
+import hashlib
+import json
+
+from django.db import transaction
+from django.utils import timezone
+from .models import Scene
+from apps.core.models import ChangeCounter
 
 class RoutineService:
     @staticmethod
-    def execute_routine(routine_id):
+    def execute_routine(routine_id, timeout=None):
+        """
+        Execute a NezuRoutine and wait for it to finish.
+        Runs on the routine runtime like any other run; callers that should not
+        block (API, Alexa) use routine_runtime.submit() instead.
+        """
+        from .runtime import routine_runtime
+        execution = routine_runtime.submit(routine_id)
+        if not execution.wait(timeout):
+            raise TimeoutError(f"Routine {routine_id} still running after {timeout} seconds")
+        if execution.exception:
+            raise execution.exception
+        return execution.results()
+
+
+class SceneCatalogSync:
+    """
+    Mirrors HA scenes and automations into the Scene table.
+
+    Only the fields the catalog stores (entity_id, type, name, icon) are
+    fingerprinted, so state and `last_triggered` churn never cause a write.
+    When the fingerprint matches the last applied one, sync() returns
+    without touching the database; otherwise the difference is applied with
+    bulk queries in one transaction.
+    """
+    DOMAINS = ('scene', 'automation')
+
+    def __init__(self):
+        self.fingerprint = None
+
+    def catalog(self, states):
+        """{entity_id: {'type', 'name', 'icon'}} for the scenes/automations in `states`"""
+        catalog = {}
+        for state in states:
+            entity_id = state.get('entity_id', '')
+            domain = entity_id.split('.')[0]
+            if domain in self.DOMAINS:
+                attributes = state.get('attributes', {})
+                catalog[entity_id] = {
+                    'type': domain,
+                    'name': attributes.get('friendly_name', entity_id),
+                    'icon': attributes.get('icon', ''),
+                }
+        return catalog
+
+    @staticmethod
+    def fingerprint_of(catalog):
+        payload = json.dumps(catalog, sort_keys=True, default=str).encode()
+        return hashlib.sha1(payload).hexdigest()
+
+    def sync(self, states, force=False):
         """
-        Execute a NezuRoutine by iterating through its actions and calling HA services.
+        Apply the HA scene/automation set to the Scene table.
+        Returns None when nothing changed since the last sync, else a summary
+        dict with new/updated/removed counts.
         """
-        try:
-            routine = NezuRoutine.objects.get(id=routine_id)
-            results = []
-            
-            print(f"Executing routine: {routine.name} with {routine.actions.count()} actions")
-            
-            for action in routine.actions.all():
-                print(f"Processing action: {action.device_id} - {action.action_type}")
-                
-                if action.action_type == 'delay':
-                    import time
-                    delay_seconds = action.value
-                    print(f"Waiting for {delay_seconds} seconds...")
-                    time.sleep(delay_seconds)
-                    results.append({
-                        'action_id': action.id,
-                        'type': 'delay',
-                        'status': 'success'
-                    })
-                    continue
-
-                domain = action.device_id.split('.')[0]
-                service = action.action_type
-                
-                print(f"Calling HA service: {domain}.{service} for {action.device_id}")
-                ha_client.call_service(domain, service, {'entity_id': action.device_id})
-                
-                results.append({
-                    'action_id': action.id,
-                    'device_id': action.device_id,
-                    'status': 'success'
-                })
-                
-            print(f"Routine executed successfully: {len(results)} actions completed")
-            return results
-            
-        except Exception as e:
-            print(f"Error executing routine {routine_id}: {str(e)}")
-            raise e
+        catalog = self.catalog(states)
+        fingerprint = self.fingerprint_of(catalog)
+        if fingerprint == self.fingerprint and not force:
+            return None
+
+        existing = {scene.entity_id: scene for scene in Scene.objects.all()}
+        to_create = []
+        to_update = []
+        for entity_id, entry in catalog.items():
+            scene = existing.get(entity_id)
+            if scene is None:
+                to_create.append(Scene(entity_id=entity_id, **entry))
+            # Names are only taken from HA on creation, they can be edited here
+            elif scene.type != entry['type'] or scene.icon != entry['icon']:
+                scene.type = entry['type']
+                scene.icon = entry['icon']
+                # bulk_update does not apply auto_now
+                scene.updated_at = timezone.now()
+                to_update.append(scene)
+        to_delete = [scene.pk for entity_id, scene in existing.items() if entity_id not in catalog]
+
+        if to_create or to_update or to_delete:
+            with transaction.atomic():
+                if to_create:
+                    Scene.objects.bulk_create(to_create)
+                if to_update:
+                    Scene.objects.bulk_update(to_update, ['type', 'icon', 'updated_at'])
+                if to_delete:
+                    Scene.objects.filter(pk__in=to_delete).delete()
+                # Bulk queries skip the signals that bump the list's ETag counter
+                ChangeCounter.next_on_commit('scenes')
+            print(f"Scene catalog: {len(to_create)} new, {len(to_update)} updated, {len(to_delete)} removed")
+
+        self.fingerprint = fingerprint
+        return {'new': len(to_create), 'updated': len(to_update), 'removed': len(to_delete)}
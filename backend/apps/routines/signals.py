@@ -0,0 +1,57 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.core.models import ChangeCounter
+from .models import NezuRoutine, RoutineAction, RoutineTrigger, Scene
+from .plans import routine_plans
+
+# ETag counters for the scene and routine lists
+ChangeCounter.track(Scene, 'scenes')
+ChangeCounter.track(NezuRoutine, 'routines')
+ChangeCounter.track(RoutineTrigger, 'routines')
+ChangeCounter.track(RoutineAction, 'routines')
+
+
+def reindex_on_commit(routine_id: int):
+    """
+    Re-read a routine's triggers into the trigger engine and the scheduler
+    (waking its thread) once the edit is committed
+    """
+    def reindex():
+        from .scheduler import routine_scheduler
+        from .triggers import trigger_engine
+        trigger_engine.routine_changed(routine_id)
+        routine_scheduler.routine_changed(routine_id)
+    transaction.on_commit(reindex)
+
+
+@receiver(post_save, sender=NezuRoutine)
+def reindex_routine(sender, instance, **kwargs):
+    reindex_on_commit(instance.id)
+
+
+@receiver(post_save, sender=RoutineTrigger)
+@receiver(post_delete, sender=RoutineTrigger)
+def reindex_routine_for_trigger(sender, instance, **kwargs):
+    reindex_on_commit(instance.routine_id)
+
+
+@receiver(post_delete, sender=NezuRoutine)
+def unindex_routine_triggers(sender, instance, **kwargs):
+    from .scheduler import routine_scheduler
+    from .triggers import trigger_engine
+    trigger_engine.routine_removed(instance.id)
+    routine_scheduler.routine_removed(instance.id)
+
+
+@receiver(post_save, sender=NezuRoutine)
+@receiver(post_delete, sender=NezuRoutine)
+def drop_routine_plan(sender, instance, **kwargs):
+    routine_plans.invalidate(instance.id)
+
+
+@receiver(post_save, sender=RoutineAction)
+@receiver(post_delete, sender=RoutineAction)
+def drop_routine_plan_for_action(sender, instance, **kwargs):
+    routine_plans.invalidate(instance.routine_id)
@@ -0,0 +1,164 @@
+"""
+Offline sunrise/sunset/dawn/dusk times for `sun` RoutineTriggers.
+
+A year of solar events for the home's coordinates is computed in one
+vectorized NumPy pass (the NOAA "sunrise equation", good to about a
+minute), saved to SUN_TABLE_PATH, and answered with a binary search, so
+the scheduler never asks HA's `sun.sun` entity.
+"""
+import datetime
+import os
+import re
+import threading
+from typing import Dict, Optional
+
+import numpy as np
+from django.conf import settings
+
+# Sun elevation (degrees) at each event; -0.833 accounts for refraction and
+# the solar disc, -6 is civil twilight
+EVENTS = {
+    'sunrise': (-0.833, 'rise'),
+    'sunset': (-0.833, 'set'),
+    'dawn': (-6.0, 'rise'),
+    'dusk': (-6.0, 'set'),
+}
+UNIX_EPOCH_JD = 2440587.5
+J2000 = 2451545.0
+OBLIQUITY = np.radians(23.4397)
+
+SUN_VALUE = re.compile(r'^\s*(sunrise|sunset|dawn|dusk)\s*(?:([+-])\s*(\d+)\s*(?:m|min)?)?\s*$', re.IGNORECASE)
+
+
+def parse_sun_value(value: str):
+    """'sunset', 'sunrise-30', 'dusk + 15min' -> (event, offset in seconds)"""
+    match = SUN_VALUE.match(value or '')
+    if not match:
+        raise ValueError(f"Unknown sun event {value!r}")
+    event, sign, minutes = match.groups()
+    offset = int(minutes or 0) * 60 * (-1 if sign == '-' else 1)
+    return event.lower(), offset
+
+
+def compute_events(latitude: float, longitude: float, start: datetime.date, days: int) -> Dict[str, np.ndarray]:
+    """
+    UNIX timestamps of each event for `days` days from `start`, one array per
+    event, sorted. Days on which an event does not happen (polar day or
+    night) are left out.
+    """
+    # Julian day numbers of each date's UTC midnight, then days since J2000
+    start_jd = (datetime.datetime.combine(start, datetime.time(), datetime.timezone.utc).timestamp() / 86400
+                + UNIX_EPOCH_JD)
+    n = np.ceil(start_jd + np.arange(days) - J2000 + 0.0008)
+
+    mean_noon = n - longitude / 360.0
+    anomaly = np.radians((357.5291 + 0.98560028 * mean_noon) % 360)
+    center = 1.9148 * np.sin(anomaly) + 0.0200 * np.sin(2 * anomaly) + 0.0003 * np.sin(3 * anomaly)
+    ecliptic = np.radians((np.degrees(anomaly) + center + 180 + 102.9372) % 360)
+    transit = J2000 + mean_noon + 0.0053 * np.sin(anomaly) - 0.0069 * np.sin(2 * ecliptic)
+    declination = np.arcsin(np.sin(ecliptic) * np.sin(OBLIQUITY))
+
+    phi = np.radians(latitude)
+    events = {}
+    for name, (elevation, direction) in EVENTS.items():
+        with np.errstate(invalid='ignore'):
+            cos_hour_angle = ((np.sin(np.radians(elevation)) - np.sin(phi) * np.sin(declination))
+                              / (np.cos(phi) * np.cos(declination)))
+            hour_angle = np.degrees(np.arccos(cos_hour_angle))
+        julian = transit - hour_angle / 360 if direction == 'rise' else transit + hour_angle / 360
+        timestamps = (julian - UNIX_EPOCH_JD) * 86400
+        events[name] = np.sort(timestamps[~np.isnan(timestamps)])
+    return events
+
+
+class SunTable:
+    """Precomputed solar events for one location and date range"""
+
+    def __init__(self, latitude: float, longitude: float, start: datetime.date, days: int = 366,
+                 events: Dict[str, np.ndarray] = None):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.start = start
+        self.days = days
+        self.events = events if events is not None else compute_events(latitude, longitude, start, days)
+
+    @property
+    def end(self) -> datetime.date:
+        return self.start + datetime.timedelta(days=self.days)
+
+    def covers(self, latitude: float, longitude: float, when: datetime.datetime, margin_days: int = 2) -> bool:
+        """Same location and `when` (plus a margin) inside the table"""
+        day = when.astimezone(datetime.timezone.utc).date()
+        return (abs(self.latitude - latitude) < 1e-6 and abs(self.longitude - longitude) < 1e-6
+                and self.start <= day and day + datetime.timedelta(days=margin_days) < self.end)
+
+    def next_event(self, event: str, after: datetime.datetime) -> Optional[datetime.datetime]:
+        """First `event` strictly after `after`, or None past the end of the table"""
+        timestamps = self.events[event]
+        index = int(np.searchsorted(timestamps, after.timestamp(), side='right'))
+        if index == len(timestamps):
+            return None
+        return datetime.datetime.fromtimestamp(float(timestamps[index]), datetime.timezone.utc)
+
+    # Persistence
+
+    def save(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Write then rename, so concurrent readers never see half a file
+        temporary = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(temporary, latitude=self.latitude, longitude=self.longitude,
+                 start=self.start.toordinal(), days=self.days, **self.events)
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'SunTable':
+        with np.load(path) as data:
+            return cls(float(data['latitude']), float(data['longitude']),
+                       datetime.date.fromordinal(int(data['start'])), int(data['days']),
+                       events={name: data[name] for name in EVENTS})
+
+
+_table: Optional[SunTable] = None
+_table_lock = threading.Lock()
+
+
+def get_sun_table(when: datetime.datetime = None) -> SunTable:
+    """
+    Table for the home (HOME_LATITUDE/HOME_LONGITUDE) covering `when`:
+    kept in memory, else read from SUN_TABLE_PATH, else computed and saved.
+    Raises ValueError when the home coordinates are not configured.
+    """
+    global _table
+    latitude = getattr(settings, 'HOME_LATITUDE', None)
+    longitude = getattr(settings, 'HOME_LONGITUDE', None)
+    if latitude is None or longitude is None:
+        raise ValueError("HOME_LATITUDE and HOME_LONGITUDE must be set for sun triggers")
+    when = when or datetime.datetime.now(datetime.timezone.utc)
+
+    if _table is not None and _table.covers(latitude, longitude, when):
+        return _table
+    with _table_lock:
+        if _table is not None and _table.covers(latitude, longitude, when):
+            return _table
+
+        path = getattr(settings, 'SUN_TABLE_PATH', None)
+        table = None
+        if path and os.path.exists(path):
+            try:
+                table = SunTable.load(path)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Sun table: could not read {path}: {e}")
+        if table is None or not table.covers(latitude, longitude, when):
+            # Start a day early so the first hours of `when` (UTC vs local) are covered
+            start = when.astimezone(datetime.timezone.utc).date() - datetime.timedelta(days=1)
+            table = SunTable(latitude, longitude, start)
+            print(f"Sun table: computed {table.start} - {table.end} for {latitude}, {longitude}")
+            if path:
+                try:
+                    table.save(path)
+                except OSError as e:
+                    print(f"Sun table: could not save {path}: {e}")
+        _table = table
+        return table
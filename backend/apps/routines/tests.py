@@ -0,0 +1,816 @@
+import datetime
+import os
+import tempfile
+import time
+from unittest import mock
+
+import pytz
+
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from apps.core.models import ChangeCounter
+from apps.core.services.ha_async_client import AsyncHomeAssistantClient
+from apps.devices.tests import FakeHAHttpServer
+from .history import RunHistory, percentile
+from .models import (NezuRoutine, RoutineAction, RoutineActionResult, RoutineRun, RoutineTrigger, Scene,
+                     TriggerClaim)
+from . import plans as plans_module
+from .plans import PlanCache, routine_plans
+from .runtime import RoutineExecution, RoutineRuntime
+from .scheduler import ManualClock, RoutineScheduler, parse_days, routine_scheduler
+from .services import RoutineService, SceneCatalogSync
+from .sun import SunTable, get_sun_table, parse_sun_value
+from .timers import TimerQueue
+from .triggers import TriggerEngine, TriggerIndex, compile_condition, trigger_engine
+
+
+def ha_ok(calls, **kwargs):
+    return [([], 0.01)] * len(calls)
+
+
+def ha_down(calls, **kwargs):
+    return [(ConnectionError('HA down'), 0.01)] * len(calls)
+
+
+# Runs finish on worker threads, whose DB connections can't see (or write
+# past) the test transaction; RoutineRunHistoryTests records in-thread
+@override_settings(ROUTINE_RUN_HISTORY=False)
+class RoutineServiceTests(TestCase):
+    def setUp(self):
+        self.routine = NezuRoutine.objects.create(name='Buenas noches')
+        steps = [
+            ('light.sala', 'turn_off', 0),
+            ('light.cocina', 'turn_off', 0),
+            ('switch.tele', 'turn_off', 0),
+            (None, 'delay', 1),
+            ('light.pasillo', 'turn_off', 2),
+        ]
+        for device_id, action_type, order in steps:
+            RoutineAction.objects.create(routine=self.routine, device_id=device_id, action_type=action_type, order=order)
+
+    @mock.patch('apps.routines.runtime.dispatch_service_calls_timed')
+    def test_actions_between_delays_are_dispatched_together(self, dispatch):
+        dispatch.side_effect = ha_ok
+
+        with mock.patch('time.sleep') as sleep:
+            results = RoutineService.execute_routine(self.routine.id, timeout=5)
+
+        sleep.assert_not_called()
+        self.assertEqual([call[0][0] for call in dispatch.call_args_list], [
+            [
+                ('light', 'turn_off', {'entity_id': 'light.sala'}),
+                ('light', 'turn_off', {'entity_id': 'light.cocina'}),
+                ('switch', 'turn_off', {'entity_id': 'switch.tele'}),
+            ],
+            [('light', 'turn_off', {'entity_id': 'light.pasillo'})],
+        ])
+        self.assertEqual([result.get('device_id', result.get('type')) for result in results],
+                         ['light.sala', 'light.cocina', 'switch.tele', 'delay', 'light.pasillo'])
+
+    @mock.patch('apps.routines.runtime.dispatch_service_calls_timed')
+    def test_failed_call_stops_the_routine(self, dispatch):
+        dispatch.side_effect = ha_down
+
+        with self.assertRaises(ConnectionError):
+            RoutineService.execute_routine(self.routine.id, timeout=5)
+
+        self.assertEqual(dispatch.call_count, 1)
+
+
+@override_settings(ROUTINE_RUN_HISTORY=False)
+class RoutineRuntimeTests(TestCase):
+    def setUp(self):
+        self.routine = NezuRoutine.objects.create(name='Salir de casa')
+        RoutineAction.objects.create(routine=self.routine, device_id='light.sala', action_type='turn_off', order=0)
+        RoutineAction.objects.create(routine=self.routine, action_type='delay', value=60, order=1)
+        RoutineAction.objects.create(routine=self.routine, device_id='lock.puerta', action_type='lock', order=2)
+        self.runtime = RoutineRuntime(max_workers=2, timers=TimerQueue())
+
+    def wait_for_status(self, run_id, status):
+        for _ in range(200):
+            run = self.runtime.get_run(run_id)
+            if run['status'] == status:
+                return run
+            time.sleep(0.01)
+        self.fail(f"run never reached {status}: {run}")
+
+    @mock.patch('apps.routines.runtime.dispatch_service_calls_timed')
+    def test_delay_is_a_timer_not_a_blocked_thread(self, dispatch):
+        dispatch.side_effect = ha_ok
+
+        started = time.monotonic()
+        execution = self.runtime.submit(self.routine.id)
+        self.assertLess(time.monotonic() - started, 1)
+
+        run = self.wait_for_status(execution.id, 'waiting')
+        self.assertEqual([action['status'] for action in run['actions']], ['success', 'waiting', 'pending'])
+        self.assertIsNotNone(run['actions'][0]['duration_ms'])
+        self.assertEqual(len(self.runtime.timers), 1)
+
+        # Waiting runs hold no worker: more runs than workers all reach their delay
+        others = [self.runtime.submit(self.routine) for _ in range(3)]
+        for other in others:
+            self.wait_for_status(other.id, 'waiting')
+        self.assertEqual(len(self.runtime.timers), 4)
+
+    @mock.patch('apps.routines.runtime.dispatch_service_calls_timed')
+    def test_run_finishes_after_the_delay(self, dispatch):
+        dispatch.side_effect = ha_ok
+        RoutineAction.objects.filter(action_type='delay').update(value=0)
+
+        execution = self.runtime.submit(self.routine.id)
+        self.assertTrue(execution.wait(5))
+
+        run = self.runtime.get_run(execution.id)
+        self.assertEqual(run['status'], 'success')
+        self.assertEqual([action['status'] for action in run['actions']], ['success', 'success', 'success'])
+        self.assertEqual(dispatch.call_args_list[-1][0][0], [('lock', 'lock', {'entity_id': 'lock.puerta'})])
+
+    @mock.patch('apps.routines.runtime.dispatch_service_calls_timed')
+    def test_failure_skips_the_remaining_actions(self, dispatch):
+        dispatch.side_effect = ha_down
+
+        execution = self.runtime.submit(self.routine.id)
+        self.assertTrue(execution.wait(5))
+
+        run = self.runtime.get_run(execution.id)
+        self.assertEqual(run['status'], 'error')
+        self.assertEqual(run['error'], 'HA down')
+        self.assertEqual([action['status'] for action in run['actions']], ['error', 'skipped', 'skipped'])
+        self.assertEqual(len(self.runtime.timers), 0)
+
+
+@override_settings(ROUTINE_RUN_HISTORY=False)
+class RoutineRunEndpointTests(TestCase):
+    def setUp(self):
+        self.routine = NezuRoutine.objects.create(name='Cine')
+        RoutineAction.objects.create(routine=self.routine, device_id='light.sala', action_type='turn_off', order=0)
+
+    @mock.patch('apps.routines.runtime.dispatch_service_calls_timed')
+    def test_execute_returns_a_run_id_to_poll(self, dispatch):
+        dispatch.side_effect = ha_ok
+
+        response = self.client.post(f'/api/nezu-routines/{self.routine.id}/execute/')
+        self.assertEqual(response.status_code, 202)
+        run_id = response.json()['run_id']
+
+        for _ in range(200):
+            run = self.client.get(f'/api/nezu-routines/runs/{run_id}/').json()
+            if run['status'] == 'success':
+                break
+            time.sleep(0.01)
+        self.assertEqual(run['status'], 'success')
+        self.assertEqual(run['routine_id'], self.routine.id)
+        self.assertEqual(run['actions'][0]['device_id'], 'light.sala')
+        self.assertEqual(run['actions'][0]['status'], 'success')
+
+    def test_unknown_run(self):
+        response = self.client.get(f'/api/nezu-routines/runs/{"0" * 32}/')
+        self.assertEqual(response.status_code, 404)
+
+
+class RoutineRunHistoryTests(TestCase):
+    def setUp(self):
+        self.routine = NezuRoutine.objects.create(name='Llegar a casa')
+        RoutineAction.objects.create(routine=self.routine, device_id='light.sala', action_type='turn_on', order=0)
+        RoutineAction.objects.create(routine=self.routine, device_id='lock.puerta', action_type='unlock', order=1)
+        RoutineAction.objects.create(routine=self.routine, device_id='climate.salon', action_type='turn_on', order=2)
+        routine_plans.invalidate(self.routine.id)
+        self.history = RunHistory(retention_days=30)
+
+    def failed_execution(self):
+        execution = RoutineExecution(routine_plans.get(self.routine.id))
+        execution.set_status('running')
+        execution.action_started(0)
+        execution.action_finished(0, ha_seconds=0.05)
+        execution.action_started(1)
+        execution.action_finished(1, ConnectionError('HA down'), ha_seconds=0.2)
+        execution.finish(ConnectionError('HA down'))
+        return execution
+
+    def add_run(self, routine, duration_ms, started_at=None, status='success', entity_results=()):
+        run = RoutineRun.objects.create(
+            run_id=f'{RoutineRun.objects.count():032x}', routine=routine, status=status,
+            started_at=started_at or timezone.now(), finished_at=timezone.now(), duration_ms=duration_ms)
+        RoutineActionResult.objects.bulk_create([
+            RoutineActionResult(run=run, entity_id=entity_id, action_type='turn_on', status=action_status, ha_ms=ha_ms)
+            for entity_id, action_status, ha_ms in entity_results
+        ])
+        return run
+
+    def test_run_is_written_with_two_inserts(self):
+        execution = self.failed_execution()
+        self.history._pruned_at = time.monotonic()
+
+        with CaptureQueriesContext(connection) as queries:
+            run = self.history.record(execution)
+
+        inserts = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 2)
+        self.assertEqual(run.run_id, execution.id)
+        self.assertEqual(run.status, 'error')
+        self.assertEqual(run.error, 'HA down')
+        self.assertGreaterEqual(run.duration_ms, 0)
+        results = list(run.action_results.order_by('id').values_list('entity_id', 'status', 'ha_ms', 'error'))
+        self.assertEqual(results, [
+            ('light.sala', 'success', 50.0, ''),
+            ('lock.puerta', 'error', 200.0, 'HA down'),
+            ('climate.salon', 'skipped', None, ''),
+        ])
+
+    def test_runtime_hands_finished_runs_to_its_history(self):
+        history = mock.Mock()
+        runtime = RoutineRuntime(max_workers=1, timers=TimerQueue(), history=history)
+        with mock.patch('apps.routines.runtime.dispatch_service_calls_timed', side_effect=ha_ok):
+            execution = runtime.submit(self.routine.id)
+            self.assertTrue(execution.wait(5))
+        for _ in range(200):
+            if history.record_safely.called:
+                break
+            time.sleep(0.01)
+        history.record_safely.assert_called_once_with(execution)
+
+    def test_finished_runs_are_found_from_another_worker(self):
+        execution = self.failed_execution()
+        self.history.record(execution)
+        # Another worker: its own process-local cache has never seen the run
+        other_worker = RoutineRuntime(max_workers=1, timers=TimerQueue(), history=self.history,
+                                      cache_alias='routine-history-tests')
+        with override_settings(CACHES={'routine-history-tests': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'routine-history-tests'}}):
+            run = other_worker.get_run(execution.id)
+        snapshot = execution.snapshot()
+        self.assertEqual({key: run[key] for key in ('id', 'routine_name', 'status', 'error', 'finished_at')},
+                         {key: snapshot[key] for key in ('id', 'routine_name', 'status', 'error', 'finished_at')})
+        self.assertEqual([(action['device_id'], action['status']) for action in run['actions']],
+                         [(action['device_id'], action['status']) for action in snapshot['actions']])
+        self.assertIsNone(self.history.get_run('0' * 32))
+
+    def test_old_runs_are_pruned_in_batches(self):
+        old = timezone.now() - datetime.timedelta(days=40)
+        for i in range(5):
+            self.add_run(self.routine, 100, started_at=old + datetime.timedelta(minutes=i),
+                         entity_results=[('light.sala', 'success', 10)])
+        recent = self.add_run(self.routine, 100, entity_results=[('light.sala', 'success', 10)])
+
+        history = RunHistory(retention_days=30, batch_size=2)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(history.prune(), 5)
+
+        deletes = [query for query in queries.captured_queries if query['sql'].startswith('DELETE')]
+        # Three batches (2 + 2 + 1), each deleting action results then runs
+        self.assertEqual(len(deletes), 6)
+        self.assertEqual(list(RoutineRun.objects.values_list('id', flat=True)), [recent.id])
+        self.assertEqual(RoutineActionResult.objects.count(), 1)
+
+    def test_percentile(self):
+        values = list(range(1, 21))
+        self.assertEqual(percentile(values, 0.5), 10)
+        self.assertEqual(percentile(values, 0.95), 19)
+        self.assertEqual(percentile([7], 0.95), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_stats_endpoint(self):
+        slow = NezuRoutine.objects.create(name='Lenta')
+        for duration in range(1, 21):
+            self.add_run(self.routine, duration, entity_results=[('light.sala', 'success', 5)])
+        self.add_run(slow, 900, status='error', entity_results=[('lock.puerta', 'error', 3000)])
+        self.add_run(slow, 1000, entity_results=[('lock.puerta', 'success', 800)])
+        self.add_run(slow, 5000, started_at=timezone.now() - datetime.timedelta(days=10))
+
+        response = self.client.get('/api/nezu-routines/stats/?days=7')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+
+        routines = data['routines']
+        self.assertEqual([entry['name'] for entry in routines], ['Lenta', 'Llegar a casa'])
+        self.assertEqual((routines[0]['runs'], routines[0]['errors'], routines[0]['max_ms']), (2, 1, 1000))
+        self.assertEqual((routines[1]['runs'], routines[1]['p50_ms'], routines[1]['p95_ms']), (20, 10, 19))
+
+        entities = data['entities']
+        self.assertEqual(entities[0]['entity_id'], 'lock.puerta')
+        self.assertEqual((entities[0]['calls'], entities[0]['error_rate'], entities[0]['p95_ms']), (2, 0.5, 3000))
+        self.assertEqual(entities[1]['error_rate'], 0)
+
+        for days in ('x', '0', '-1', '3651', '99999999999'):
+            self.assertEqual(self.client.get(f'/api/nezu-routines/stats/?days={days}').status_code, 400)
+
+
+class SceneCatalogSyncTests(TestCase):
+    def setUp(self):
+        self.states = [
+            {'entity_id': f'scene.escena_{i}', 'state': '2026-01-01T00:00:00', 'attributes': {'friendly_name': f'Escena {i}'}}
+            for i in range(20)
+        ]
+        self.states += [
+            {'entity_id': f'automation.auto_{i}', 'state': 'on',
+             'attributes': {'friendly_name': f'Auto {i}', 'icon': 'mdi:robot', 'last_triggered': None}}
+            for i in range(5)
+        ]
+        self.states.append({'entity_id': 'light.sala', 'state': 'on', 'attributes': {}})
+        self.sync = SceneCatalogSync()
+
+    def test_unchanged_catalog_costs_no_queries(self):
+        self.assertEqual(self.sync.sync(self.states), {'new': 25, 'updated': 0, 'removed': 0})
+
+        # State and last_triggered churn is not part of the fingerprint
+        self.states[0] = dict(self.states[0], state='2026-02-01T00:00:00')
+        self.states[20] = dict(self.states[20], attributes=dict(self.states[20]['attributes'], last_triggered='now'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.sync.sync(self.states))
+
+    def test_changes_are_applied_in_bulk(self):
+        self.sync.sync(self.states)
+        self.states[1] = dict(self.states[1], attributes={'friendly_name': 'Escena 1', 'icon': 'mdi:sofa'})
+        del self.states[2]
+        self.states.append({'entity_id': 'scene.nueva', 'state': 'x', 'attributes': {'friendly_name': 'Nueva'}})
+
+        # SELECT, SAVEPOINT, INSERT, UPDATE, DELETE (SELECT + DELETE for the
+        # delete signals), counter bumps, RELEASE: independent of catalog size
+        with CaptureQueriesContext(connection) as queries:
+            summary = self.sync.sync(self.states)
+        self.assertEqual(summary, {'new': 1, 'updated': 1, 'removed': 1})
+        self.assertLess(len(queries), 15)
+        self.assertEqual(Scene.objects.get(entity_id='scene.escena_1').icon, 'mdi:sofa')
+        self.assertFalse(Scene.objects.filter(entity_id='scene.escena_2').exists())
+        self.assertEqual(Scene.objects.get(entity_id='scene.nueva').type, 'scene')
+
+    def test_list_is_a_pure_read(self):
+        self.sync.sync(self.states)
+        for _ in range(3):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/api/scenes/')
+            self.assertEqual(len(response.json()), 25)
+            # ETag counters + scenes
+            self.assertEqual([query['sql'].split()[0] for query in queries.captured_queries], ['SELECT', 'SELECT'])
+
+
+class TriggerEngineTests(TestCase):
+    def setUp(self):
+        self.routine = NezuRoutine.objects.create(name='Calor')
+        RoutineTrigger.objects.create(routine=self.routine, type='device_state',
+                                      entity_id='sensor.temperatura', condition='>', value='25')
+        RoutineTrigger.objects.create(routine=self.routine, type='device_state',
+                                      entity_id='binary_sensor.puerta', condition='==', value='On')
+        inactive = NezuRoutine.objects.create(name='Apagada', is_active=False)
+        RoutineTrigger.objects.create(routine=inactive, type='device_state',
+                                      entity_id='sensor.temperatura', condition='>', value='0')
+
+        self.runtime = mock.Mock()
+        self.engine = TriggerEngine(runtime=self.runtime, mirror=mock.Mock(), recheck_interval=3600)
+        self.engine.reload()
+
+    def change(self, entity_id, old, new, when='2026-01-01T00:00:00'):
+        return self.engine.on_state_changed(
+            entity_id,
+            None if old is None else {'entity_id': entity_id, 'state': old},
+            {'entity_id': entity_id, 'state': new, 'last_updated': when},
+            1,
+        )
+
+    def test_compiled_comparators(self):
+        above = compile_condition('>', '25')
+        self.assertTrue(above('25.5'))
+        self.assertFalse(above('25'))
+        self.assertFalse(above('unavailable'))
+        self.assertTrue(compile_condition('==', 'On')('on'))
+        self.assertTrue(compile_condition('!=', 'off')('on'))
+        with self.assertRaises(ValueError):
+            compile_condition('>', 'sunset')
+        with self.assertRaises(ValueError):
+            compile_condition('~', 'on')
+
+    def test_fires_on_the_rising_edge_only(self):
+        self.assertEqual(self.change('sensor.temperatura', '24', '26', when='t1'), [self.routine.id])
+        self.assertEqual(self.change('sensor.temperatura', '26', '27', when='t2'), [])
+        self.assertEqual(self.change('sensor.temperatura', '27', '20', when='t3'), [])
+        self.assertEqual(self.change('sensor.temperatura', '20', '30', when='t4'), [self.routine.id])
+        # No previous state (startup snapshot): no edge
+        self.assertEqual(self.change('binary_sensor.puerta', None, 'on'), [])
+        self.assertEqual([call[0][0] for call in self.runtime.submit.call_args_list], [self.routine.id] * 2)
+
+    def test_unwatched_entities_cost_no_queries(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.change('light.sala', 'off', 'on'), [])
+            self.assertEqual(self.change('sensor.temperatura', '20', '21'), [])
+
+    def test_same_event_is_claimed_once(self):
+        other_worker = TriggerEngine(runtime=mock.Mock(), mirror=mock.Mock(), index=self.engine.index,
+                                     recheck_interval=3600)
+        self.assertEqual(self.change('binary_sensor.puerta', 'off', 'on', when='t9'), [self.routine.id])
+        self.assertEqual(other_worker.on_state_changed(
+            'binary_sensor.puerta', {'state': 'off'}, {'state': 'on', 'last_updated': 't9'}, 1), [])
+        self.assertEqual(TriggerClaim.objects.filter(routine=self.routine).count(), 1)
+
+    def test_old_claims_are_pruned(self):
+        self.change('binary_sensor.puerta', 'off', 'on', when='t1')
+        TriggerClaim.objects.update(created_at=timezone.now() - TriggerClaim.RETENTION * 2)
+        self.change('binary_sensor.puerta', 'off', 'on', when='t2')
+        TriggerClaim.prune(force=True)
+        self.assertEqual(list(TriggerClaim.objects.values_list('occurrence', flat=True)),
+                         ['state:binary_sensor.puerta@t2'])
+
+    def test_index_is_updated_per_routine(self):
+        index = self.engine.index
+        self.assertEqual(len(index), 2)
+
+        RoutineTrigger.objects.filter(entity_id='binary_sensor.puerta').update(entity_id='binary_sensor.ventana')
+        with self.assertNumQueries(1):
+            index.refresh_routine(self.routine.id)
+        self.assertEqual(index.triggers_for('binary_sensor.puerta'), ())
+        self.assertEqual(len(index.triggers_for('binary_sensor.ventana')), 1)
+
+        index.remove_routine(self.routine.id)
+        self.assertEqual(len(index), 0)
+
+    def test_serializer_reindexes_the_routine(self):
+        with mock.patch.object(trigger_engine, 'routine_changed') as routine_changed:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.put(f'/api/nezu-routines/{self.routine.id}/', {
+                    'name': 'Calor', 'icon': 'Play', 'color': 'blue', 'is_active': True,
+                    'triggers': [{'type': 'device_state', 'entity_id': 'sensor.humedad', 'condition': '>', 'value': '70'}],
+                }, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        # Once per saved routine/trigger row, all after the commit
+        self.assertEqual({call.args for call in routine_changed.call_args_list}, {(self.routine.id,)})
+
+    def test_ten_thousand_triggers(self):
+        # 2,000 entities x 5 triggers; a burst of 1,000 events must be handled
+        # in well under a second (i.e. keep up with 1k events/s)
+        triggers = [
+            RoutineTrigger(id=i, routine_id=i // 5, type='device_state',
+                           entity_id=f'sensor.s{i // 5}', condition='>', value=str(i % 5 * 10))
+            for i in range(10000)
+        ]
+        index = TriggerIndex()
+        index.load(triggers)
+        self.assertEqual(len(index), 10000)
+
+        started = time.perf_counter()
+        fired = 0
+        for n in range(1000):
+            entity_id = f'sensor.s{n * 7 % 2000}'
+            fired += len(index.match(entity_id, {'state': '5'}, {'state': '35'}))
+        elapsed = time.perf_counter() - started
+
+        self.assertEqual(fired, 3000)
+        self.assertLess(elapsed, 0.5)
+
+
+class RoutineSchedulerTests(TestCase):
+    def setUp(self):
+        self.tz = pytz.timezone('Europe/Madrid')
+        # Friday 2026-03-27 06:00 local
+        self.clock = ManualClock(self.tz.localize(datetime.datetime(2026, 3, 27, 6, 0)))
+        self.runtime = mock.Mock()
+        self.routine = NezuRoutine.objects.create(name='Despertar')
+        self.trigger = RoutineTrigger.objects.create(routine=self.routine, type='time',
+                                                     time=datetime.time(7, 0), days='weekdays')
+        self.weekend = NezuRoutine.objects.create(name='Finde')
+        RoutineTrigger.objects.create(routine=self.weekend, type='time', time=datetime.time(9, 30), days='["sat", "dom"]')
+
+    def scheduler(self):
+        scheduler = RoutineScheduler(runtime=self.runtime, clock=self.clock, tz=self.tz)
+        scheduler.load()
+        return scheduler
+
+    def local(self, when):
+        return when.astimezone(self.tz).replace(tzinfo=None)
+
+    def test_parse_days(self):
+        self.assertEqual(parse_days('daily'), frozenset(range(7)))
+        self.assertEqual(parse_days('weekends'), frozenset((5, 6)))
+        self.assertEqual(parse_days('["mon", "miércoles", 4]'), frozenset((0, 2, 4)))
+        with self.assertRaises(ValueError):
+            parse_days('sometimes')
+
+    def test_fires_at_each_deadline_and_reschedules(self):
+        scheduler = self.scheduler()
+        self.assertEqual(self.local(scheduler.next_deadline()), datetime.datetime(2026, 3, 27, 7, 0))
+
+        self.clock.advance(minutes=59)
+        self.assertEqual(scheduler.run_due(), [])
+        self.clock.advance(minutes=1)
+        self.assertEqual(scheduler.run_due(), [self.routine.id])
+        self.assertEqual(scheduler.run_due(), [])
+
+        # Saturday morning: the weekend routine, then Monday for the weekday one
+        self.assertEqual(self.local(scheduler.next_deadline()), datetime.datetime(2026, 3, 28, 9, 30))
+        self.clock.advance(days=1, hours=3)
+        self.assertEqual(scheduler.run_due(), [self.weekend.id])
+        self.clock.advance(days=1)
+        # Sunday 29 March: the clocks go forward, 09:30 is still 09:30 local
+        self.assertEqual(scheduler.run_due(), [self.weekend.id])
+        self.assertEqual(self.local(scheduler.next_deadline()), datetime.datetime(2026, 3, 30, 7, 0))
+        self.assertEqual(self.runtime.submit.call_count, 3)
+
+    def test_edits_replace_only_that_routine(self):
+        scheduler = self.scheduler()
+        self.trigger.time = datetime.time(6, 30)
+        self.trigger.save()
+
+        with self.assertNumQueries(1):
+            scheduler.refresh_routine(self.routine.id)
+        self.assertEqual(len(scheduler), 2)
+        self.assertEqual(self.local(scheduler.next_deadline()), datetime.datetime(2026, 3, 27, 6, 30))
+
+        scheduler.refresh_routine(self.routine.id, triggers=[])
+        self.assertEqual(len(scheduler), 1)
+        # The old 06:30 heap entry is stale and skipped
+        self.assertEqual(self.local(scheduler.next_deadline()), datetime.datetime(2026, 3, 28, 9, 30))
+
+    def test_thread_sleeps_until_the_next_deadline(self):
+        scheduler = self.scheduler()
+        waits = []
+
+        def wait(condition, seconds):
+            waits.append(seconds)
+            scheduler._stop = True
+        with mock.patch.object(self.clock, 'wait', side_effect=wait):
+            scheduler._run()
+        self.assertEqual(waits, [3600])
+
+        scheduler = RoutineScheduler(runtime=self.runtime, clock=self.clock, tz=self.tz)
+        scheduler.load(triggers=[])
+        waits.clear()
+        with mock.patch.object(self.clock, 'wait', side_effect=wait):
+            scheduler._run()
+        self.assertEqual(waits, [None])
+
+    def test_saved_triggers_wake_the_scheduler(self):
+        with mock.patch.object(routine_scheduler, 'routine_changed') as routine_changed:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.trigger.time = datetime.time(6, 30)
+                self.trigger.save()
+                routine_changed.assert_not_called()
+            routine_changed.assert_called_once_with(self.routine.id)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.weekend.is_active = False
+                self.weekend.save()
+            routine_changed.assert_called_with(self.weekend.id)
+
+    def test_same_occurrence_is_claimed_once(self):
+        scheduler, other_worker = self.scheduler(), self.scheduler()
+        self.clock.advance(hours=1)
+        self.assertEqual(scheduler.run_due(), [self.routine.id])
+        self.assertEqual(other_worker.run_due(), [])
+        self.assertEqual(self.runtime.submit.call_count, 1)
+
+    def test_missed_occurrences_are_not_replayed(self):
+        scheduler = self.scheduler()
+        self.clock.advance(days=5)
+        self.assertEqual(sorted(scheduler.run_due()), sorted([self.routine.id, self.weekend.id]))
+        self.assertEqual(scheduler.run_due(), [])
+
+    def test_a_broken_trigger_does_not_drop_the_others(self):
+        scheduler = self.scheduler()
+        coffee = NezuRoutine.objects.create(name='Café')
+        RoutineTrigger.objects.create(routine=coffee, type='time', time=datetime.time(7, 0), days='daily')
+        scheduler.refresh_routine(coffee.id)
+        # Bad data that only shows when the next occurrence is computed
+        scheduled, _ = scheduler._entries[self.trigger.id]
+        scheduled.next_fire = mock.Mock(side_effect=ValueError('No matching day'))
+
+        self.clock.advance(hours=1)
+        self.assertEqual(sorted(scheduler.run_due()), sorted([self.routine.id, coffee.id]))
+        self.assertNotIn(self.trigger.id, scheduler._entries)
+        self.assertEqual(len(scheduler), 2)
+        self.assertEqual(self.local(scheduler.next_deadline()), datetime.datetime(2026, 3, 28, 7, 0))
+
+    def test_thousands_of_triggers(self):
+        triggers = [
+            RoutineTrigger(id=i, routine_id=i, type='time', time=datetime.time(i % 24, i % 60), days='daily')
+            for i in range(5000)
+        ]
+        scheduler = RoutineScheduler(runtime=self.runtime, clock=self.clock, tz=self.tz)
+        # The heap is under test here, not the claims (whose routines don't exist)
+        scheduler._claim = lambda scheduled, fire_at: True
+        started = time.perf_counter()
+        scheduler.load(triggers)
+        self.clock.advance(hours=24)
+        fired = scheduler.run_due()
+        elapsed = time.perf_counter() - started
+        self.assertEqual(len(fired), 5000)
+        self.assertLess(elapsed, 2)
+
+
+class SunTableTests(TestCase):
+    # Almanac times (local), within the ~1 minute accuracy of the equation
+    ALMANAC = [
+        ('Europe/London', 51.5074, -0.1278, datetime.date(2024, 12, 21), {'sunrise': (8, 4), 'sunset': (15, 53)}),
+        ('Europe/London', 51.5074, -0.1278, datetime.date(2024, 6, 20), {'sunrise': (4, 43), 'sunset': (21, 21)}),
+        ('Europe/Madrid', 40.4168, -3.7038, datetime.date(2024, 6, 21), {'sunrise': (6, 45), 'sunset': (21, 48)}),
+        ('America/New_York', 40.7128, -74.0060, datetime.date(2024, 3, 20), {'sunrise': (6, 59), 'sunset': (19, 8)}),
+    ]
+
+    def test_matches_almanac_values(self):
+        for tz_name, latitude, longitude, day, expected in self.ALMANAC:
+            tz = pytz.timezone(tz_name)
+            table = SunTable(latitude, longitude, day - datetime.timedelta(days=1), days=3)
+            midnight = tz.localize(datetime.datetime.combine(day, datetime.time()))
+            for event, (hour, minute) in expected.items():
+                found = table.next_event(event, midnight).astimezone(tz)
+                expected_at = tz.localize(datetime.datetime.combine(day, datetime.time(hour, minute)))
+                self.assertLess(abs((found - expected_at).total_seconds()), 120, (tz_name, day, event, found))
+            dawn, sunrise = table.next_event('dawn', midnight), table.next_event('sunrise', midnight)
+            self.assertTrue(datetime.timedelta(minutes=20) < sunrise - dawn < datetime.timedelta(minutes=60))
+
+    def test_polar_night_has_no_sunrise(self):
+        table = SunTable(69.6492, 18.9553, datetime.date(2024, 12, 10), days=20)
+        self.assertIsNone(table.next_event('sunrise', datetime.datetime(2024, 12, 10, tzinfo=datetime.timezone.utc)))
+        self.assertIsNotNone(table.next_event('dawn', datetime.datetime(2024, 12, 10, tzinfo=datetime.timezone.utc)))
+
+    def test_table_is_persisted_and_reused(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'sun.npz')
+            when = datetime.datetime(2026, 5, 1, tzinfo=datetime.timezone.utc)
+            with self.settings(HOME_LATITUDE=40.4168, HOME_LONGITUDE=-3.7038, SUN_TABLE_PATH=path), \
+                    mock.patch('apps.routines.sun._table', None):
+                table = get_sun_table(when)
+                self.assertEqual(table.days, 366)
+                self.assertTrue(os.path.exists(path))
+
+            with self.settings(HOME_LATITUDE=40.4168, HOME_LONGITUDE=-3.7038, SUN_TABLE_PATH=path), \
+                    mock.patch('apps.routines.sun._table', None), \
+                    mock.patch('apps.routines.sun.compute_events') as compute:
+                loaded = get_sun_table(when)
+                compute.assert_not_called()
+                self.assertEqual(loaded.next_event('sunset', when), table.next_event('sunset', when))
+
+    def test_sun_trigger_schedule(self):
+        self.assertEqual(parse_sun_value('sunset'), ('sunset', 0))
+        self.assertEqual(parse_sun_value('Sunrise - 30'), ('sunrise', -1800))
+        self.assertEqual(parse_sun_value('dusk+15min'), ('dusk', 900))
+        with self.assertRaises(ValueError):
+            parse_sun_value('noon')
+
+        tz = pytz.timezone('Europe/Madrid')
+        routine = NezuRoutine.objects.create(name='Atardecer')
+        RoutineTrigger.objects.create(routine=routine, type='sun', value='sunset-30', days='daily')
+        clock = ManualClock(tz.localize(datetime.datetime(2024, 6, 21, 12, 0)))
+        with tempfile.TemporaryDirectory() as directory, \
+                self.settings(HOME_LATITUDE=40.4168, HOME_LONGITUDE=-3.7038,
+                              SUN_TABLE_PATH=os.path.join(directory, 'sun.npz')), \
+                mock.patch('apps.routines.sun._table', None):
+            scheduler = RoutineScheduler(runtime=mock.Mock(), clock=clock, tz=tz)
+            scheduler.load()
+            deadline = scheduler.next_deadline().astimezone(tz)
+            # Sunset 21:48 minus 30 minutes
+            self.assertEqual((deadline.hour, deadline.minute), (21, 18))
+
+    def test_sun_triggers_are_skipped_without_coordinates(self):
+        routine = NezuRoutine.objects.create(name='Atardecer')
+        RoutineTrigger.objects.create(routine=routine, type='sun', value='sunset')
+        with self.settings(HOME_LATITUDE=None, HOME_LONGITUDE=None), mock.patch('apps.routines.sun._table', None):
+            scheduler = RoutineScheduler(runtime=mock.Mock())
+            scheduler.load()
+        self.assertEqual(len(scheduler), 0)
+
+
+@override_settings(ROUTINE_RUN_HISTORY=False)
+class RoutinePlanTests(TestCase):
+    def setUp(self):
+        self.routine = NezuRoutine.objects.create(name='Noche')
+        steps = [
+            ('light.sala', 'turn_off', 0, 0),
+            ('switch.tele', 'turn_off', 0, 0),
+            (None, 'delay', 30, 1),
+            ('lock.puerta', 'lock', 0, 2),
+        ]
+        for device_id, action_type, value, order in steps:
+            RoutineAction.objects.create(routine=self.routine, device_id=device_id, action_type=action_type,
+                                         value=value, order=order)
+        self.plans = PlanCache(recheck_interval=3600)
+
+    def test_compiled_plan(self):
+        plan = self.plans.get(self.routine.id)
+        self.assertEqual(len(plan.steps), 3)
+        first, delay, last = plan.steps
+        self.assertEqual([action.call for action in first.actions], [
+            ('light', 'turn_off', {'entity_id': 'light.sala'}),
+            ('switch', 'turn_off', {'entity_id': 'switch.tele'}),
+        ])
+        self.assertEqual((delay.index, delay.seconds), (2, 30))
+        self.assertEqual(last.actions[0].domain, 'lock')
+        self.assertEqual(plan.total_delay, 30)
+        self.assertEqual(plan.call_count, 3)
+
+    def test_cached_plan_costs_no_queries(self):
+        self.plans.get(self.routine.id)
+        with self.assertNumQueries(0):
+            self.assertIs(self.plans.get(self.routine.id), self.plans.get(str(self.routine.id)))
+
+    @mock.patch('apps.routines.runtime.dispatch_service_calls_timed')
+    def test_submit_is_query_free_once_compiled(self, dispatch):
+        dispatch.side_effect = ha_ok
+        RoutineAction.objects.filter(action_type='delay').update(value=0)
+        routine_plans.invalidate(self.routine.id)
+        runtime = RoutineRuntime(max_workers=1, timers=TimerQueue())
+
+        runtime.submit(self.routine.id).wait(5)
+        with mock.patch.object(routine_plans, 'recheck_interval', 3600), self.assertNumQueries(0):
+            execution = runtime.submit(self.routine.id)
+        self.assertTrue(execution.wait(5))
+        self.assertEqual(execution.status, 'success')
+
+    def test_edits_drop_the_plan(self):
+        with mock.patch('apps.routines.signals.routine_plans', self.plans):
+            self.plans.get(self.routine.id)
+            action = self.routine.actions.get(action_type='lock')
+            action.action_type = 'unlock'
+            action.save()
+            self.assertEqual(self.plans.get(self.routine.id).steps[-1].actions[0].service, 'unlock')
+
+            self.client.put(f'/api/nezu-routines/{self.routine.id}/', {
+                'name': 'Noche', 'icon': 'Play', 'color': 'blue', 'is_active': True,
+                'actions': [{'device_id': 'light.sala', 'action_type': 'turn_on', 'order': 0}],
+            }, content_type='application/json')
+            plan = self.plans.get(self.routine.id)
+        self.assertEqual(len(plan.steps), 1)
+        self.assertEqual(plan.steps[0].actions[0].service, 'turn_on')
+
+    def test_edits_during_compilation_are_not_overwritten(self):
+        compile_plan = plans_module.compile_plan
+
+        def compile_and_edit(routine, actions):
+            plan = compile_plan(routine, actions)
+            # The routine is edited (and its plan dropped) before the stale plan is stored
+            self.plans.invalidate(routine.id)
+            return plan
+        with mock.patch.object(plans_module, 'compile_plan', side_effect=compile_and_edit):
+            self.plans.get(self.routine.id)
+        self.assertEqual(len(self.plans), 0)
+        self.plans.get(self.routine.id)
+        self.assertEqual(len(self.plans), 1)
+
+    def test_edits_from_other_processes_are_noticed(self):
+        plans = PlanCache(recheck_interval=0)
+        plan = plans.get(self.routine.id)
+        self.assertIs(plans.get(self.routine.id), plan)
+        # Another worker edited a routine: only the counter tells us
+        ChangeCounter.next('routines')
+        self.assertIsNot(plans.get(self.routine.id), plan)
+
+
+@override_settings(ROUTINE_RUN_HISTORY=False)
+class RoutineStageTests(TestCase):
+    LATENCY = 0.05
+
+    def create_routine(self, name, orders):
+        routine = NezuRoutine.objects.create(name=name)
+        RoutineAction.objects.bulk_create([
+            RoutineAction(routine=routine, device_id=f'light.luz_{i}', action_type='turn_off', order=order)
+            for i, order in enumerate(orders)
+        ])
+        routine_plans.invalidate(routine.id)
+        return routine
+
+    def run_routine(self, routine, server, **kwargs):
+        runtime = RoutineRuntime(max_workers=1, timers=TimerQueue(), **kwargs)
+        with mock.patch('apps.core.services.ha_async_client.async_ha_client',
+                        AsyncHomeAssistantClient(base_url=server.url, token='t')):
+            started = time.perf_counter()
+            execution = runtime.submit(routine)
+            self.assertTrue(execution.wait(10))
+            return execution, time.perf_counter() - started
+
+    def test_order_defines_stages(self):
+        routine = self.create_routine('Etapas', [0, 0, 1, 1, 1, 2])
+        RoutineAction.objects.create(routine=routine, action_type='delay', value=0, order=1)
+        plan = routine_plans.get(routine.id)
+        # Order 0, order 1 up to the delay, the delay, the rest of order 1, order 2
+        self.assertEqual([len(getattr(step, 'actions', ())) for step in plan.steps], [2, 3, 0, 1])
+        self.assertEqual([getattr(step, 'order', None) for step in plan.steps], [0, 1, None, 2])
+
+    def test_shared_order_runs_concurrently(self):
+        together = self.create_routine('Buenas noches', [0] * 25)
+        one_by_one = self.create_routine('Una a una', range(25))
+
+        with FakeHAHttpServer(latency=self.LATENCY) as server:
+            # Warm up the event loop and connection pool
+            self.run_routine(self.create_routine('Calentar', [0]), server)
+            execution, elapsed_together = self.run_routine(together, server)
+            _, elapsed_one_by_one = self.run_routine(one_by_one, server)
+
+        self.assertEqual(execution.status, 'success')
+        self.assertLess(elapsed_together, 5 * self.LATENCY)
+        self.assertGreater(elapsed_one_by_one, 20 * self.LATENCY)
+        actions = execution.snapshot()['actions']
+        self.assertEqual(len(actions), 25)
+        for action in actions:
+            self.assertGreaterEqual(action['ha_ms'], self.LATENCY * 1000 * 0.9)
+            self.assertIsNotNone(action['duration_ms'])
+
+    def test_slow_actions_time_out(self):
+        routine = self.create_routine('Lenta', [0, 1])
+        with FakeHAHttpServer(latency=0.5) as server:
+            execution, elapsed = self.run_routine(routine, server, action_timeout=0.1)
+
+        self.assertLess(elapsed, 0.45)
+        self.assertEqual(execution.status, 'error')
+        self.assertIn('timed out', execution.error)
+        self.assertEqual([action['status'] for action in execution.snapshot()['actions']], ['error', 'skipped'])
@@ -0,0 +1,82 @@
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable, Optional
+
+
+class TimerHandle:
+    """Returned by TimerQueue.call_later; cancel() drops the callback"""
+
+    def __init__(self, deadline: float, callback: Callable[[], None]):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerQueue:
+    """
+    Runs callbacks at a deadline from a single thread.
+
+    Pending callbacks sit in a heap ordered by deadline, and the thread
+    sleeps until the earliest one, so any number of waiting routines cost
+    one thread in total. Callbacks must be quick (e.g. hand the real work to
+    an executor): they run on the timer thread.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic, name: str = 'routine-timers'):
+        self.clock = clock
+        self.name = name
+
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self):
+        with self._condition:
+            return sum(1 for _, _, handle in self._heap if not handle.cancelled)
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> TimerHandle:
+        return self.call_at(self.clock() + max(delay, 0), callback)
+
+    def call_at(self, deadline: float, callback: Callable[[], None]) -> TimerHandle:
+        handle = TimerHandle(deadline, callback)
+        with self._condition:
+            heapq.heappush(self._heap, (deadline, next(self._counter), handle))
+            self._ensure_thread()
+            # The new entry may be earlier than what the thread sleeps for
+            self._condition.notify()
+        return handle
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _pop_due(self):
+        """Remove and return the callbacks whose deadline has passed"""
+        due = []
+        now = self.clock()
+        while self._heap and (self._heap[0][0] <= now or self._heap[0][2].cancelled):
+            _, _, handle = heapq.heappop(self._heap)
+            if not handle.cancelled:
+                due.append(handle)
+        return due
+
+    def _run(self):
+        while True:
+            with self._condition:
+                due = self._pop_due()
+                if not due:
+                    timeout = self._heap[0][0] - self.clock() if self._heap else None
+                    self._condition.wait(timeout)
+                    continue
+            for handle in due:
+                try:
+                    handle.callback()
+                except Exception as e:
+                    print(f"Timer callback failed: {e}")
@@ -0,0 +1,274 @@
+"""
+Event-driven evaluation of `device_state` RoutineTriggers.
+
+Active triggers are compiled once into comparators and indexed by
+entity_id, so a state change only evaluates the triggers watching that
+entity. Triggers are edge-triggered: a routine starts when its condition
+goes from false to true, not on every event while it stays true.
+"""
+import operator
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from apps.core.services.ha_state_mirror import state_mirror
+
+ROUTINES_COUNTER = 'routines'
+
+NUMERIC_OPERATORS = {
+    '>': operator.gt,
+    '<': operator.lt,
+    '>=': operator.ge,
+    '<=': operator.le,
+}
+STRING_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+
+def _to_float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def compile_condition(condition: str, value: str) -> Callable[[Optional[str]], bool]:
+    """
+    Turn a trigger's condition/value pair into a predicate on an HA state
+    string. `>`/`<` (and `>=`/`<=`) compare numerically and never match a
+    non-numeric state; `==`/`!=` compare strings case-insensitively.
+    Raises ValueError for unknown conditions or non-numeric thresholds.
+    """
+    condition = (condition or '==').strip()
+
+    if condition in NUMERIC_OPERATORS:
+        compare = NUMERIC_OPERATORS[condition]
+        threshold = _to_float(value)
+        if threshold is None:
+            raise ValueError(f"'{condition}' needs a numeric value, got {value!r}")
+
+        def matches(state):
+            number = _to_float(state)
+            return number is not None and compare(number, threshold)
+        return matches
+
+    if condition in STRING_OPERATORS:
+        compare = STRING_OPERATORS[condition]
+        expected = str(value if value is not None else '').strip().casefold()
+
+        def matches(state):
+            return state is not None and compare(str(state).casefold(), expected)
+        return matches
+
+    raise ValueError(f"Unknown trigger condition {condition!r}")
+
+
+class CompiledTrigger:
+    __slots__ = ('trigger_id', 'routine_id', 'entity_id', 'matches')
+
+    def __init__(self, trigger_id, routine_id, entity_id, matches):
+        self.trigger_id = trigger_id
+        self.routine_id = routine_id
+        self.entity_id = entity_id
+        self.matches = matches
+
+    @classmethod
+    def from_trigger(cls, trigger) -> 'CompiledTrigger':
+        return cls(trigger.id, trigger.routine_id, trigger.entity_id,
+                   compile_condition(trigger.condition, trigger.value))
+
+    def fires(self, old_state: Optional[Dict[str, Any]], new_state: Optional[Dict[str, Any]]) -> bool:
+        """True when the condition turns true with this change"""
+        # Without a previous state (startup, new entity) there is no edge
+        if old_state is None or new_state is None:
+            return False
+        return self.matches(new_state.get('state')) and not self.matches(old_state.get('state'))
+
+
+class TriggerIndex:
+    """
+    device_state triggers of active routines, by entity_id.
+
+    Lookups read an immutable tuple per entity without locking; updates
+    rebuild the tuples of the affected entities and swap them in.
+    """
+
+    def __init__(self):
+        self._by_entity: Dict[str, Tuple[CompiledTrigger, ...]] = {}
+        self._entities_by_routine: Dict[int, set] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(triggers) for triggers in self._by_entity.values())
+
+    @staticmethod
+    def _compile(triggers) -> List[CompiledTrigger]:
+        compiled = []
+        for trigger in triggers:
+            if not trigger.entity_id:
+                continue
+            try:
+                compiled.append(CompiledTrigger.from_trigger(trigger))
+            except ValueError as e:
+                print(f"Skipping trigger {trigger.id} of routine {trigger.routine_id}: {e}")
+        return compiled
+
+    @staticmethod
+    def _queryset():
+        from .models import RoutineTrigger
+        return RoutineTrigger.objects.filter(type='device_state', routine__is_active=True)
+
+    def load(self, triggers: Iterable = None):
+        """Rebuild the whole index (from the database unless `triggers` is given)"""
+        compiled = self._compile(self._queryset() if triggers is None else triggers)
+        by_entity: Dict[str, List[CompiledTrigger]] = {}
+        entities_by_routine: Dict[int, set] = {}
+        for trigger in compiled:
+            by_entity.setdefault(trigger.entity_id, []).append(trigger)
+            entities_by_routine.setdefault(trigger.routine_id, set()).add(trigger.entity_id)
+        with self._lock:
+            self._by_entity = {entity_id: tuple(triggers) for entity_id, triggers in by_entity.items()}
+            self._entities_by_routine = entities_by_routine
+
+    def refresh_routine(self, routine_id: int, triggers: Iterable = None):
+        """Re-read one routine's triggers (e.g. after it was edited)"""
+        compiled = self._compile(self._queryset().filter(routine_id=routine_id) if triggers is None else triggers)
+        self._replace(routine_id, compiled)
+
+    def remove_routine(self, routine_id: int):
+        self._replace(routine_id, [])
+
+    def _replace(self, routine_id: int, compiled: List[CompiledTrigger]):
+        with self._lock:
+            by_entity = dict(self._by_entity)
+            entities = self._entities_by_routine.pop(routine_id, set())
+            for entity_id in entities:
+                kept = tuple(t for t in by_entity.get(entity_id, ()) if t.routine_id != routine_id)
+                if kept:
+                    by_entity[entity_id] = kept
+                else:
+                    by_entity.pop(entity_id, None)
+            for trigger in compiled:
+                by_entity[trigger.entity_id] = by_entity.get(trigger.entity_id, ()) + (trigger,)
+            if compiled:
+                self._entities_by_routine[routine_id] = {trigger.entity_id for trigger in compiled}
+            self._by_entity = by_entity
+
+    def triggers_for(self, entity_id: str) -> Tuple[CompiledTrigger, ...]:
+        return self._by_entity.get(entity_id, ())
+
+    def match(self, entity_id: str, old_state, new_state) -> List[CompiledTrigger]:
+        """Triggers watching `entity_id` that fire on this change"""
+        return [trigger for trigger in self._by_entity.get(entity_id, ()) if trigger.fires(old_state, new_state)]
+
+
+class TriggerEngine:
+    """
+    Starts routines whose device_state triggers fire, fed by the state mirror.
+
+    Edits made in this process update the index right away (see
+    routine_changed/routine_removed). Edits made elsewhere are picked up by
+    comparing the 'routines' change counter at most every `recheck_interval`
+    seconds. With several workers, each sees the same HA events: the first
+    to claim an event in the database (a TriggerClaim row) starts the routine.
+    """
+
+    def __init__(self, runtime=None, mirror=None, index: TriggerIndex = None,
+                 recheck_interval: float = None):
+        self.mirror = mirror or state_mirror
+        self.index = index or TriggerIndex()
+        self.recheck_interval = (recheck_interval if recheck_interval is not None
+                                 else getattr(settings, 'ROUTINE_TRIGGER_RECHECK_INTERVAL', 30))
+        self._runtime = runtime
+
+        self._loaded_counter = None
+        self._checked_at = 0.0
+        self._started = False
+
+    @property
+    def runtime(self):
+        if self._runtime is None:
+            from .runtime import routine_runtime
+            self._runtime = routine_runtime
+        return self._runtime
+
+    def start(self):
+        """Load the index and listen to the state mirror (idempotent)"""
+        if self._started:
+            return
+        self._started = True
+        self.reload()
+        self.mirror.add_listener(self.on_state_changed)
+        self.mirror.ensure_started()
+
+    def stop(self):
+        self.mirror.remove_listener(self.on_state_changed)
+        self._started = False
+
+    def reload(self):
+        from apps.core.models import ChangeCounter
+        self._loaded_counter = ChangeCounter.current(ROUTINES_COUNTER)
+        self._checked_at = time.monotonic()
+        self.index.load()
+
+    # Local edits
+
+    def routine_changed(self, routine_id: int):
+        if not self._started:
+            return
+        from apps.core.models import ChangeCounter
+        self.index.refresh_routine(routine_id)
+        self._loaded_counter = ChangeCounter.current(ROUTINES_COUNTER)
+
+    def routine_removed(self, routine_id: int):
+        if self._started:
+            self.index.remove_routine(routine_id)
+
+    # Event path
+
+    def _check_for_remote_edits(self):
+        from apps.core.models import ChangeCounter
+        self._checked_at = time.monotonic()
+        if ChangeCounter.current(ROUTINES_COUNTER) != self._loaded_counter:
+            self.reload()
+
+    def _claim(self, trigger: CompiledTrigger, new_state: Dict[str, Any]) -> bool:
+        """Only one worker may start a routine for a given HA state change"""
+        from .models import TriggerClaim
+        changed = new_state.get('last_updated') or new_state.get('last_changed')
+        if not changed:
+            return True
+        return TriggerClaim.claim(trigger.routine_id, f'state:{trigger.entity_id}@{changed}')
+
+    def on_state_changed(self, entity_id, old_state, new_state, version):
+        """State mirror listener"""
+        recheck = time.monotonic() - self._checked_at >= self.recheck_interval
+        fired = self.index.match(entity_id, old_state, new_state)
+        # Events that fire nothing stay off the database entirely
+        if not fired and not recheck:
+            return []
+
+        close_old_connections()
+        try:
+            if recheck:
+                self._check_for_remote_edits()
+                fired = self.index.match(entity_id, old_state, new_state)
+            routine_ids = []
+            for trigger in fired:
+                if trigger.routine_id not in routine_ids and self._claim(trigger, new_state):
+                    routine_ids.append(trigger.routine_id)
+            for routine_id in routine_ids:
+                print(f"Trigger: {entity_id} -> {new_state.get('state')}, starting routine {routine_id}")
+                self.runtime.submit(routine_id)
+            return routine_ids
+        finally:
+            close_old_connections()
+
+
+# Singleton instance
+trigger_engine = TriggerEngine()
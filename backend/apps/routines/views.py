@@ -1,55 +1,20 @@
+import datetime
+
+from django.utils import timezone
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from apps.core.mixins import ConditionalListMixin
+from .history import RunHistory
 from .models import Scene, NezuRoutine
 from .serializers import SceneSerializer, NezuRoutineSerializer
 from apps.core.services.ha_client import ha_client
 
-class SceneViewSet(viewsets.ModelViewSet):
+class SceneViewSet(ConditionalListMixin, viewsets.ModelViewSet):
+    # list is a pure read: the catalog is synced by apps.devices.reconciler
     queryset = Scene.objects.all()
     serializer_class = SceneSerializer
-
-    def list(self, request, *args, **kwargs):
-        """
-        Sync scenes/scripts from HA before listing
-        """
-        try:
-            states = ha_client.get_states()
-            active_entity_ids = []
-            
-            for state in states:
-                entity_id = state.get('entity_id', '')
-                domain = entity_id.split('.')[0]
-                
-                if domain in ['scene', 'automation']:
-                    attributes = state.get('attributes', {})
-                    friendly_name = attributes.get('friendly_name', entity_id)
-                    icon = attributes.get('icon', '')
-                    
-                    scene, created = Scene.objects.get_or_create(
-                        entity_id=entity_id,
-                        defaults={
-                            'name': friendly_name,
-                            'type': domain,
-                            'icon': icon
-                        }
-                    )
-                    
-                    if not created:
-                        scene.type = domain
-                        scene.icon = icon
-                        scene.save()
-                    active_entity_ids.append(entity_id)
-            
-            # Delete scenes that are no longer in HA
-            deleted_count, _ = Scene.objects.exclude(entity_id__in=active_entity_ids).delete()
-            if deleted_count > 0:
-                print(f"Deleted {deleted_count} stale scenes/automations")
-                
-        except Exception as e:
-            print(f"Error syncing scenes: {e}")
-
-        return super().list(request, *args, **kwargs)
+    etag_counters = ('scenes',)
 
     @action(detail=True, methods=['post'])
     def execute(self, request, pk=None):
@@ -72,21 +37,58 @@ class SceneViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
-class NezuRoutineViewSet(viewsets.ModelViewSet):
+class NezuRoutineViewSet(ConditionalListMixin, viewsets.ModelViewSet):
     queryset = NezuRoutine.objects.all()
     serializer_class = NezuRoutineSerializer
+    etag_counters = ('routines',)
+    # Bounds ?days= of stats/ (larger values overflow the date arithmetic)
+    STATS_MAX_DAYS = 3650
 
     @action(detail=True, methods=['post'])
     def execute(self, request, pk=None):
+        """
+        Start the routine in the background; poll runs/<run_id>/ for progress
+        """
         routine = self.get_object()
         
         try:
-            from .services import RoutineService
-            results = RoutineService.execute_routine(routine.id)
-            return Response({'status': 'executed', 'results': results})
+            from .runtime import routine_runtime
+            execution = routine_runtime.submit(routine)
+            return Response(
+                {'status': 'accepted', 'run_id': execution.id, 'run': execution.snapshot()},
+                status=status.HTTP_202_ACCEPTED
+            )
             
         except Exception as e:
             return Response(
                 {'error': str(e), 'routine': routine.name}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
+
+    @action(detail=False, methods=['get'], url_path=r'runs/(?P<run_id>[0-9a-f]{32})')
+    def run(self, request, run_id=None):
+        """
+        Progress of a routine run: overall status and per-action status/timings
+        """
+        from .runtime import routine_runtime
+        run = routine_runtime.get_run(run_id)
+        if run is None:
+            return Response({'error': 'Run not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(run)
+
+    @action(detail=False, methods=['get'])
+    def stats(self, request):
+        """
+        Run history of the last `days` days (default 7, at most
+        STATS_MAX_DAYS): p50/p95 duration per routine, slowest first, and
+        error rate/HA latency per entity
+        """
+        try:
+            days = int(request.query_params.get('days', 7))
+        except ValueError:
+            return Response({'error': 'days must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= days <= self.STATS_MAX_DAYS:
+            return Response({'error': f'days must be between 1 and {self.STATS_MAX_DAYS}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        since = timezone.now() - datetime.timedelta(days=days)
+        return Response({'days': days, **RunHistory.stats(since)})
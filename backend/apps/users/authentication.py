@@ -0,0 +1,174 @@
+"""
+In-process cache for token authentication.
+
+Every API request (the dashboard polls every couple of seconds, Alexa sends
+a directive per utterance) used to look its token and user up in the
+database. TokenCache keeps the result of that lookup, keyed by a SHA-256 of
+the token, in a bounded LRU: a hit authenticates without a query. Entries
+never outlive the token's own expiry, and signals.py drops them when a token
+is deleted, rotated or edited, or its user changes.
+
+Other worker processes learn about those changes through a generation
+number in the shared cache (CACHES): every invalidation bumps it, and a
+worker that sees a new value drops all its entries. It is read at most
+every `check_interval` seconds, which bounds how long another worker can
+still accept a revoked token (with a per-process cache such as locmem,
+`ttl` is the only bound).
+"""
+import copy
+import datetime
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, NamedTuple, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from oauth2_provider.contrib.rest_framework import OAuth2Authentication
+from rest_framework.authentication import TokenAuthentication
+
+
+class CachedToken(NamedTuple):
+    user_id: int
+    scopes: str
+    expires: Optional[datetime.datetime]
+    user: Any   # copied on every hit, so requests never share an instance
+    auth: Any   # the token row (oauth2 AccessToken or authtoken Token)
+
+
+class TokenCache:
+    """Bounded LRU of authenticated tokens, safe to share between threads"""
+
+    GENERATION_KEY = 'auth_token_cache:generation'
+
+    def __init__(self, max_size: int = None, ttl: float = None, check_interval: float = None):
+        self.max_size = max_size if max_size is not None else getattr(settings, 'AUTH_TOKEN_CACHE_SIZE', 1024)
+        self.ttl = ttl if ttl is not None else getattr(settings, 'AUTH_TOKEN_CACHE_TTL', 300)
+        self.check_interval = (check_interval if check_interval is not None
+                               else getattr(settings, 'AUTH_TOKEN_CACHE_CHECK_INTERVAL', 2))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+        self._checked_at = None
+
+    @staticmethod
+    def _key(kind: str, token: str) -> str:
+        return hashlib.sha256(f'{kind}:{token}'.encode()).hexdigest()
+
+    def get(self, kind: str, token: str):
+        """
+        (user, auth) for a cached token, as fresh copies, or None on a miss.
+        Expired tokens are dropped here, so the caller's own lookup decides
+        what to answer for them.
+        """
+        if not self.max_size:
+            return None
+        self._check_generation()
+        key = self._key(kind, token)
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            deadline, entry = item
+            if time.monotonic() >= deadline or (entry.expires is not None and entry.expires <= timezone.now()):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        user, auth = copy.copy(entry.user), copy.copy(entry.auth)
+        auth.user = user
+        return user, auth
+
+    def put(self, kind: str, token: str, user, auth, scopes: str = '', expires: datetime.datetime = None):
+        if not self.max_size:
+            return
+        self._check_generation()
+        entry = CachedToken(user.pk, scopes, expires, copy.copy(user), copy.copy(auth))
+        key = self._key(kind, token)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, kind: str, token: str):
+        with self._lock:
+            self._entries.pop(self._key(kind, token), None)
+        self._bump_generation()
+
+    def invalidate_user(self, user_id):
+        """Drop every token of a user (after the user row changes)"""
+        with self._lock:
+            for key in [key for key, (_, entry) in self._entries.items() if entry.user_id == user_id]:
+                del self._entries[key]
+        self._bump_generation()
+
+    def _check_generation(self):
+        """Drop every entry once another worker has invalidated something"""
+        now = time.monotonic()
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+        try:
+            generation = cache.get(self.GENERATION_KEY, 0)
+        except Exception as e:
+            # Without the shared cache, entries still expire after `ttl`
+            print(f"TokenCache: could not read the generation: {e}")
+            return
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+                self._generation = generation
+
+    def _bump_generation(self):
+        try:
+            cache.add(self.GENERATION_KEY, 0, timeout=None)
+            cache.incr(self.GENERATION_KEY)
+        except Exception as e:
+            print(f"TokenCache: could not publish an invalidation: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CachedOAuth2Authentication(OAuth2Authentication):
+    """OAuth2Authentication answering known Bearer tokens from the token cache"""
+
+    def authenticate(self, request):
+        auth_header = request.META.get('HTTP_AUTHORIZATION', '')
+        if not auth_header.startswith('Bearer '):
+            return super().authenticate(request)
+
+        token_str = auth_header.split(' ', 1)[1]
+        cached = token_cache.get('oauth2', token_str)
+        if cached is not None:
+            return cached
+
+        result = super().authenticate(request)
+        if result is not None:
+            user, access_token = result
+            token_cache.put('oauth2', token_str, user, access_token, access_token.scope, access_token.expires)
+        return result
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """DRF TokenAuthentication answering known keys from the token cache"""
+
+    def authenticate_credentials(self, key):
+        cached = token_cache.get('token', key)
+        if cached is not None:
+            return cached
+
+        user, token = super().authenticate_credentials(key)
+        token_cache.put('token', key, user, token)
+        return user, token
+
+
+# Singleton instance
+token_cache = TokenCache()
@@ -0,0 +1,41 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from oauth2_provider.models import AccessToken
+from rest_framework.authtoken.models import Token
+
+from .authentication import token_cache
+from .models import User
+
+# Entries are dropped once the change commits: until then other requests
+# still read the old rows, and dropping earlier would let one of them cache
+# the old row again. New rows have nothing cached, and each invalidation
+# makes every worker drop its whole cache, so creations are skipped.
+
+
+@receiver(post_save, sender=AccessToken)
+@receiver(post_delete, sender=AccessToken)
+def drop_cached_access_token(sender, instance, created=False, **kwargs):
+    if created:
+        return
+    token = instance.token
+    transaction.on_commit(lambda: token_cache.invalidate('oauth2', token))
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def drop_cached_token(sender, instance, created=False, **kwargs):
+    if created:
+        return
+    key = instance.key
+    transaction.on_commit(lambda: token_cache.invalidate('token', key))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def drop_cached_user_tokens(sender, instance, created=False, update_fields=None, **kwargs):
+    # Deactivations, renames, permission changes; not logins
+    if created or update_fields == frozenset(['last_login']):
+        return
+    user_id = instance.pk
+    transaction.on_commit(lambda: token_cache.invalidate_user(user_id))
@@ -1,3 +1,75 @@
+import datetime
+from unittest import mock
+
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from oauth2_provider.models import AccessToken, Application
+from rest_framework.authtoken.models import Token
+
+from .authentication import TokenCache, token_cache
+from .models import User
+
+
+class TokenAuthenticationCacheTests(TestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.user = User.objects.create_user(username='owner', password='x', first_name='Ana')
+        self.token = Token.objects.create(user=self.user)
+        app = Application.objects.create(name='Dashboard', user=self.user, client_type=Application.CLIENT_CONFIDENTIAL,
+                                         authorization_grant_type=Application.GRANT_AUTHORIZATION_CODE)
+        self.access_token = AccessToken.objects.create(user=self.user, application=app, token='bearer-1', scope='read',
+                                                       expires=timezone.now() + datetime.timedelta(hours=1))
+
+    def me(self, authorization):
+        return self.client.get('/api/auth/me/', HTTP_AUTHORIZATION=authorization)
+
+    def assert_cached_request_saves_a_query(self, authorization):
+        with CaptureQueriesContext(connection) as first:
+            self.assertEqual(self.me(authorization).status_code, 200)
+        with CaptureQueriesContext(connection) as cached:
+            self.assertEqual(self.me(authorization).status_code, 200)
+        self.assertEqual(len(first), 1)
+        self.assertEqual(len(cached), 0)
+
+    def test_drf_tokens_are_cached(self):
+        self.assert_cached_request_saves_a_query(f'Token {self.token.key}')
+
+    def test_oauth2_tokens_are_cached(self):
+        self.assert_cached_request_saves_a_query('Bearer bearer-1')
+
+    def test_expired_oauth2_tokens_are_refused(self):
+        self.assertEqual(self.me('Bearer bearer-1').status_code, 200)
+        with mock.patch('django.utils.timezone.now', return_value=self.access_token.expires):
+            self.assertEqual(self.me('Bearer bearer-1').status_code, 401)
+
+    def test_deleted_tokens_are_refused(self):
+        self.assertEqual(self.me(f'Token {self.token.key}').status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.token.delete()
+        self.assertEqual(self.me(f'Token {self.token.key}').status_code, 401)
+
+    def test_deactivated_users_are_refused(self):
+        self.assertEqual(self.me(f'Token {self.token.key}').json()['first_name'], 'Ana')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        self.assertEqual(self.me(f'Token {self.token.key}').status_code, 401)
+
+    def test_invalidations_reach_other_workers(self):
+        worker, other_worker = TokenCache(ttl=300, check_interval=0), TokenCache(ttl=300, check_interval=0)
+        worker.put('token', self.token.key, self.user, self.token)
+        self.assertIsNotNone(worker.get('token', self.token.key))
+        other_worker.invalidate('token', self.token.key)
+        self.assertIsNone(worker.get('token', self.token.key))
 
-# Create your tests here.
+    def test_cache_is_bounded(self):
+        cache = TokenCache(max_size=2, ttl=60)
+        for key in ('a', 'b', 'c'):
+            cache.put('token', key, self.user, self.token)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('token', 'a'))
+        user, token = cache.get('token', 'c')
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertIsNot(user, cache.get('token', 'c')[0])
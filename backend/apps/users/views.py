@@ -91,12 +91,12 @@ class SyncUsersView(APIView):
     permission_classes = (IsAuthenticated,)
 
     def post(self, request):
-        from apps.core.services.ha_client import ha_client
+        from apps.core.services.ha_state_cache import state_cache
         from django.contrib.auth import get_user_model
         User = get_user_model()
         
         try:
-            persons = ha_client.get_persons()
+            persons = [state for state in state_cache.get_states() if state['entity_id'].startswith('person.')]
             synced_count = 0
             synced_usernames = []
             
@@ -8,3 +8,5 @@ pip install -r requirements.txt
 
 python manage.py collectstatic --no-input
 python manage.py migrate
+# Table for CACHE_URL=dbcache://nezu_cache (no-op when it exists)
+python manage.py createcachetable
@@ -161,6 +161,15 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Custom user model
 AUTH_USER_MODEL = 'users.User'
 
+# Cache shared by all workers: HA state snapshots, routine run progress and the
+# Alexa discovery payload. locmem (the default, for development and tests) is
+# per-process and only correct with a single worker; render.yaml uses the
+# database cache (dbcache://nezu_cache, table created by build.sh).
+# `manage.py check --deploy` warns about process-local caches (core.W001).
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
 
 # CORS Configuration
 CORS_ALLOW_ALL_ORIGINS = True  # Allow OAuth2 from Amazon
@@ -184,18 +193,90 @@ CORS_ALLOW_HEADERS = [
 # DRF Configuration
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'oauth2_provider.contrib.rest_framework.OAuth2Authentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'apps.users.authentication.CachedOAuth2Authentication',
+        'apps.users.authentication.CachedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
     'DEFAULT_RENDERER_CLASSES': [
         'rest_framework.renderers.JSONRenderer',
     ],
 }
+# Authenticated tokens kept in memory per worker (0 disables), for at most TTL
+# seconds. Revocations reach other workers through a generation number in the
+# shared cache (CACHES), read at most every CHECK_INTERVAL seconds: that is how
+# long another worker can still accept a revoked token
+AUTH_TOKEN_CACHE_SIZE = env.int('AUTH_TOKEN_CACHE_SIZE', default=1024)
+AUTH_TOKEN_CACHE_TTL = env.float('AUTH_TOKEN_CACHE_TTL', default=300)
+AUTH_TOKEN_CACHE_CHECK_INTERVAL = env.float('AUTH_TOKEN_CACHE_CHECK_INTERVAL', default=2)
 
 # Home Assistant Configuration
 HOMEASSISTANT_URL = env('HOMEASSISTANT_URL', default='http://192.168.1.34:8123')
 HOMEASSISTANT_TOKEN = env('HOMEASSISTANT_TOKEN', default='')
+# Keep-alive connection pool shared by all threads of a worker
+HOMEASSISTANT_POOL_SIZE = env.int('HOMEASSISTANT_POOL_SIZE', default=10)
+# Extra attempts for failed GETs (POST service calls are never retried)
+HOMEASSISTANT_GET_RETRIES = env.int('HOMEASSISTANT_GET_RETRIES', default=2)
+# Max service calls in flight when fanning out commands (room toggles, batch toggles)
+HOMEASSISTANT_MAX_CONCURRENCY = env.int('HOMEASSISTANT_MAX_CONCURRENCY', default=10)
+# Keep an in-process copy of HA states fed by the WebSocket event stream
+HOMEASSISTANT_STATE_MIRROR_ENABLED = env.bool('HOMEASSISTANT_STATE_MIRROR_ENABLED', default=True)
+# Cross-worker HA states snapshot: cache alias and seconds between refreshes
+HOMEASSISTANT_STATE_CACHE_ALIAS = env('HOMEASSISTANT_STATE_CACHE_ALIAS', default='default')
+HOMEASSISTANT_STATE_CACHE_INTERVAL = env.int('HOMEASSISTANT_STATE_CACHE_INTERVAL', default=5)
+# Seconds the cached entity registry index is trusted before re-downloading it
+HOMEASSISTANT_REGISTRY_TTL = env.int('HOMEASSISTANT_REGISTRY_TTL', default=300)
+# Background HA -> DB device reconciliation (disable when running `manage.py reconcile_devices` separately)
+DEVICE_RECONCILER_ENABLED = env.bool('DEVICE_RECONCILER_ENABLED', default=True)
+DEVICE_RECONCILE_INTERVAL = env.int('DEVICE_RECONCILE_INTERVAL', default=30)
+# Seconds the reconciling worker's lease (in CACHES) lasts without renewal;
+# only that worker reconciles, another one takes over when it dies
+DEVICE_RECONCILER_LEASE = env.int('DEVICE_RECONCILER_LEASE', default=60)
+# GET /api/devices/?since=: seconds a device write may take to commit after taking
+# its version, and days deletions are remembered (older `since` values get the full list)
+DEVICE_VERSION_OVERLAP = env.float('DEVICE_VERSION_OVERLAP', default=5)
+DEVICE_TOMBSTONE_RETENTION_DAYS = env.int('DEVICE_TOMBSTONE_RETENTION_DAYS', default=7)
+# /api/devices/stream/ (SSE): seconds before a stream is recycled, keep-alive
+# comment interval, and how many deltas are kept for Last-Event-ID replays
+DEVICE_STREAM_MAX_AGE = env.int('DEVICE_STREAM_MAX_AGE', default=300)
+DEVICE_STREAM_HEARTBEAT = env.int('DEVICE_STREAM_HEARTBEAT', default=15)
+DEVICE_STREAM_BUFFER_SIZE = env.int('DEVICE_STREAM_BUFFER_SIZE', default=1000)
+# Open streams per worker; keep well below gunicorn's --threads (each stream holds
+# one). Clients refused with a 503 poll GET /api/devices/?since= instead
+DEVICE_STREAM_MAX_CONNECTIONS = env.int('DEVICE_STREAM_MAX_CONNECTIONS', default=4)
+# Routine runtime: worker threads per process, and where/how long run progress is kept
+ROUTINE_RUNTIME_WORKERS = env.int('ROUTINE_RUNTIME_WORKERS', default=4)
+ROUTINE_RUN_CACHE_ALIAS = env('ROUTINE_RUN_CACHE_ALIAS', default='default')
+ROUTINE_RUN_TTL = env.int('ROUTINE_RUN_TTL', default=3600)
+# Store finished runs (RoutineRun/RoutineActionResult), and for how many days
+ROUTINE_RUN_HISTORY = env.bool('ROUTINE_RUN_HISTORY', default=True)
+ROUTINE_RUN_RETENTION_DAYS = env.int('ROUTINE_RUN_RETENTION_DAYS', default=30)
+# Per routine stage: max HA requests in flight and seconds before one is abandoned
+ROUTINE_MAX_FANOUT = env.int('ROUTINE_MAX_FANOUT', default=10)
+ROUTINE_ACTION_TIMEOUT = env.int('ROUTINE_ACTION_TIMEOUT', default=10)
+# Seconds a cached routine plan is trusted before checking for edits made by other processes
+ROUTINE_PLAN_RECHECK_INTERVAL = env.int('ROUTINE_PLAN_RECHECK_INTERVAL', default=5)
+# device_state/time triggers: evaluate in this process, and how often (seconds)
+# the device_state engine looks for routine edits made by other processes
+ROUTINE_TRIGGERS_ENABLED = env.bool('ROUTINE_TRIGGERS_ENABLED', default=True)
+ROUTINE_TRIGGER_RECHECK_INTERVAL = env.int('ROUTINE_TRIGGER_RECHECK_INTERVAL', default=30)
+# Local time zone and coordinates of the home, for time and sun routine triggers
+HOME_TIME_ZONE = env('HOME_TIME_ZONE', default=TIME_ZONE)
+HOME_LATITUDE = env.float('HOME_LATITUDE', default=None)
+HOME_LONGITUDE = env.float('HOME_LONGITUDE', default=None)
+# Where the precomputed year of sunrise/sunset times is kept between restarts
+SUN_TABLE_PATH = env('SUN_TABLE_PATH', default=str(BASE_DIR / 'sun_table.npz'))
+# Seconds the Alexa discovery payload may be served from the cache; edits
+# drop it right away, this only bounds staleness with a per-process cache
+ALEXA_DISCOVERY_CACHE_ALIAS = env('ALEXA_DISCOVERY_CACHE_ALIAS', default='default')
+ALEXA_DISCOVERY_TTL = env.int('ALEXA_DISCOVERY_TTL', default=3600)
+# Routines estimated (delays + seconds per stage) to take longer than the budget
+# are answered with a DeferredResponse and report back through the event outbox
+ALEXA_RESPONSE_BUDGET = env.float('ALEXA_RESPONSE_BUDGET', default=3.0)
+ALEXA_STAGE_LATENCY_ESTIMATE = env.float('ALEXA_STAGE_LATENCY_ESTIMATE', default=0.5)
+# Hours outbox events are kept once sent (or while Alexa could still accept them)
+ALEXA_EVENT_RETENTION_HOURS = env.int('ALEXA_EVENT_RETENTION_HOURS', default=24)
+# Seconds a room TurnOn/TurnOff waits for HA before answering Alexa (commands keep going)
+ALEXA_ROOM_POWER_BUDGET = env.float('ALEXA_ROOM_POWER_BUDGET', default=2.0)
 
 # OAuth2 Configuration
 LOGIN_URL = '/api/auth/auto-login/'
@@ -214,6 +295,9 @@ OAUTH2_PROVIDER = {
     'PKCE_REQUIRED': False,  # Alexa doesn't support PKCE
     'CLIENT_SECRET_GENERATOR_CLASS': 'oauth2_provider.generators.ClientSecretGenerator',  # Use plain text secrets
 }
+# Swappable model settings, needed by models with a foreign key to tokens or applications
+OAUTH2_PROVIDER_ACCESS_TOKEN_MODEL = 'oauth2_provider.AccessToken'
+OAUTH2_PROVIDER_APPLICATION_MODEL = 'oauth2_provider.Application'
 
 # Email Configuration
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -29,6 +29,38 @@ export function DataProvider({ children }: { children: React.ReactNode }) {
   const [isLoading, setIsLoading] = React.useState(true);
   const pendingUpdates = React.useRef(new Set<string>());
 
+  // Every device by id, as last received from the API or the stream
+  const allDevices = React.useRef(new Map<string, Device>());
+
+  const publishDevices = React.useCallback(() => {
+    const onlineLights = Array.from(allDevices.current.values()).filter(d => 
+      d.isOnline && 
+      (d.type === 'light' || d.type === 'switch') &&
+      d.room && 
+      d.room !== "Sin Asignar"
+    );
+
+    setDevices(prev => {
+      if (pendingUpdates.current.size === 0) {
+        const isDifferent = JSON.stringify(prev) !== JSON.stringify(onlineLights);
+        return isDifferent ? onlineLights : prev;
+      }
+
+      return onlineLights.map(newDevice => {
+        if (pendingUpdates.current.has(String(newDevice.id))) {
+          const currentDevice = prev.find(d => d.id === newDevice.id);
+          return currentDevice || newDevice;
+        }
+        return newDevice;
+      });
+    });
+  }, []);
+
+  const replaceDevices = React.useCallback((devicesData: Device[]) => {
+    allDevices.current = new Map(devicesData.map(d => [String(d.id), d]));
+    publishDevices();
+  }, [publishDevices]);
+
   const loadData = React.useCallback(async (showLoading = false) => {
     try {
       if (showLoading) setIsLoading(true);
@@ -39,28 +71,7 @@ export function DataProvider({ children }: { children: React.ReactNode }) {
         routineService.getNezuRoutines()
       ]);
 
-      const onlineLights = devicesData.filter(d => 
-        d.isOnline && 
-        (d.type === 'light' || d.type === 'switch') &&
-        d.room && 
-        d.room !== "Sin Asignar"
-      );
-
-      setDevices(prev => {
-        if (pendingUpdates.current.size === 0) {
-          const isDifferent = JSON.stringify(prev) !== JSON.stringify(onlineLights);
-          return isDifferent ? onlineLights : prev;
-        }
-
-        return onlineLights.map(newDevice => {
-          if (pendingUpdates.current.has(newDevice.id)) {
-            const currentDevice = prev.find(d => d.id === newDevice.id);
-            return currentDevice || newDevice;
-          }
-          return newDevice;
-        });
-      });
-
+      replaceDevices(devicesData);
       setScenes(scenesData);
       setRoutines(routinesData);
     } catch (error) {
@@ -68,24 +79,79 @@ export function DataProvider({ children }: { children: React.ReactNode }) {
     } finally {
       if (showLoading) setIsLoading(false);
     }
-  }, []);
+  }, [replaceDevices]);
 
   // Initial load
   React.useEffect(() => {
     loadData(true);
   }, [loadData]);
 
-  // Polling
+  // Live device updates: the server pushes a snapshot and then only deltas.
+  // EventSource reconnects by itself and sends Last-Event-ID, so a short
+  // disconnect only replays the missed deltas.
   React.useEffect(() => {
-    const intervalId = setInterval(() => {
-      loadData(false);
-    }, 2000);
+    // Poll for changed rows only: without SSE support, or when the server
+    // refuses the stream (all of its stream slots are taken)
+    let intervalId: ReturnType<typeof setInterval> | undefined;
+    const startPolling = () => {
+      let version = 0;
+      intervalId = setInterval(async () => {
+        try {
+          const changes = await deviceService.getDeviceChanges(version);
+          if (changes.reset) allDevices.current.clear();
+          changes.devices.forEach(d => allDevices.current.set(String(d.id), d));
+          changes.deleted.forEach(id => allDevices.current.delete(String(id)));
+          version = changes.version;
+          publishDevices();
+        } catch (error) {
+          console.error("Error polling device changes:", error);
+        }
+      }, 2000);
+    };
 
-    return () => clearInterval(intervalId);
-  }, [loadData]);
+    if (typeof EventSource === "undefined") {
+      startPolling();
+      return () => clearInterval(intervalId);
+    }
+
+    const source = new EventSource(deviceService.getStreamUrl());
+
+    // Non-200 answers (503 when the server is at its stream limit) close the
+    // source for good instead of reconnecting
+    source.addEventListener("error", () => {
+      if (source.readyState === EventSource.CLOSED && intervalId === undefined) {
+        startPolling();
+      }
+    });
+
+    source.addEventListener("snapshot", (event) => {
+      const { devices: devicesData } = JSON.parse((event as MessageEvent).data);
+      replaceDevices(devicesData);
+    });
+
+    source.addEventListener("delta", (event) => {
+      const delta = JSON.parse((event as MessageEvent).data);
+      const id = String(delta.id);
+
+      if (delta.removed) {
+        allDevices.current.delete(id);
+      } else {
+        const fields = { ...delta.fields };
+        // Keep the optimistic state of devices the user just toggled
+        if (pendingUpdates.current.has(id)) delete fields.isOn;
+        allDevices.current.set(id, { ...allDevices.current.get(id), ...fields } as Device);
+      }
+      publishDevices();
+    });
+
+    return () => {
+      source.close();
+      clearInterval(intervalId);
+    };
+  }, [replaceDevices, publishDevices]);
 
   const toggleDevice = async (id: string, isOn: boolean) => {
-    pendingUpdates.current.add(id);
+    pendingUpdates.current.add(String(id));
 
     setDevices(prev => prev.map(d => {
       if (d.id === id) {
@@ -97,11 +163,11 @@ export function DataProvider({ children }: { children: React.ReactNode }) {
     try {
       await deviceService.toggleDevice(id, isOn);
       setTimeout(() => {
-        pendingUpdates.current.delete(id);
+        pendingUpdates.current.delete(String(id));
       }, 2000);
     } catch (error) {
       console.error("Error toggling device:", error);
-      pendingUpdates.current.delete(id);
+      pendingUpdates.current.delete(String(id));
       setDevices(prev => prev.map(d => {
         if (d.id === id) {
           return { ...d, isOn: !isOn };
@@ -112,7 +178,7 @@ export function DataProvider({ children }: { children: React.ReactNode }) {
   };
 
   const batchToggle = async (ids: string[], isOn: boolean) => {
-    ids.forEach(id => pendingUpdates.current.add(id));
+    ids.forEach(id => pendingUpdates.current.add(String(id)));
 
     setDevices(prev => prev.map(d => {
       if (ids.includes(d.id)) {
@@ -124,12 +190,12 @@ export function DataProvider({ children }: { children: React.ReactNode }) {
     try {
       await deviceService.batchToggle(ids, isOn);
       setTimeout(() => {
-        ids.forEach(id => pendingUpdates.current.delete(id));
+        ids.forEach(id => pendingUpdates.current.delete(String(id)));
       }, 2000);
     } catch (error) {
       console.error("Error in batch toggle:", error);
       loadData(false);
-      ids.forEach(id => pendingUpdates.current.delete(id));
+      ids.forEach(id => pendingUpdates.current.delete(String(id)));
     }
   };
 
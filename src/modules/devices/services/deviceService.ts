@@ -1,5 +1,5 @@
 import api from "../../core/services/api";
-import { Device } from "../types/device";
+import { Device, DeviceChanges } from "../types/device";
 
 export const deviceService = {
   getDevices: async (): Promise<Device[]> => {
@@ -26,4 +26,14 @@ export const deviceService = {
     const response = await api.post<Device[]>("/devices/batch_toggle/", { ids, isOn });
     return response.data;
   },
+
+  // Only devices written after `since` (0 = all), ids deleted since then
+  // and the version to pass next time (`reset` when the list is complete)
+  getDeviceChanges: async (since: number): Promise<DeviceChanges> => {
+    const response = await api.get<DeviceChanges>("/devices/", { params: { since } });
+    return response.data;
+  },
+
+  // Server-Sent Events feed: a "snapshot" event, then "delta" events
+  getStreamUrl: (): string => `${api.defaults.baseURL}/devices/stream/`,
 };
@@ -12,3 +12,11 @@ export interface Device {
   isOnline: boolean;
   attributes?: Record<string, any>;
 }
+
+export interface DeviceChanges {
+  devices: Device[];
+  deleted: string[];
+  version: number;
+  // `devices` is the full list: drop anything else
+  reset: boolean;
+}
@@ -83,9 +83,11 @@ export default function RoutineBuilderPage({ routineId }: RoutineBuilderPageProp
   };
 
   const addAction = () => {
+    // New actions run together with the previous one (same order = same stage)
+    const last = routine.actions[routine.actions.length - 1];
     const newAction: RoutineAction = {
       action_type: "turn_on",
-      order: routine.actions.length,
+      order: last ? last.order : 0,
       data: {}
     };
     setRoutine({ ...routine, actions: [...routine.actions, newAction] });
@@ -115,6 +117,20 @@ export default function RoutineBuilderPage({ routineId }: RoutineBuilderPageProp
     setRoutine({ ...routine, actions: newActions });
   };
 
+  // Actions sharing an order run concurrently; "after previous" starts a new stage
+  const setRunsWithPrevious = (index: number, together: boolean) => {
+    const previous = routine.actions[index - 1];
+    if (!previous || together === (routine.actions[index].order === previous.order)) return;
+    // Move this action (and everything after it) by however far it is from
+    // the previous stage: orders saved elsewhere may have gaps
+    const target = together ? previous.order : previous.order + 1;
+    const shift = target - routine.actions[index].order;
+    const newActions = routine.actions.map((action, i) =>
+      i >= index ? { ...action, order: action.order + shift } : action
+    );
+    setRoutine({ ...routine, actions: newActions });
+  };
+
   if (isLoading) {
     return <div className="p-8 text-center">Loading...</div>;
   }
@@ -298,6 +314,16 @@ export default function RoutineBuilderPage({ routineId }: RoutineBuilderPageProp
                     <option value="turn_off">Turn Off</option>
                     <option value="toggle">Toggle</option>
                   </select>
+                  {idx > 0 && (
+                    <select
+                      value={action.order === routine.actions[idx - 1].order ? "together" : "after"}
+                      onChange={e => setRunsWithPrevious(idx, e.target.value === "together")}
+                      className="px-2 py-1 rounded border border-slate-300 dark:border-slate-600 bg-transparent"
+                    >
+                      <option value="together">With previous</option>
+                      <option value="after">After previous</option>
+                    </select>
+                  )}
                 </div>
               </div>
             ))}
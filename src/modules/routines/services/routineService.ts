@@ -1,6 +1,6 @@
 import api from '../../core/services/api';
 import { Scene } from '../types/routine';
-import { NezuRoutine } from '../types/nezuRoutine';
+import { NezuRoutine, RoutineRun } from '../types/nezuRoutine';
 
 export const routineService = {
   getScenes: async (): Promise<Scene[]> => {
@@ -23,8 +23,15 @@ export const routineService = {
     return response.data;
   },
 
-  executeNezuRoutine: async (id: number): Promise<void> => {
-    await api.post(`/nezu-routines/${id}/execute/`);
+  // Starts the routine in the background and returns its run id
+  executeNezuRoutine: async (id: number): Promise<string> => {
+    const response = await api.post(`/nezu-routines/${id}/execute/`);
+    return response.data.run_id;
+  },
+
+  getRoutineRun: async (runId: string): Promise<RoutineRun> => {
+    const response = await api.get(`/nezu-routines/runs/${runId}/`);
+    return response.data;
   },
 
   updateNezuRoutine: async (routine: NezuRoutine): Promise<NezuRoutine> => {
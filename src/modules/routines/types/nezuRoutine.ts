@@ -28,3 +28,26 @@ export interface NezuRoutine {
   triggers: RoutineTrigger[];
   actions: RoutineAction[];
 }
+
+export interface RoutineActionProgress {
+  action_id: number;
+  device_id?: string | null;
+  type: string;
+  status: 'pending' | 'running' | 'waiting' | 'success' | 'error' | 'skipped';
+  started_at: string | null;
+  finished_at: string | null;
+  duration_ms: number | null;
+  error: string | null;
+}
+
+export interface RoutineRun {
+  id: string;
+  routine_id: number;
+  routine_name: string;
+  status: 'queued' | 'running' | 'waiting' | 'success' | 'error';
+  error: string | null;
+  created_at: string;
+  started_at: string | null;
+  finished_at: string | null;
+  actions: RoutineActionProgress[];
+}